@@ -0,0 +1,328 @@
+import copy
+from datetime import date
+import sys
+
+import numpy as np
+
+import containers
+
+
+class NumericColumn(object):
+  """Column of numbers, held in a numpy array of the given dtype.
+
+  Missing values are represented by a sentinel: NaN for floating point columns
+  and the lowest representable number for integer ones.
+  """
+  def __init__(self, dtype:str, values:list, missing=None):
+    self.dtype = np.dtype(dtype)
+    if missing is not None:
+      self.missing = missing
+    elif self.dtype.kind == 'f':
+      self.missing = np.nan
+    else:
+      self.missing = np.iinfo(self.dtype).min
+    self.values = np.array(self.encodeAll(values), dtype=self.dtype)
+
+  def encodeAll(self, values:list):
+    missing = self.missing
+    return [missing if value is None else value for value in values]
+
+  def encode(self, value):
+    return value
+
+  def decode(self, value):
+    return value.item()
+
+  def present(self):
+    """Return a boolean mask of rows for which the value is not missing."""
+    if self.dtype.kind == 'f':
+      return ~np.isnan(self.values)
+    return self.values != self.missing
+
+  def get(self, row:int):
+    value = self.values[row]
+    if value != value or value == self.missing:
+      return None
+    return self.decode(value)
+
+  def set(self, row:int, value):
+    self.values[row] = self.missing if value is None else self.encode(value)
+
+  def take(self, rows:np.ndarray):
+    """Return a column of the values at the given rows (missing where -1)."""
+    column = copy.copy(self)
+    column.values = np.full(len(rows), self.missing, dtype=self.dtype)
+    taken = rows >= 0
+    column.values[taken] = self.values[rows[taken]]
+    return column
+
+
+class DateColumn(NumericColumn):
+  """Column of dates, held as their proleptic Gregorian ordinals (0: missing)."""
+  def __init__(self, values:list):
+    super(DateColumn, self).__init__('int32', values, missing=0)
+
+  def encodeAll(self, values:list):
+    return [0 if value is None else value.toordinal() for value in values]
+
+  def encode(self, value:date):
+    return value.toordinal()
+
+  def decode(self, value):
+    return date.fromordinal(int(value))
+
+
+class ObjectColumn(object):
+  """Column of arbitrary objects (i.e. strings), with None for missing values."""
+  def __init__(self, values:list):
+    self.values = self.encodeAll(values)
+
+  def encodeAll(self, values:list):
+    return list(values)
+
+  def encode(self, value):
+    return value
+
+  def present(self):
+    return np.array([value is not None for value in self.values], dtype=bool)
+
+  def get(self, row:int):
+    return self.values[row]
+
+  def set(self, row:int, value):
+    self.values[row] = None if value is None else self.encode(value)
+
+  def take(self, rows:np.ndarray):
+    """Return a column of the values at the given rows (missing where -1)."""
+    column = copy.copy(self)
+    values = self.values
+    column.values = [None if row < 0 else values[row] for row in rows.tolist()]
+    return column
+
+
+class ListColumn(ObjectColumn):
+  """Column of lists of strings (e.g. genres), held as tuples.
+
+  Such properties take values from a rather small vocabulary, so all strings
+  are interned and identical tuples are shared between the rows.
+  """
+  def __init__(self, values:list):
+    self.shared = {}
+    super(ListColumn, self).__init__(values)
+
+  def encodeAll(self, values:list):
+    encode = self.encode
+    return [None if value is None else encode(value) for value in values]
+
+  def encode(self, value:list):
+    # only the strings of a list not seen before need interning
+    value = tuple(value)
+    shared = self.shared.get(value, None)
+    if shared is None:
+      shared = tuple(map(sys.intern, value))
+      self.shared[shared] = shared
+    return shared
+
+
+class ColumnStore(object):
+  """Column-oriented storage of all Items of a single type.
+
+  Instead of each Item holding a dict of its properties, the store holds one
+  column per Blueprint of the Item class, each column holding values of that
+  property for all items (numbers and dates in numpy arrays, see Blueprint.kind
+  for details). A single row of the store corresponds to a single Item, which
+  can be accessed by a lightweight ItemView.
+
+  The store is built from records, i.e. dicts in the format of Item.asDict,
+  which allows constructing it directly from the deserialized JSON data.
+  Number of rows is fixed for the lifetime of the store, but the values can be
+  modified (see ItemView.update and addRating). A store with the rows moved,
+  added or removed is made by take.
+
+  Values formatted for display (see Blueprint.display_rule) are cached, also
+  column-wise, as they are requested. Setting a value invalidates its entry.
+  """
+  def __init__(self, itemtype:str, records:list=[]):
+    self.itemtype = itemtype
+    self.itemclass = containers.classByString[itemtype]
+    self.length = len(records)
+    values = self.collectColumns(records)
+    self.columns = {
+      name: self.makeColumn(blueprint.getKind(), values[name])
+      for name, blueprint in self.itemclass.blueprints.items()
+    }
+    self.display = {} # name -> list of formatted values (None if not yet known)
+
+  @classmethod
+  def fromColumns(cls, itemtype:str, length:int, columns:dict):
+    """Construct a store of the given columns (missing ones will be empty)."""
+    store = cls(itemtype)
+    store.length = length
+    for name, blueprint in store.itemclass.blueprints.items():
+      column = columns.get(name, None)
+      if column is None:
+        column = cls.makeColumn(blueprint.getKind(), [None] * length)
+      store.columns[name] = column
+    return store
+
+  @staticmethod
+  def makeColumn(kind:str, values:list):
+    if kind == 'str':
+      return ObjectColumn(values)
+    if kind == 'list':
+      return ListColumn(values)
+    if kind == 'date':
+      return DateColumn(values)
+    return NumericColumn(kind, values)
+
+  def collectColumns(self, records:list):
+    """Return values of each property in all records, as lists by name.
+
+    Same as iterRecord over all records, but done column by column, each in a
+    single pass over the records.
+    """
+    values = {name: [None] * self.length for name in self.itemclass.blueprints}
+    for name in self.itemclass.storables:
+      values[name] = [record.get(name, None) for record in records]
+    ratings = [record.get('userdata', {}).get('rating', None) for record in records]
+    if any(rating is not None for rating in ratings):
+      for name in ['rating', 'comment', 'faved']:
+        values[name] = [None if rating is None else rating[name] for rating in ratings]
+      values['dateOf'] = [
+        None if rating is None else date(
+          year=rating['dateOf']['y'], month=rating['dateOf']['m'], day=rating['dateOf']['d']
+        ) for rating in ratings
+      ]
+    return values
+
+  def iterRecord(self, record:dict):
+    """Yield (name, value) of all known properties stored in a record."""
+    for name in self.itemclass.storables:
+      if name in record.keys():
+        yield name, record[name]
+    rating = record.get('userdata', {}).get('rating', None)
+    if rating is not None:
+      yield 'rating', rating['rating']
+      yield 'comment', rating['comment']
+      yield 'faved', rating['faved']
+      dateOf = rating['dateOf']
+      yield 'dateOf', date(year=dateOf['y'], month=dateOf['m'], day=dateOf['d'])
+
+  def __len__(self):
+    return self.length
+
+  def getColumn(self, name:str):
+    return self.columns[name]
+
+  def get(self, row:int, name:str):
+    """Return a raw value of a property of an Item, or None if it's missing."""
+    column = self.columns.get(name, None)
+    return column.get(row) if column is not None else None
+
+  def set(self, row:int, name:str, value):
+    self.columns[name].set(row, value)
+    if name in self.display.keys():
+      self.display[name][row] = None
+
+  def getDisplay(self, row:int, name:str):
+    """Return a value of a property formatted for display, or '' if it's missing."""
+    if name not in self.columns.keys():
+      return ''
+    cache = self.display.get(name, None)
+    if cache is None:
+      cache = self.display[name] = [None] * self.length
+    string = cache[row]
+    if string is None:
+      value = self.get(row, name)
+      if value is None:
+        string = ''
+      else:
+        string = self.itemclass.blueprints[name].getDisplay()(value)
+      cache[row] = string
+    return string
+
+  def getRecord(self, row:int):
+    """Reconstruct a record (as Item.asDict would) of an Item."""
+    record = {}
+    for name in self.itemclass.storables:
+      value = self.get(row, name)
+      if value is not None:
+        record[name] = list(value) if isinstance(value, tuple) else value
+    record['userdata'] = {}
+    if self.get(row, 'rating') is not None:
+      dateOf = self.get(row, 'dateOf')
+      record['userdata']['rating'] = {
+        'rating':  self.get(row, 'rating'),
+        'comment': self.get(row, 'comment'),
+        'dateOf':  {'y': dateOf.year, 'm': dateOf.month, 'd': dateOf.day},
+        'faved':   self.get(row, 'faved')
+      }
+    return record
+
+  def setRecord(self, row:int, record:dict):
+    """Overwrite the properties of an Item with those found in a record."""
+    for name, value in self.iterRecord(record):
+      self.set(row, name, value)
+
+  def take(self, rows:list):
+    """Return a new store of the given rows of this one, in the given order.
+
+    Rows given as -1 are empty (all values missing), to be filled by setRecord.
+    Values of the other rows are copied, along with their display values.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    store = ColumnStore(self.itemtype)
+    store.length = len(rows)
+    store.columns = {name: column.take(rows) for name, column in self.columns.items()}
+    store.display = {
+      name: [None if row < 0 else cache[row] for row in rows.tolist()]
+      for name, cache in self.display.items()
+    }
+    return store
+
+  def view(self, row:int):
+    return ItemView(self, row)
+
+  def views(self):
+    return [ItemView(self, row) for row in range(self.length)]
+
+
+class ItemView(object):
+  """Lightweight Item-like view into a single row of a ColumnStore.
+
+  Implements the parts of the Item interface used throughout the program, so it
+  can be used in place of an Item, while storing nothing but a reference to the
+  store and a row number.
+  """
+  __slots__ = ('store', 'row')
+
+  def __init__(self, store:ColumnStore, row:int):
+    self.store = store
+    self.row = row
+
+  @property
+  def TYPE_STRING(self):
+    return self.store.itemclass.TYPE_STRING
+
+  @property
+  def blueprints(self):
+    return self.store.itemclass.blueprints
+
+  def __getitem__(self, prop):
+    """Return a properly formatted value of a requested property."""
+    return self.store.getDisplay(self.row, prop)
+
+  def getRawProperty(self, prop):
+    """Return raw data of a requested property."""
+    value = self.store.get(self.row, prop)
+    return '' if value is None else value
+
+  def addRating(self, rating:dict):
+    self.store.setRecord(self.row, {'userdata': {'rating': rating}})
+
+  def asDict(self):
+    return self.store.getRecord(self.row)
+
+  def update(self, other):
+    """Update own properties from another Item (or ItemView), see Item.update."""
+    self.store.setRecord(self.row, other.asDict())
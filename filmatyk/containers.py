@@ -27,7 +27,11 @@ class Blueprint(object):
   * display_rule: callable or None, (optional) function to convert raw property
     into a string representation,
   * store: bool, should that property be included when serializing a containing
-    instance.
+    instance,
+  * kind: str, type of the raw property, determining how is it held in a column
+    of a ColumnStore (see columnstore.py) - either a numpy dtype name (e.g.
+    "int32") or one of: "date", "str", "list". If not given, it is inferred
+    from the parsing rule.
 
   Static methods define some basic, commonly used presentation functions for
   known types of properties.
@@ -64,12 +68,25 @@ class Blueprint(object):
 
   # Functionality
 
-  def __init__(self, name:str, colwidth:int, parsing:dict={}, display=None, store=True):
+  def __init__(self, name:str, colwidth:int, parsing:dict={}, display=None, store=True, kind=None):
     self.display_name = name
     self.column_width = colwidth
     self.parsing_rule = parsing if parsing else None
     self.display_rule = display if display else self._default
     self.store = store
+    self.kind = kind if kind else self.inferKind(parsing)
+
+  @staticmethod
+  def inferKind(parsing:dict):
+    """Guess the kind of a property from its parsing rule."""
+    if parsing.get('list', False):
+      return 'list'
+    ptype = parsing.get('type', None)
+    if ptype is int:
+      return 'int32'
+    if ptype is float:
+      return 'float64'
+    return 'str'
 
   def getParsing(self):
     return self.parsing_rule
@@ -83,6 +100,9 @@ class Blueprint(object):
   def getColWidth(self):
     return self.column_width
 
+  def getKind(self):
+    return self.kind
+
 
 class UserData(object):
   """Encapsulates user information associated with each Item instance.
@@ -218,7 +238,8 @@ class Item(metaclass=BlueprintInheritance):
   # Special ID field
   id = Blueprint(
     name='ID',
-    colwidth=0
+    colwidth=0,
+    kind='int64'
   )
   # General parsed fields
   title = Blueprint(
@@ -268,18 +289,21 @@ class Item(metaclass=BlueprintInheritance):
     name='Moja ocena',
     colwidth=150,
     display=Blueprint._rating,
-    store=False
+    store=False,
+    kind='int8'
   )
   faved = Blueprint(
     name='Ulubione',
     colwidth=50,
     display=Blueprint._favourite,
-    store=False
+    store=False,
+    kind='int8'
   )
   dateOf = Blueprint(
     name='Data obejrzenia',
     colwidth=100,
-    store=False
+    store=False,
+    kind='date'
   )
   comment = Blueprint(
     name='Komentarz',
@@ -289,6 +313,7 @@ class Item(metaclass=BlueprintInheritance):
 
   def __init__(self, userdata:dict={}, **properties):
     self.properties = {}
+    self.display_cache = {}
     for prop, val in properties.items():
       # ignore any values that are not defined by the blueprints
       if prop in self.blueprints.keys():
@@ -296,14 +321,44 @@ class Item(metaclass=BlueprintInheritance):
     #construct the UserData object for rating/wantto information
     self.userdata = UserData(userdata, self)
 
+  @classmethod
+  def fromRecords(cls, records:list):
+    """Construct Items from many records (see asDict) at once.
+
+    Same as calling the constructor with each record, only faster: the keys of
+    the records are checked against the blueprints once per distinct set of
+    keys (usually there are just a few), instead of one by one in each record.
+    """
+    known = {} # keys of a record -> those of them defined by the blueprints
+    items = []
+    for record in records:
+      keys = tuple(record.keys())
+      names = known.get(keys, None)
+      if names is None:
+        names = known[keys] = [key for key in keys if key in cls.blueprints.keys()]
+      item = cls.__new__(cls)
+      item.properties = {name: record[name] for name in names}
+      item.display_cache = {}
+      item.userdata = UserData(record.get('userdata', {}), item)
+      items.append(item)
+    return items
+
   def __getitem__(self, prop):
-    """Return a properly formatted value of a requested property."""
+    """Return a properly formatted value of a requested property.
+
+    Formatted values are cached until the Item is modified (see addRating and
+    update), since the display rules are called on every display of the Item.
+    """
+    if prop in self.display_cache.keys():
+      return self.display_cache[prop]
     if prop in self.properties.keys():
       val = self.properties[prop]
       dsp = self.blueprints[prop].getDisplay()
-      return dsp(val)
+      string = dsp(val)
     else:
-      return ''
+      string = ''
+    self.display_cache[prop] = string
+    return string
 
   def getRawProperty(self, prop):
     """Return raw data of a requested property."""
@@ -314,9 +369,11 @@ class Item(metaclass=BlueprintInheritance):
 
   def addRating(self, rating):
     self.userdata.addRating(rating)
+    self.display_cache.clear()
 
   def addWantTo(self, wantto):
     self.userdata.addWantTo(wantto)
+    self.display_cache.clear()
 
   def asDict(self):
     """Store all properties as dict, the exact reverse of __init__."""
@@ -341,6 +398,7 @@ class Item(metaclass=BlueprintInheritance):
       if prop in other.properties.keys():
         self.properties[prop] = other.properties[prop]
     self.userdata.addRating(other.userdata.rating)
+    self.display_cache.clear()
 
 
 class Movie(Item):
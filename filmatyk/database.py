@@ -1,47 +1,215 @@
-import json
+from bisect import bisect_left, bisect_right
 import os
 from math import ceil
 
+from columnstore import ColumnStore, ItemView
 import containers
+import fastjson
+import snapshot
 from filmweb import ConnectionError, FilmwebAPI
 
 
 class Database(object):
-  def __init__(self, itemtype:str, api:FilmwebAPI, callback:callable):
+  """Holds all Items of a single type, in the order given by Filmweb.
+
+  Items are indexed by their IDs (see reindex), and can additionally be looked
+  up by ranges of values of some of their properties (see getItemsInRange).
+  All Items are also held in a ColumnStore (row numbers being their positions),
+  which allows processing them in bulk. In the compact mode, the Items are just
+  views into that store, which makes for a much lower memory footprint.
+  The indexes and the store are kept up to date as long as the list of items is
+  only changed via setItems (or the update methods). If the list is modified
+  directly, they have to be brought up to date by calling reindex.
+  """
+  # Properties for which range queries are expected (see SortedIndex)
+  indexed_properties = ['year', 'rating', 'dateOf']
+
+  def __init__(self, itemtype:str, api:FilmwebAPI, callback:callable, compact:bool=False):
     self.itemtype = itemtype
     self.callback = callback
+    self.compact = compact
     self.items = []
-    self.ids = set() # TODO: optimize using cached IDs
+    self.store = ColumnStore(itemtype)
+    self.stored = [] # Items whose values the rows of the store hold (see reindex)
+    self.index = {} # ID -> position in self.items
+    self.sorted_indexes = {} # property -> SortedIndex, built on demand
     self.api = api
     self.isDirty = False # are there any changes that need to be saved?
+    self.changes = [] # what has changed since the last save (see popChanges)
+    # progress of the update in terms of pages (see softUpdate, fetchPages)
+    self.progress_total = 1
+    self.progress_done = 0
 
   # INTERFACE
   def getItems(self):
     return self.items.copy()
 
+  def getStore(self):
+    return self.store
+
   def getItemByID(self, id:int):
-    for item in self.items:
-      if item.getRawProperty('id') == id:
-        return item
-    return None
+    position = self.index.get(id, None)
+    if not self.__isIndexed(id, position):
+      # The list must have been modified directly - the index is stale
+      self.reindex()
+      position = self.index.get(id, None)
+    return self.items[position] if position is not None else None
+
+  def getItemsInRange(self, prop:str, lo=None, hi=None):
+    """Return Items whose value of prop is within [lo, hi], sorted by it.
+
+    Either bound can be omitted. Items lacking the property are never returned.
+    """
+    if prop not in self.sorted_indexes:
+      self.sorted_indexes[prop] = SortedIndex(prop, self.items)
+    return [self.items[pos] for pos in self.sorted_indexes[prop].range(lo, hi)]
+
+  def setItems(self, items:list, changed:list=[]):
+    """Replace the list of Items, updating the store and the indexes.
+
+    Items modified in place since they were set (e.g. by Item.update) should be
+    given by their new positions, for their values to be stored again.
+    """
+    self.items = items
+    self.reindex(changed)
+
+  def loadRecords(self, records:list):
+    """Replace all Items with ones constructed from records (see Item.asDict)."""
+    self.store = ColumnStore(self.itemtype, records)
+    if self.compact:
+      self.items = self.store.views()
+    else:
+      self.items = containers.classByString[self.itemtype].fromRecords(records)
+    self.__reindexIDs()
+
+  def reindex(self, changed:list=[]):
+    """Bring the store and the indexes up to date with the current list of Items.
+
+    Rows of the Items that the store already holds are only moved to their new
+    positions. Only the new Items, and those at the given (new) positions, are
+    written to the store. In the compact mode, the new Items are replaced by
+    views into the store, and the views already in the list are pointed at
+    their new rows - so they remain valid wherever else they are held.
+    """
+    if self.compact:
+      views = [isinstance(item, ItemView) and item.store is self.store for item in self.items]
+      rows = [item.row if view else -1 for item, view in zip(self.items, views)]
+    else:
+      stored = {id(item): row for row, item in enumerate(self.stored)}
+      rows = [stored.get(id(item), -1) for item in self.items]
+    for position in changed:
+      rows[position] = -1
+    records = {position: self.items[position].asDict() for position, row in enumerate(rows) if row < 0}
+    if records or rows != list(range(len(self.store))):
+      store = self.store.take(rows)
+      for position, record in records.items():
+        store.setRecord(position, record)
+      if self.compact:
+        for position, view in enumerate(views):
+          if view:
+            self.items[position].store = store
+            self.items[position].row = position
+          else:
+            self.items[position] = store.view(position)
+      self.store = store
+    self.__reindexIDs()
+
+  def __reindexIDs(self):
+    """Rebuild the ID index, dropping the secondary ones (to be rebuilt later)."""
+    ids = self.store.getColumn('id').values.tolist()
+    self.index = dict(zip(ids, range(len(ids))))
+    self.sorted_indexes = {}
+    if not self.compact:
+      self.stored = self.items.copy()
+
+  def __isIndexed(self, id:int, position:int):
+    """Check whether the index is consistent with the list for the given ID.
+
+    An ID that is not indexed is only checked against the length of the list
+    and the IDs at both of its ends. This catches the list being replaced,
+    reordered, or grown or shrunk at either end. A single item replaced in the
+    middle of the list goes unnoticed, so replace the items with setItems.
+    """
+    if position is None:
+      if len(self.index) != len(self.items):
+        return False
+      ends = {0: self.items[0], len(self.items) - 1: self.items[-1]} if self.items else {}
+      return all(self.index.get(item.getRawProperty('id'), None) == end for end, item in ends.items())
+    if position >= len(self.items):
+      return False
+    return self.items[position].getRawProperty('id') == id
 
   def __iter__(self):
     return self.items.__iter__()
 
   # Serialization-deserialization
   @staticmethod
-  def restoreFromString(itemtype:str, string:str, api:FilmwebAPI, callback:callable):
-    newDatabase = Database(itemtype, api, callback)
-    if not string:
-      # simply return a raw, empty DB
-      return newDatabase
-    listOfDicts = json.loads(string)
-    itemclass = containers.classByString[itemtype]
-    newDatabase.items = [itemclass(**dct) for dct in listOfDicts]
+  def restoreFromString(itemtype:str, string:str, api:FilmwebAPI, callback:callable, compact:bool=False):
+    newDatabase = Database(itemtype, api, callback, compact)
+    newDatabase.loadString(string)
     return newDatabase
 
+  def loadString(self, string:str):
+    """Replace all Items with ones deserialized from a string (see storeToString)."""
+    if not string:
+      # leave the DB as it is (empty, if it was just constructed)
+      return
+    listOfDicts = fastjson.loads(string)
+    self.loadRecords(listOfDicts)
+
   def storeToString(self):
-    return json.dumps([item.asDict() for item in self.items])
+    return fastjson.dumps([item.asDict() for item in self.items])
+
+  def loadSnapshot(self, path:str):
+    """Replace all Items with ones from a snapshot file (see snapshot.py).
+
+    In the compact mode, the values are only read from the file when needed.
+    Raises ValueError if the file is not a valid snapshot of this item type.
+    """
+    self.store = snapshot.load(path, self.itemtype)
+    if self.compact:
+      self.items = self.store.views()
+    else:
+      records = [self.store.getRecord(row) for row in range(len(self.store))]
+      self.items = containers.classByString[self.itemtype].fromRecords(records)
+    self.__reindexIDs()
+
+  def storeToSnapshot(self, path:str):
+    snapshot.write(path, self.store)
+
+  def popChanges(self):
+    """Return the changes made since the last call, and forget them.
+
+    Each change is what a single softUpdate did to the Database: the IDs of the
+    items that it put at the head of the list (in order), records of those that
+    were added or changed, and the IDs of the removed items. All the other items
+    remain in their order after the head.
+    Returns None if the items have all been reloaded (see hardUpdate) - such a
+    change is better saved as a whole new Database.
+    """
+    changes = self.changes
+    self.changes = []
+    return changes
+
+  def applyChanges(self, changes:list):
+    """Replay the given changes (see popChanges) on the current Items.
+
+    Replaying a change more than once has the same effect as doing it once.
+    """
+    if not changes:
+      return
+    items = {item.getRawProperty('id'): item for item in self.items}
+    records = {} # of the added or changed items, by ID
+    order = list(items.keys())
+    for change in changes:
+      records.update((record['id'], record) for record in change['records'])
+      head = [id for id in change['head'] if id in records.keys() or id in items.keys()]
+      dropped = set(change['head']).union(change['removed'])
+      order = head + [id for id in order if id not in dropped]
+    # only the added and changed items are constructed (and stored) anew
+    new_items = containers.classByString[self.itemtype].fromRecords(list(records.values()))
+    items.update(zip(records.keys(), new_items))
+    self.setItems([items[id] for id in order])
 
   # Data acquisition
   def softUpdate(self):
@@ -75,6 +243,10 @@ class Database(object):
       condition (that the local and remote databases should count the same).
     At some point either the counts will even out, or all of the remote items
     will be loaded. In either case the update completes.
+    Pages are not necessarily fetched one by one. The count difference tells
+    how many remote items will have to be seen at the very least, so all pages
+    holding them are downloaded concurrently, in a single batch (see fetchPages).
+    In particular, when the database is loaded from scratch, all pages are.
 
     The problem this algorithm solves has one special form that is impossible
     to overcome: when a symmetric change has occurred past a certain page. In
@@ -109,10 +281,16 @@ class Database(object):
     if not remote_count or not items_per_page or not still_need:
       self.callback(-1)
       return False
-    # Convert the existing database to a hashed format
+    # Convert the existing database to a hashed format. The index will be used
+    # to locate the split points, so make sure it reflects the current list.
+    self.reindex()
     local_hashed = list(HashedItem(item) for item in self.items)
     local_hashed_dict = {item.id: item for item in local_hashed}
     # Prepare to and run the main loop
+    self.progress_total = max(1, ceil(abs(still_need) / items_per_page))
+    self.progress_done = 0
+    total_pages = ceil(remote_count / items_per_page)
+    fetched_pages = {}
     remote_page_no = 0
     remote_items = []
     local_changed = []
@@ -120,9 +298,20 @@ class Database(object):
     while still_need:
       # Fetch a page and represent it in the hashed form
       remote_page_no += 1
+      if remote_page_no not in fetched_pages:
+        # At least as many remote items as the count difference will have to be
+        # processed before the update completes - this many pages can be safely
+        # fetched at once.
+        surely_needed = remote_count - local_count - len(remote_items)
+        batch_size = ceil(surely_needed / items_per_page)
+        batch_size = max(1, min(batch_size, total_pages - remote_page_no + 1))
+        new_pages = self.fetchPages(range(remote_page_no, remote_page_no + batch_size))
+        if new_pages is None:
+          self.callback(-1, abort=True)
+          return False
+        fetched_pages.update(new_pages)
       fetched_items = list(
-        HashedItem(item) for item in
-        self.api.getItemsPage(self.itemtype, page=remote_page_no)
+        HashedItem(item) for item in fetched_pages.pop(remote_page_no)
       )
       # Detect additions and changes among the new items
       for item in fetched_items:
@@ -151,7 +340,7 @@ class Database(object):
       if remote_items[-1].changed:
         continue
       # Otherwise, locate the item in the local Database and split it.
-      last_unchanged_pos = local_hashed.index(remote_items[-1].id) + 1
+      last_unchanged_pos = self.index[remote_items[-1].id] + 1
       local_changed = local_hashed[:last_unchanged_pos]
       local_unchanged = local_hashed[last_unchanged_pos:]
       # Check if the databases would balance out if they were merged right now.
@@ -171,12 +360,46 @@ class Database(object):
         new_items.append(item.parent)
     # Then add the rest of unchanged items.
     new_items.extend(item.parent for item in local_unchanged)
-    self.items = new_items
+    # Items that had local counterparts have been updated in place
+    updated = [position for position, item in enumerate(remote_items) if item.local_item]
+    self.setItems(new_items, updated)
+    # Remember what has changed, so that only that has to be saved.
+    if self.changes is not None:
+      head = [item.id for item in remote_items]
+      head_ids = set(head)
+      self.changes.append({
+        'head': head,
+        'records': [
+          new_item.asDict() for new_item, item in zip(new_items, remote_items) if item.changed
+        ],
+        'removed': [item.id for item in local_changed if item.id not in head_ids],
+      })
     # Finalize - notify the GUI and potential caller.
     self.callback(-1)
     self.isDirty = True
     return True
 
+  def fetchPages(self, pages:list):
+    """Fetch items from the given pages, reporting the progress of the update.
+
+    Pages are downloaded concurrently by the API, so the progress is reported
+    in the order in which they actually complete.
+    Returns a dict mapping page numbers to lists of Items, or None if any page
+    could not be acquired (network problems or the user failed to log in).
+    """
+    fetched_pages = {}
+    try:
+      for page, items in self.api.getItemsPages(self.itemtype, pages):
+        if items is None:
+          return None
+        fetched_pages[page] = items
+        self.progress_done += 1
+        total = max(self.progress_total, self.progress_done)
+        self.callback(100 * self.progress_done // total)
+    except ConnectionError:
+      return None
+    return fetched_pages
+
   def hardUpdate(self):
     """Drop all the Items and reload all the data.
 
@@ -184,9 +407,35 @@ class Database(object):
     lost as everything is backed up first.
     """
     old_items = self.items
-    self.items = []
-    if not self.softUpdate():
-      self.items = old_items
+    old_changes = self.changes
+    self.setItems([])
+    if self.softUpdate():
+      self.changes = None
+    else:
+      self.setItems(old_items)
+      self.changes = old_changes
+
+
+class SortedIndex():
+  """Positions of Items sorted by a single property, for range queries.
+
+  Items lacking the property are not indexed at all. Keys are held in a list of
+  their own, so that it can be bisected directly.
+  """
+  def __init__(self, prop:str, items:list):
+    pairs = sorted(
+      (key, pos) for key, pos in
+      ((item.getRawProperty(prop), pos) for pos, item in enumerate(items))
+      if key != ''
+    )
+    self.keys = [key for key, _ in pairs]
+    self.positions = [pos for _, pos in pairs]
+
+  def range(self, lo=None, hi=None):
+    """Return positions of all Items with lo <= key <= hi, in the key order."""
+    start = bisect_left(self.keys, lo) if lo is not None else 0
+    stop = bisect_right(self.keys, hi) if hi is not None else len(self.keys)
+    return self.positions[start:stop]
 
 
 class HashedItem():
@@ -1,8 +1,11 @@
+from collections import OrderedDict
+
 from PIL import Image, ImageTk
 import tkinter as tk
 from tkinter import ttk
 
 import containers
+from options import Options
 import posterman
 
 class Fonts(object):
@@ -151,6 +154,8 @@ class DetailWindow(object):
   # but to display detail information, it grids a specialized DetailView
   # Make sure there only exists a single window in the whole application.
   WINDOW = None
+  POLL = 50 # ms between checks whether a requested poster has arrived
+  IMAGES = 50 # number of recently shown posters kept decoded in memory
   @classmethod
   def getDetailWindow(cls):
     if cls.WINDOW is None:
@@ -161,7 +166,9 @@ class DetailWindow(object):
     self.root = tk.Toplevel()
     self.detailViews = {} # for displaying the right DetailView
     self.activeView = None
-    self.posterManager = posterman.PosterManager()
+    self.posterManager = posterman.PosterManager(Options.get('posterCacheSize') * 2**20)
+    self.posterRequest = None # Future of the poster that is to be shown
+    self.images = OrderedDict() # PhotoImages of the posters, by path, least recently used first
     self.__construct()
     self.root.protocol('WM_DELETE_WINDOW', self.root.withdraw)
     self.root.resizable(0,0)
@@ -205,12 +212,16 @@ class DetailWindow(object):
     self.titleLabel['text']  = item['title']
     self.otitleLabel['text'] = item['otitle']
     self.itypeLabel['text']  = item.TYPE_STRING
-    # get the poster
+    # get the poster - if it's not cached, don't wait for it to download
     posterURL = item.getRawProperty('imglink')
-    posterPath = self.posterManager.getPosterByURL(posterURL)
-    image = Image.open(posterPath)
-    self.image = ImageTk.PhotoImage(image)
-    self.poster.configure(image=self.image)
+    posterPath = self.posterManager.getCachedPath(posterURL)
+    if posterPath:
+      self.posterRequest = None
+      self.showPoster(posterPath)
+    else:
+      self.showPoster(self.posterManager.getCachedPath(''))
+      self.posterRequest = self.posterManager.requestPoster(posterURL)
+      self.root.after(self.POLL, self.__checkPoster, self.posterRequest)
     # fill in details using a dedicated objects
     # select the right View for the item type
     if item.TYPE_STRING != self.activeView:
@@ -226,3 +237,39 @@ class DetailWindow(object):
     self.root.title('{} ({})'.format(item['title'], item['year']))
     self.root.deiconify()
     self.root.lift()
+  def __checkPoster(self, request):
+    # another item might have been previewed in the meantime
+    if request is not self.posterRequest:
+      return
+    if request.done():
+      self.posterRequest = None
+      # a download that was cancelled or has failed leaves the blank poster
+      if request.cancelled() or request.exception() is not None:
+        self.showPoster(self.posterManager.getCachedPath(''))
+      else:
+        self.showPoster(request.result())
+    else:
+      self.root.after(self.POLL, self.__checkPoster, request)
+  def showPoster(self, path:str):
+    # until the actual poster is there, a blank one is shown (or just a text)
+    image = self.loadImage(path) if path else None
+    if image is None:
+      self.poster.configure(image='', text='POSTER')
+    else:
+      self.poster.configure(image=image)
+  def loadImage(self, path:str):
+    # decoding is only needed for posters that have not been shown recently
+    if path in self.images.keys():
+      self.images.move_to_end(path)
+      return self.images[path]
+    try:
+      image = ImageTk.PhotoImage(Image.open(path))
+    except OSError:
+      return None
+    self.images[path] = image
+    if len(self.images) > self.IMAGES:
+      self.images.popitem(last=False)
+    return image
+  def close(self):
+    # stop downloading posters, so that the app can exit right away
+    self.posterManager.close()
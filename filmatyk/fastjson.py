@@ -0,0 +1,50 @@
+"""JSON encoding and decoding by the fastest library available.
+
+Databases are stored as JSON strings (see Database.storeToString), and decoding
+them takes a large part of the startup time. Libraries like orjson or ujson do
+it several times faster than the standard json module, so they are used if
+installed - but neither is required. They all read and write the same data,
+although the strings are not always identical (e.g. in whitespace).
+"""
+
+import json
+
+# Backends in order of preference
+BACKENDS = ['orjson', 'ujson', 'json']
+
+
+def makeBackend(name:str):
+  """Return the (loads, dumps) pair of a backend, or raise an ImportError."""
+  if name == 'orjson':
+    import orjson
+    return orjson.loads, lambda data: orjson.dumps(data).decode('utf-8')
+  if name == 'ujson':
+    import ujson
+    return ujson.loads, lambda data: ujson.dumps(data, ensure_ascii=False)
+  if name == 'json':
+    return json.loads, json.dumps
+  raise ImportError('Unknown JSON backend: {}'.format(name))
+
+
+def available():
+  """Return names of all the installed backends."""
+  names = []
+  for name in BACKENDS:
+    try:
+      makeBackend(name)
+    except ImportError:
+      continue
+    names.append(name)
+  return names
+
+
+def use(name:str=None):
+  """Switch to the given backend, or the fastest installed one; return its name."""
+  global backend, loads, dumps
+  name = name or available()[0]
+  loads, dumps = makeBackend(name)
+  backend = name
+  return backend
+
+
+use()
@@ -1,10 +1,17 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import date
 import binascii
+import functools
 import html
 import json
 import pickle
+import queue
+import threading
 
 from bs4 import BeautifulSoup as BS
+import lxml.html
+from lxml import etree
 import requests_html
 
 import containers
@@ -50,8 +57,37 @@ class Constants():
     return self.userpage + '/games?page={}'.format(page)
 
 
+class PageDiagnostics():
+  """Problems encountered when joining items of a page with their ratings.
+
+  Each page lists items and, separately, the user's ratings of those items.
+  Normally every rating belongs to exactly one item on the same page, but the
+  parser does not assume that. Anything that failed to join is recorded here:
+  * orphan_ratings: list of (item ID, rating dict) for ratings with no item,
+  * unrated_items: list of IDs of items for which no rating was found.
+  Evaluates to False if no problems were found.
+  """
+  def __init__(self, itemtype:str='', page:int=0):
+    self.itemtype = itemtype
+    self.page = page
+    self.orphan_ratings = []
+    self.unrated_items = []
+
+  def __bool__(self):
+    return bool(self.orphan_ratings or self.unrated_items)
+
+  def __str__(self):
+    return '{} page {}: {} orphan rating(s) {}, {} unrated item(s) {}'.format(
+      self.itemtype, self.page,
+      len(self.orphan_ratings), [iid for iid, _ in self.orphan_ratings],
+      len(self.unrated_items), self.unrated_items
+    )
+
+
 class FilmwebAPI():
   """HTML-based API for acquiring data from Filmweb."""
+  max_diagnostics = 100 # only the most recent join problems are remembered
+
   @staticmethod
   def login(username, password):
     """Attempt to acquire an authenticated user session."""
@@ -85,6 +121,9 @@ class FilmwebAPI():
       in a request for login and re-calling of the function.
     Additionally, session cookies are watched for changes, in order to set the
     isDirty flag in case that happens.
+    Requesting a login involves the GUI, so it can only be done from the main
+    thread. Calls made from worker threads (see getItemsPages) do not attempt
+    it and raise UnauthenticatedError instead, leaving it to the main thread.
 
     Because it assumes that the first argument of the wrapped function is
     a bound FilmwebAPI instance ("self"), it shall only be used with FilmwebAPI
@@ -99,6 +138,9 @@ class FilmwebAPI():
     def wrapper(*args, **kwargs):
       # Extract the bound FilmwebAPI instance
       self = args[0]
+      in_worker = threading.current_thread() is not threading.main_thread()
+      if in_worker and not self.session:
+        raise UnauthenticatedError
       # First check: for presence of a live session
       if not self.checkSession():
         return None
@@ -107,6 +149,8 @@ class FilmwebAPI():
       try:
         result = fun(*args, **kwargs)
       except UnauthenticatedError:
+        if in_worker:
+          raise
         # Request login and call again
         print('Session was stale! Requesting login...')
         self.requestSession()
@@ -121,15 +165,39 @@ class FilmwebAPI():
       return result
     return wrapper
 
-  def __init__(self, login_handler, username:str=''):
+  # Spawning parser processes only pays off for batches of at least this size
+  min_parsed_pages = 8
+
+  def __init__(
+    self,
+    login_handler,
+    username:str='',
+    fetch_workers:int=4,
+    parse_workers:int=0,
+    parser:str='soup'
+  ):
     self.username = username
     self.constants = Constants(username)
     self.login_handler = login_handler
     self.session = None
     self.isDirty = False
+    # Max number of pages downloaded at the same time by getItemsPages
+    self.fetch_workers = fetch_workers
+    # Number of processes parsing them in parallel (0: parse in the main thread)
+    self.parse_workers = parse_workers
     self.parsingRules = {}
+    self.compiledRules = {}
     for container in containers.classByString.keys():
       self.__cacheParsingRules(container)
+    # Parsing backend: 'soup' (BeautifulSoup, see parsePage) or 'lxml' (faster,
+    # XPath-based, see CompiledParser)
+    self.parser = parser
+    # Join problems found on the fetched pages (see PageDiagnostics)
+    self.diagnostics = deque(maxlen=self.max_diagnostics)
+    if parser == 'lxml':
+      self.compiledParser = CompiledParser(self.constants, self.compiledRules)
+    elif parser != 'soup':
+      raise ValueError('Unknown parser: {}'.format(parser))
     # bind specific methods and constants to their item types
     self.urlGenerationMethods = {
       'Movie': self.constants.getUserMoviePage,
@@ -149,6 +217,8 @@ class FilmwebAPI():
     writable form that makes them easy to modify if need be, but not very
     convenient for the parser. This method groups rules in a parser-friendly
     representation that makes its job easier.
+    Additionally, each rule is compiled into an XPath expression that finds all
+    elements it applies to, for the use of the CompiledParser.
     """
     # Get all the blueprints of a given class
     rawRules = {}
@@ -176,6 +246,11 @@ class FilmwebAPI():
         }
     # Bind the result to a type name
     self.parsingRules[itemtype] = pTree
+    self.compiledRules[itemtype] = [
+      (CompiledParser.compileSelector(tag, pClass), rule)
+      for tag, classes in pTree.items()
+      for pClass, rule in classes.items()
+    ]
 
   def checkSession(self):
     """Check if there exists a session instance and acquire a new one if not."""
@@ -266,18 +341,90 @@ class FilmwebAPI():
     """
     getURL = self.urlGenerationMethods[itemtype]
     url = getURL(page)
-    page = self.fetchPage(url)
-    data = self.parsePage(page, itemtype)
+    diagnostics = PageDiagnostics(itemtype, page)
+    data = self.parseRaw(self.fetchRaw(url), itemtype, diagnostics)
+    self.reportDiagnostics(diagnostics)
     return data
 
+  def getItemsPages(self, itemtype:str, pages:list):
+    """Acquire items from multiple pages, yielding them as they are ready.
+
+    Works as a two-stage pipeline, so that network I/O and parsing can overlap:
+    * downloader threads (at most fetch_workers) fetch raw HTML of the pages,
+    * each downloaded page is handed over to a pool of parser processes (if
+      parse_workers is non-zero and the batch is large enough to make it worth
+      spawning them), or simply parsed by the calling thread as it comes.
+    Join problems are reported like in getItemsPage.
+    Yields (page number, list of Items) tuples in the order in which the pages
+    have been completed - NOT in the order of their numbers. This allows the
+    caller to report progress as it goes, but makes it responsible for
+    restoring the right order of the results.
+
+    Worker threads cannot request a login, so this is only meant to be called
+    when a live session is known to exist (e.g. right after getNumOf). Should
+    the session go stale anyway, affected pages are fetched again at the end,
+    from the calling thread, where a login can be requested if needed.
+    """
+    pages = list(pages)
+    if self.fetch_workers < 2 or len(pages) < 2:
+      for page in pages:
+        yield page, self.getItemsPage(itemtype, page=page)
+      return
+    getURL = self.urlGenerationMethods[itemtype]
+    use_processes = self.parse_workers > 0 and len(pages) >= self.min_parsed_pages
+    downloaders = ThreadPoolExecutor(max_workers=self.fetch_workers)
+    parsers = ProcessPoolExecutor(self.parse_workers) if use_processes else None
+    # Both stages deliver their results here, as (stage, page, future) tuples
+    results = queue.Queue()
+    def downloaded(page, future):
+      if future.cancelled():
+        return
+      if not parsers or future.exception() is not None:
+        results.put(('raw', page, future))
+        return
+      try:
+        parsing = parsers.submit(parseRawPage, future.result(), itemtype, self.parser)
+      except RuntimeError:
+        # The pipeline has been shut down in the meantime
+        return
+      parsing.add_done_callback(lambda f: results.put(('parsed', page, f)))
+    downloads = []
+    stale_pages = []
+    try:
+      for page in pages:
+        download = downloaders.submit(self.fetchRaw, getURL(page))
+        download.add_done_callback(functools.partial(downloaded, page))
+        downloads.append(download)
+      for _ in pages:
+        stage, page, future = results.get()
+        try:
+          if stage == 'raw':
+            diagnostics = PageDiagnostics(itemtype, page)
+            items = self.parseRaw(future.result(), itemtype, diagnostics)
+          else:
+            items, diagnostics = future.result()
+            diagnostics.page = page
+        except UnauthenticatedError:
+          stale_pages.append(page)
+          continue
+        self.reportDiagnostics(diagnostics)
+        yield page, items
+    finally:
+      # Don't wait for the queued downloads if we stopped early (on error)
+      for download in downloads:
+        download.cancel()
+      downloaders.shutdown()
+      if parsers:
+        parsers.shutdown()
+    for page in sorted(stale_pages):
+      yield page, self.getItemsPage(itemtype, page=page)
+
   @enforceSession
-  def fetchPage(self, url):
-    """Fetch the page and return its BeautifulSoup representation.
+  def fetchRaw(self, url):
+    """Fetch the page and return its raw HTML content.
 
     ConnectionError is raised in case of any failure to get HTML data or page
     status being not-ok after get.
-    UnauthenticatedError is raised if the response contains a span indicating
-    that the session used to obtain it is no longer valid.
     """
     try:
       page = self.session.get(url)
@@ -287,8 +434,24 @@ class FilmwebAPI():
       status = page.status_code
       print("FETCH ERROR {}".format(status))
       raise ConnectionError
-    else:
-      bspage = BS(page.html.html, 'lxml')
+    return page.html.html
+
+  @enforceSession
+  def fetchPage(self, url):
+    """Fetch the page and return its BeautifulSoup representation.
+
+    Raises ConnectionError in the same cases as fetchRaw, and additionally
+    UnauthenticatedError - see makePage.
+    """
+    return self.makePage(self.fetchRaw(url))
+
+  def makePage(self, text:str):
+    """Build a BeautifulSoup representation of a raw HTML page.
+
+    UnauthenticatedError is raised if the page contains a span indicating that
+    the session used to obtain it is no longer valid.
+    """
+    bspage = BS(text, 'lxml')
     # If a request required an active session but the one we had happened to be
     # stale, this magical span will be found in the page data:
     span = bspage.find('span', attrs={'class': self.constants.no_access_class})
@@ -296,18 +459,33 @@ class FilmwebAPI():
       raise UnauthenticatedError
     return bspage
 
-  def parsePage(self, page, itemtype:str):
-    """Parse items and ratings, returning constructed Item objects."""
+  def parseRaw(self, text:str, itemtype:str, diagnostics:PageDiagnostics=None):
+    """Parse a raw HTML page, returning constructed Item objects.
+
+    Uses the parsing backend selected at construction.
+    """
+    if self.parser == 'lxml':
+      return self.compiledParser.parseRaw(text, itemtype, diagnostics)
+    return self.parsePage(self.makePage(text), itemtype, diagnostics)
+
+  def parsePage(self, page, itemtype:str, diagnostics:PageDiagnostics=None):
+    """Parse items and ratings, returning constructed Item objects.
+
+    If a PageDiagnostics object is given, it is filled with any problems found
+    while joining the ratings with the items (see joinRatings).
+    """
     data_div = self.extractDataSource(page)
     sub_divs = self.extractItems(data_div)
     parsed_items = [self.parseOne(div, itemtype) for div in sub_divs]
-    ratings = [self.parseRating(txt) for txt in self.extractRatings(data_div)]
-    for rating, iid in ratings:
-      for item in parsed_items:
-        if item.getRawProperty('id') == iid:
-          item.addRating(rating)
+    self.joinRatings(parsed_items, self.extractRatings(data_div), diagnostics)
     return parsed_items
 
+  def reportDiagnostics(self, diagnostics:PageDiagnostics):
+    """Store the join problems found on a page (if any) and notify about them."""
+    if diagnostics:
+      self.diagnostics.append(diagnostics)
+      print("PARSING WARNING {}".format(diagnostics))
+
   def extractDataSource(self, page):
     """Extract the div that holds all the data."""
     return page.find('div', attrs={'class': self.constants.main_class})
@@ -364,14 +542,57 @@ class FilmwebAPI():
     constructObject = containers.classByString[itemtype]
     return constructObject(**parsed)
 
-  def parseRating(self, text):
+  @staticmethod
+  def parseRating(text):
     """Parse the rating information into compatible dict.
 
     FW stores the ratings as simple dict serialized to JSON, this only ensures
     all the entries are present and translates them to a standard expected by
     Item's addRating method.
     """
-    origDict = json.loads(text)
+    return FilmwebAPI.translateRating(json.loads(text))
+
+  @staticmethod
+  def parseRatings(texts:list):
+    """Parse a list of rating strings, in the same way as parseRating does.
+
+    All the strings are decoded by a single JSON call, since this is much
+    faster than decoding them one by one. Should any of them be malformed, they
+    are decoded separately, so that the error points to the faulty one.
+    """
+    try:
+      origDicts = json.loads('[' + ','.join(texts) + ']')
+    except ValueError:
+      origDicts = [json.loads(text) for text in texts]
+    return [FilmwebAPI.translateRating(origDict) for origDict in origDicts]
+
+  @staticmethod
+  def joinRatings(items:list, texts:list, diagnostics:PageDiagnostics=None):
+    """Attach the ratings (given as strings) to the matching items, in place.
+
+    Items are indexed by their IDs, so that each rating is matched in constant
+    time. Ratings which do not match any item, as well as items that have not
+    received any rating, are recorded in the diagnostics object, if given.
+    """
+    items_by_id = {}
+    for item in items:
+      items_by_id.setdefault(item.getRawProperty('id'), []).append(item)
+    rated = set()
+    for rating, iid in FilmwebAPI.parseRatings(texts):
+      matches = items_by_id.get(iid)
+      if not matches:
+        if diagnostics is not None:
+          diagnostics.orphan_ratings.append((iid, rating))
+        continue
+      for item in matches:
+        item.addRating(rating)
+      rated.add(iid)
+    if diagnostics is not None:
+      diagnostics.unrated_items.extend(iid for iid in items_by_id if iid not in rated)
+
+  @staticmethod
+  def translateRating(origDict:dict):
+    """Translate a single decoded rating dict (see parseRating)."""
     # Ensure all date keys are present
     try:
       date_ = origDict['d']
@@ -394,3 +615,102 @@ class FilmwebAPI():
       'faved':   isFaved
     }
     return ratingDict, iid
+
+
+class CompiledParser():
+  """Parsing backend working directly on lxml trees, using compiled XPaths.
+
+  The BeautifulSoup-based parser of the FilmwebAPI walks all elements of each
+  tag in the parsing tree for every item, checking each of them against every
+  class of interest. Instead, this parser evaluates a single precompiled XPath
+  expression per parsing rule (see FilmwebAPI.__cacheParsingRules), which lxml
+  executes natively. The output is the same as that of the original parser.
+  """
+  @staticmethod
+  def compileSelector(tag:str, pClass:str):
+    """Compile an XPath finding all descendant tags having the given class."""
+    return etree.XPath(
+      './/{}[contains(concat(" ", normalize-space(@class), " "), " {} ")]'.format(tag, pClass)
+    )
+
+  def __init__(self, constants:Constants, compiledRules:dict):
+    self.compiledRules = compiledRules
+    self.findNoAccess = self.compileSelector('span', constants.no_access_class)
+    self.findDataSource = self.compileSelector('div', constants.main_class)
+    self.findItems = etree.XPath(
+      './/div[@data-id][contains(concat(" ", normalize-space(@class), " "), " {} ")]'.format(constants.item_class)
+    )
+    self.findRatings = etree.XPath(
+      './/span[@data-source="{}"]//script[@type="{}"]'.format(
+        constants.rating_source, constants.rating_stype
+      )
+    )
+
+  def makePage(self, text:str):
+    """Build an lxml tree of a raw HTML page, checking for a stale session."""
+    page = lxml.html.fromstring(text)
+    if self.findNoAccess(page):
+      raise UnauthenticatedError
+    return page
+
+  def parseRaw(self, text:str, itemtype:str, diagnostics:PageDiagnostics=None):
+    """Parse a raw HTML page, returning constructed Item objects."""
+    return self.parsePage(self.makePage(text), itemtype, diagnostics)
+
+  def parsePage(self, page, itemtype:str, diagnostics:PageDiagnostics=None):
+    """Parse items and ratings, returning constructed Item objects."""
+    data_div = self.extractDataSource(page)
+    sub_divs = self.extractItems(data_div)
+    parsed_items = [self.parseOne(div, itemtype) for div in sub_divs]
+    FilmwebAPI.joinRatings(parsed_items, self.extractRatings(data_div), diagnostics)
+    return parsed_items
+
+  def extractDataSource(self, page):
+    """Extract the div that holds all the data."""
+    return self.findDataSource(page)[0]
+
+  def extractItems(self, div):
+    """From the main div, extract all divs holding item details."""
+    return self.findItems(div)
+
+  def extractRatings(self, div):
+    """From the main div, extract all item rating strings."""
+    return [script.text or '' for script in self.findRatings(div)]
+
+  def parseOne(self, div, itemtype:str):
+    """Parse a single item, constructing its container representation."""
+    parsed = {'id': int(div.attrib['data-id'])}
+    for selector, rule in self.compiledRules[itemtype]:
+      found = selector(div)
+      if not found:
+        continue
+      # Like in the original parser, the last matching element has the final say
+      element = found[-1]
+      if rule['text']:
+        if rule['list']:
+          value = [li.text_content().strip() for li in element.iterdescendants('li')]
+        else:
+          value = element.text_content().strip()
+      else:
+        value = element.attrib[rule['attr']]
+      rtype = rule['type']
+      parsed[rule['name']] = rtype(value) if rtype else value
+    constructObject = containers.classByString[itemtype]
+    return constructObject(**parsed)
+
+
+# Parsers used by the worker processes of FilmwebAPI.getItemsPages, by backend
+_page_parsers = {}
+
+def parseRawPage(text:str, itemtype:str, parser:str='soup'):
+  """Parse a raw HTML page into Items, in a parser process.
+
+  Parser processes have no access to the FilmwebAPI instance that spawned them,
+  so each of them constructs its own (session-less) one, just for parsing.
+  Returns the list of Items and the PageDiagnostics of the page.
+  """
+  if parser not in _page_parsers:
+    _page_parsers[parser] = FilmwebAPI(None, parser=parser)
+  diagnostics = PageDiagnostics(itemtype)
+  items = _page_parsers[parser].parseRaw(text, itemtype, diagnostics)
+  return items, diagnostics
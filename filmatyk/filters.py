@@ -1,14 +1,21 @@
 from calendar import monthrange
+from collections import defaultdict
 import datetime
+import numpy as np
 from PIL import Image, ImageTk
 import tkinter as tk
 from tkinter import ttk
 
+from titleindex import TitleIndex, fold
+
 class FilterMachine(object):
-  # Holds multiple filters and returns a callable that can be simply passed to a
-  # "filter" function on the set of Items that the Presenter holds. The machine
-  # remembers all filters, so when either of them triggers an update, the whole
-  # callable is updated, and Presenter's filtersUpdate() is executed.
+  # Holds multiple filters and evaluates them over the ColumnStore of the items
+  # that the Presenter holds, producing a boolean mask of the items that pass.
+  # The machine remembers all filters, so when either of them triggers an update
+  # the mask can be recomputed, and Presenter's filtersUpdate() is executed.
+  # Results of each filter are cached, so that only the filter that has changed
+  # has to be evaluated again - and if its criteria have only been narrowed,
+  # only on the rows that have passed it before.
 
   def __init__(self, callback):
     self.filterObjs = []
@@ -17,6 +24,11 @@ class FilterMachine(object):
     # filters that are currently active; only reset those too; additionally,
     # ignore repeated resets (speeds up startup SIGNIFICANTLY)
     self.filterFlags = []
+    # cached results of each filter on the current store: a mask of rows that
+    # passed it, meaningful only for the rows marked as known (see getMask)
+    self.filterMasks = []
+    self.filterKnown = []
+    self.store = None
     self.filterMap = {} # maps filter ID's to their positions on the lists
     self.callback = callback # to notify the Presenter about any changes
     self.ignoreCallback = False # see resetAllFilters for the meaning of it
@@ -25,6 +37,8 @@ class FilterMachine(object):
     self.filterObjs.append(filter_object)
     self.filterFuns.append(filter_object.getFunction())
     self.filterFlags.append(False)
+    self.filterMasks.append(None)
+    self.filterKnown.append(None)
     self.filterMap[filter_object.getID()] = len(self.filterObjs) - 1
   def resetAllFilters(self, force=False):
     # disable calling back to the Presenter until all of the work is done
@@ -36,9 +50,12 @@ class FilterMachine(object):
     # and now call back
     self.ignoreCallback = False
     self.callback()
-  def updateCallback(self, filter_id:int, new_function, reset=False):
+  def updateCallback(self, filter_id:int, new_function, reset=False, narrowing=False):
+    # "narrowing" means that the new function passes a subset of the rows that
+    # the previous one did (e.g. a longer search string was typed)
     filter_pos = self.filterMap[filter_id]
     self.filterFuns[filter_pos] = new_function
+    self.forgetMask(filter_pos, keep_failed=narrowing and not reset)
     # don't call back if the filter is dormant and has requested a reset
     if reset and not self.filterFlags[filter_pos]:
       return
@@ -46,21 +63,55 @@ class FilterMachine(object):
     self.filterFlags[filter_pos] = not reset
     if not self.ignoreCallback:
       self.callback()
-  def populateChoices(self, items:list):
+  def populateChoices(self, store):
     for filter in self.filterObjs:
-      filter.populateChoices(items)
+      filter.populateChoices(store)
     self.resetAllFilters()
-  def getFiltering(self):
-    # returns a callable that executes all of the filters
-    funs = [fun for fun, flag in zip(self.filterFuns, self.filterFlags) if flag]
-    if not funs:
-      funs = [lambda x: True]
-    return lambda item: all([fun(item) for fun in funs])
+  def forgetMask(self, filter_pos:int, keep_failed=False):
+    # invalidate the cached results of a filter; if its criteria have only been
+    # narrowed, rows that failed them will fail them again - keep those
+    known = self.filterKnown[filter_pos]
+    if known is None:
+      return
+    if keep_failed:
+      known &= ~self.filterMasks[filter_pos]
+    else:
+      known[:] = False
+  def getMask(self, store):
+    # returns a boolean mask of the rows of the store that pass all the filters;
+    # active filters are evaluated cheapest-first, each one only on the rows that
+    # have passed all the previous ones, stopping as soon as nothing is left;
+    # a filter is only evaluated on rows for which its result is not yet known
+    if store is not self.store:
+      # items have changed, nothing that was cached is valid anymore
+      self.store = store
+      self.filterMasks = [None for _ in self.filterObjs]
+      self.filterKnown = [None for _ in self.filterObjs]
+    active = sorted(
+      (filter.COST, pos) for pos, (filter, flag)
+      in enumerate(zip(self.filterObjs, self.filterFlags)) if flag
+    )
+    mask = np.ones(len(store), dtype=bool)
+    for _, pos in active:
+      if not mask.any():
+        break
+      if self.filterKnown[pos] is None:
+        self.filterMasks[pos] = np.zeros(len(store), dtype=bool)
+        self.filterKnown[pos] = np.zeros(len(store), dtype=bool)
+      passed = self.filterMasks[pos]
+      known = self.filterKnown[pos]
+      rows = np.flatnonzero(mask & ~known)
+      if rows.size:
+        passed[rows] = self.filterFuns[pos](store, rows)
+        known[rows] = True
+      mask &= passed
+    return mask
 
 class Filter(object):
-  # Filters return callables that, executed on Items, return a boolean value
-  # informing that a given Item passes or does not pass some criteria. These
-  # criteria are internal to the filter objects, and can be modified by user.
+  # Filters return callables that, executed on a ColumnStore and an array of its
+  # row numbers, return a boolean mask informing which of these rows (Items)
+  # pass or do not pass some criteria. These criteria are internal to the filter
+  # objects, and can be modified by user.
   # A filter object has to be registered with the Presenter and instantiated in
   # its GUI (the object controls its own widgets). It takes a look into the DB
   # to collect all possible values to populate its widgets (e.g. all directors).
@@ -71,6 +122,10 @@ class Filter(object):
   #   have a buildUI function to draw the interface (using self.main as root!)
   #   define self.function
   #   ensure that whenever the parameters change, notifyMachine is called
+  # and should set COST, a rough relative cost of evaluating its callable (the
+  # machine evaluates cheaper filters first). Looking up a mask computed up
+  # front (makeMaskFunction) costs 1, comparing values of a column (e.g.
+  # makeRangeFunction) costs 2.
 
   # filters have IDs so that machines can recognize them on callbacks
   NEXT_ID = 0
@@ -79,10 +134,25 @@ class Filter(object):
     id = Filter.NEXT_ID
     Filter.NEXT_ID += 1
     return id
+  COST = 2
   # by default any filter is inactive and everything shall pass it
   @staticmethod
-  def DEFAULT(x):
-    return True
+  def DEFAULT(store, rows):
+    return np.ones(len(rows), dtype=bool)
+  # callable passing the rows for which a numeric column lies within the limits
+  @staticmethod
+  def makeMaskFunction(mask):
+    # for filters that compute their mask over all rows up front (e.g. from an
+    # index), so that filtering only looks it up
+    def function(store, rows):
+      return mask[rows]
+    return function
+  @staticmethod
+  def makeRangeFunction(prop:str, low, high):
+    def rangeFilter(store, rows):
+      values = store.getColumn(prop).values[rows]
+      return (values >= low) & (values <= high)
+    return rangeFilter
 
   def __init__(self, root):
     # automatically assign the next free ID
@@ -91,26 +161,37 @@ class Filter(object):
     self.main = tk.Frame(root)
     self.buildUI()
     # callback takes 2 pos args: an ID (int) and a function (callable)
-    # and 1 keyword arg: "reset"
+    # and 2 keyword args: "reset" and "narrowing"
     self.machineCallback = lambda x: x # machine sets that during registering
     # end result of a filter: a callable
     self.function = self.DEFAULT
+    # limits of the current range, for the filters using setRange
+    self.last_range = None
   def setCallback(self, callback):
     self.machineCallback = callback
   def buildUI(self):
     # derived-class-defined code for UI construction
     pass
-  def populateChoices(self, items):
+  def populateChoices(self, store):
     # derived-class-defined code for updating internal filter data from items
     pass
-  # execute this every time the user modifies filter settings
-  def notifyMachine(self):
-    self.machineCallback(self.ID, self.function)
+  # execute this every time the user modifies filter settings; "narrowing" tells
+  # that the new settings can only reject more items, never accept new ones
+  def notifyMachine(self, narrowing=False):
+    self.machineCallback(self.ID, self.function, narrowing=narrowing)
+  # pass the rows for which a numeric property lies within the given limits
+  def setRange(self, prop:str, low, high):
+    last = self.last_range
+    narrowing = last is not None and low >= last[0] and high <= last[1]
+    self.last_range = (low, high)
+    self.function = self.makeRangeFunction(prop, low, high)
+    self.notifyMachine(narrowing=narrowing)
   # execute this when the filter was reset
   def reset(self):
     self._reset()
   def _reset(self):
     self.function = self.DEFAULT
+    self.last_range = None
     self.machineCallback(self.ID, self.function, reset=True)
   def getID(self):
     return self.ID
@@ -125,12 +206,16 @@ class Filter(object):
 
 class TitleFilter(Filter):
   icon_path = 'search.png'
+  COST = 1 # the mask is found in the index (see setSearch)
   def __init__(self, root):
     self.title_in = tk.StringVar()
-    self.function = self.filterTitle
+    self.index = TitleIndex()
+    self.ids = np.zeros(0, dtype=np.int64) # IDs of all items, by row
+    self.last_search = None
     super(TitleFilter, self).__init__(root)
   def reset(self):
     self.title_in.set('')
+    self.last_search = None
     self._reset()
   def buildUI(self):
     self.main.grid_columnconfigure(1, weight=1)
@@ -150,16 +235,21 @@ class TitleFilter(Filter):
         self.reset()
     # Wait before updating (see ListboxFilter.waitAndUpdate)
     self.main.after(50, self._update)
+  def populateChoices(self, store):
+    # only the items whose titles have changed are reindexed
+    self.index.update(store)
+    self.ids = store.getColumn('id').values
   def _update(self, event=None):
-    search_string = self.title_in.get().lower()
-    def filterTitle(item):
-      title = item.getRawProperty('title')
-      return search_string in title.lower()
-    self.function = filterTitle
-    self.notifyMachine()
-  def filterTitle(self, item):
-    title = item.getRawProperty('title')
-    return self.title_val in title.lower()
+    self.setSearch(fold(self.title_in.get()))
+  def setSearch(self, search_string:str):
+    # a title containing the new string also contains any of its fragments
+    last = self.last_search
+    narrowing = last is not None and last in search_string
+    self.last_search = search_string
+    found = self.index.search(search_string)
+    mask = np.isin(self.ids, np.fromiter(found, dtype=np.int64, count=len(found)))
+    self.function = self.makeMaskFunction(mask)
+    self.notifyMachine(narrowing=narrowing)
 
 class YearFilter(Filter):
   default_years = [1, 9999]
@@ -185,14 +275,10 @@ class YearFilter(Filter):
     yTo.grid(row=1, column=3, sticky=tk.NW)
     ttk.Button(m, text='Reset', width=5, command=self.reset).grid(row=1, column=4, sticky=tk.NE)
     m.grid_columnconfigure(4, weight=1) # for even placement of the reset button
-  def populateChoices(self, items:list):
-    all_years = set()
-    for item in items:
-      year = item.getRawProperty('year')
-      if not year:
-        continue
-      all_years.add(year)
-    self.all_years = sorted(list(all_years))
+  def populateChoices(self, store):
+    column = store.getColumn('year')
+    years = column.values[column.present()]
+    self.all_years = [year for year in np.unique(years).tolist() if year]
     if len(self.all_years) == 0:
       self.all_years = self.default_years
     self.yFrom.configure(values=self.all_years)
@@ -224,19 +310,15 @@ class YearFilter(Filter):
       else: # yearFrom was modified -- pull yearTo up with it
         yearTo = yearFrom
         self.year_to.set(str(yearTo))
-    def yearFilter(item):
-      year = item.getRawProperty('year')
-      if year >= yearFrom and year <= yearTo:
-        return True
-      else:
-        return False
-    self.function = yearFilter
-    self.notifyMachine()
+    self.setRange('year', yearFrom, yearTo)
 
 class ListboxFilter(Filter):
   PROPERTY = '' #derived classes must override this
+  COST = 1 # the mask is resolved from the index on selection
   def __init__(self, root):
     self.all_options = []
+    self.index = {}
+    self.lengths = np.zeros(0, dtype=np.int32)
     super(ListboxFilter, self).__init__(root)
   def makeListbox(self, where, selectmode, **grid_args):
     frame = tk.Frame(where)
@@ -248,25 +330,47 @@ class ListboxFilter(Filter):
     scroll.pack(side=tk.RIGHT, fill=tk.Y)
     self.box.configure(yscrollcommand=scroll.set)
     frame.grid(**grid_args)
-  def populateChoices(self, items:list):
-    all_options = set()
-    for item in items:
-      if isinstance(self.PROPERTY, list):
-        for prop in self.PROPERTY:
-          for value in item.getRawProperty(prop):
-            all_options.add(value)
-      else:
-        for value in item.getRawProperty(self.PROPERTY):
-          all_options.add(value)
-    self.all_options = sorted(list(all_options))
+  def populateChoices(self, store):
+    self.buildIndex(store)
     self.box.delete(0, tk.END)
     for option in self.all_options:
       self.box.insert(tk.END, option)
+  def buildIndex(self, store):
+    # inverted index: for each value, an array of rows that contain it
+    # (each row at most once); also counts values of each row
+    postings = defaultdict(list)
+    self.lengths = np.zeros(len(store), dtype=np.int32)
+    for row, values in enumerate(self.getValues(store, range(len(store)))):
+      self.lengths[row] = len(values)
+      for value in set(values):
+        postings[value].append(row)
+    self.index = {value: np.array(rows, dtype=np.int64) for value, rows in postings.items()}
+    self.all_options = sorted(self.index.keys())
   def waitAndUpdate(self, e=None):
     # without after(), the callback executes *before* GUI has updated selection
     self.main.after(50, self._update)
   def getSelection(self):
     return [self.all_options[i] for i in self.box.curselection()]
+  @classmethod
+  def getValues(cls, store, rows):
+    # list all values of the filtered property (or properties) for each row
+    props = cls.PROPERTY if isinstance(cls.PROPERTY, list) else [cls.PROPERTY]
+    columns = [store.getColumn(prop).values for prop in props]
+    if len(columns) == 1:
+      return [columns[0][row] or () for row in rows]
+    return [sum((column[row] or () for column in columns), ()) for row in rows]
+  def rowsWithAny(self, values):
+    # union of the index entries, as a mask over all rows of the store
+    mask = np.zeros(len(self.lengths), dtype=bool)
+    for value in values:
+      mask[self.index.get(value, [])] = True
+    return mask
+  def rowsWithAll(self, values):
+    # intersection of the index entries, as a mask over all rows of the store
+    counts = np.zeros(len(self.lengths), dtype=np.int32)
+    for value in values:
+      counts[self.index.get(value, [])] += 1
+    return counts == len(values)
   def _reset(self):
     self.box.selection_clear(0, tk.END)
     Filter._reset(self)
@@ -304,22 +408,14 @@ class GenreFilter(ListboxFilter):
     if len(self.selected) == 0:
       self.function = Filter.DEFAULT
     else:
-      self.function = self.filterMap[self.mode.get()]
+      self.function = self.makeMaskFunction(self.filterMap[self.mode.get()]())
     self.notifyMachine()
-  def filterAtLeast(self, item):
-    for genre in self.selected:
-      if genre in item.getRawProperty(self.PROPERTY):
-        return True
-    return False
-  def filterAll(self, item):
-    for genre in self.selected:
-      if genre not in item.getRawProperty(self.PROPERTY):
-        return False
-    return True
-  def filterExactly(self, item):
-    if len(self.selected) == len(item.getRawProperty(self.PROPERTY)):
-      return self.filterAll(item)
-    return False
+  def filterAtLeast(self):
+    return self.rowsWithAny(self.selected)
+  def filterAll(self):
+    return self.rowsWithAll(self.selected)
+  def filterExactly(self):
+    return self.rowsWithAll(self.selected) & (self.lengths == len(self.selected))
 
 class CountryFilter(ListboxFilter):
   PROPERTY = 'countries'
@@ -339,13 +435,10 @@ class CountryFilter(ListboxFilter):
     if len(self.selected) == 0:
       self.function = Filter.DEFAULT
     else:
-      self.function = self.filterBelongs
+      self.function = self.makeMaskFunction(self.filterBelongs())
     self.notifyMachine()
-  def filterBelongs(self, item):
-    for country in item.getRawProperty(self.PROPERTY):
-      if country in self.selected:
-        return True
-    return False
+  def filterBelongs(self):
+    return self.rowsWithAny(self.selected)
 
 class DirectorFilter(ListboxFilter):
   PROPERTY = 'directors'
@@ -365,13 +458,10 @@ class DirectorFilter(ListboxFilter):
     if len(self.selected) == 0:
       self.function = Filter.DEFAULT
     else:
-      self.function = self.filterBelongs
+      self.function = self.makeMaskFunction(self.filterBelongs())
     self.notifyMachine()
-  def filterBelongs(self, item):
-    for director in item.getRawProperty(self.PROPERTY):
-      if director in self.selected:
-        return True
-    return False
+  def filterBelongs(self):
+    return self.rowsWithAny(self.selected)
 
 class PlatformFilter(ListboxFilter):
   PROPERTY = 'platforms'
@@ -391,15 +481,13 @@ class PlatformFilter(ListboxFilter):
     if len(self.selected) == 0:
       self.function = Filter.DEFAULT
     else:
-      self.function = self.filterBelongs
+      self.function = self.makeMaskFunction(self.filterBelongs())
     self.notifyMachine()
-  def filterBelongs(self, item):
-    for maker in item.getRawProperty(self.PROPERTY):
-      if maker in self.selected:
-        return True
+  def filterBelongs(self):
+    return self.rowsWithAny(self.selected)
 
 class GamemakerFilter(ListboxFilter):
-  PROPERTY = ['developers', 'producers']
+  PROPERTY = ['developers', 'publishers']
   def __init__(self, root):
     self.selected = []
     super(GamemakerFilter, self).__init__(root)
@@ -416,17 +504,10 @@ class GamemakerFilter(ListboxFilter):
     if len(self.selected) == 0:
       self.function = Filter.DEFAULT
     else:
-      self.function = self.filterBelongs
+      self.function = self.makeMaskFunction(self.filterBelongs())
     self.notifyMachine()
-  def filterBelongs(self, item):
-    makers = []
-    for prop in self.PROPERTY:
-      for maker in item.getRawProperty(prop):
-        makers.append(maker)
-    for maker in makers:
-      if maker in self.selected:
-        return True
-    return False
+  def filterBelongs(self):
+    return self.rowsWithAny(self.selected)
 
 class RatingFilter(Filter):
   def __init__(self, root):
@@ -472,14 +553,7 @@ class RatingFilter(Filter):
       else:
         rateTo = rateFrom
         self.rate_to.set(str(rateTo))
-    def ratingFilter(item):
-      rating = item.getRawProperty('rating')
-      if rating >= rateFrom and rating <= rateTo:
-        return True
-      else:
-        return False
-    self.function = ratingFilter
-    self.notifyMachine()
+    self.setRange('rating', rateFrom, rateTo)
 
 class DateFilter(Filter):
   current_year = datetime.date.today().year
@@ -571,14 +645,13 @@ class DateFilter(Filter):
     ttk.Button(sc, text='msc', width=4, command=self._lastMonth).grid(row=2, column=2)
     ttk.Button(sc, text='tdzn', width=4, command=self._lastWeek).grid(row=2, column=3)
     sc.grid(row=3, column=0, columnspan=5, sticky=tk.NW)
-  def populateChoices(self, items:list):
-    all_years = set()
-    for item in items:
-      item_date = item.getRawProperty('dateOf')
-      if not item_date:
-        continue
-      all_years.add(item_date.year)
-    all_years.add(self.current_year)
+  def populateChoices(self, store):
+    column = store.getColumn('dateOf')
+    dates = column.values[column.present()]
+    all_years = {self.current_year}
+    if dates.size:
+      all_years.add(datetime.date.fromordinal(int(dates.min())).year)
+      all_years.add(datetime.date.fromordinal(int(dates.max())).year)
     self.all_years = list(range(min(all_years), max(all_years) + 1))
     self.fyInput.configure(values=self.all_years)
     self.tyInput.configure(values=self.all_years)
@@ -683,11 +756,5 @@ class DateFilter(Filter):
     # Issue the filter update
     self._makeUpdate(dateFrom=dateFrom, dateTo=dateTo)
   def _makeUpdate(self, dateFrom, dateTo):
-    def dateFilter(item):
-      date = item.getRawProperty('dateOf')
-      if date >= dateFrom and date <= dateTo:
-        return True
-      else:
-        return False
-    self.function = dateFilter
-    self.notifyMachine()
+    # dates are stored as ordinals (see columnstore.DateColumn)
+    self.setRange('dateOf', dateFrom.toordinal(), dateTo.toordinal())
@@ -8,13 +8,15 @@ from tkinter import ttk
 
 import filters
 from database import Database
+from detailviews import DetailWindow
 from filmweb import FilmwebAPI
 from options import Options
 from presenter import Presenter
+from sqlstore import SQLStore
 from updater import Updater
 from userdata import DataManager, UserData
 
-VERSION = '1.0.0-beta.4'
+VERSION = '1.0.0-beta.5'
 
 class Login(object):
   # By default a dormant window that offers a request function to be called by
@@ -137,6 +139,7 @@ class Login(object):
 
 class Main(object):
   filename = 'filmatyk.dat'  # will be created in user documents/home directory
+  tab_data = ['movies_data', 'series_data', 'games_data'] # UserData fields, by tab
   wintitle = '{}Filmatyk'    # format with debug flag
 
   def __init__(self, debugMode=False, isOnLinux=False):
@@ -149,6 +152,7 @@ class Main(object):
     userdata = self.dataManager.load()
     # initialize the options manager
     Options.init(userdata.options_json)
+    self.sqlStore = self.openSQLStore(userdata)
     # construct the window: first the notebook for tabbed view
     self.notebook = ttk.Notebook(root)
     self.notebook.grid(row=0, column=0, padx=5, pady=5, sticky=tk.NW)
@@ -161,6 +165,7 @@ class Main(object):
     frame.grid(row=1, column=0, padx=5, pady=5, sticky=tk.SW)
     ttk.Button(frame, text='Aktualizuj', command=self._updateData).grid(row=0, column=0, sticky=tk.SW)
     ttk.Button(frame, text='PRZEŁADUJ!', command=self._reloadData).grid(row=0, column=1, sticky=tk.SW)
+    ttk.Checkbutton(frame, text='baza SQLite', variable=Options.var('useSQLStore')).grid(row=0, column=2, padx=5, sticky=tk.SW)
     self.progressVar = tk.IntVar()
     self.progressbar = ttk.Progressbar(root, orient='horizontal', length=400, mode='determinate', variable=self.progressVar)
     self.progressbar.grid(row=1, column=0, padx=5, pady=5)
@@ -172,9 +177,9 @@ class Main(object):
     self.databases = []
     self.presenters = []
     # instantiate Presenters and Databases
-    self.api = FilmwebAPI(self.loginHandler.requestLogin, userdata.username)
+    self.api = FilmwebAPI(self.loginHandler.requestLogin, userdata.username, parse_workers=2)
     self.api.restoreSession(userdata.session_pkl)
-    movieDatabase = Database.restoreFromString('Movie', userdata.movies_data, self.api, self._setProgress)
+    movieDatabase = Database('Movie', self.api, self._setProgress, compact=True)
     self.databases.append(movieDatabase)
     moviePresenter = Presenter(self, self.api, movieDatabase, userdata.movies_conf)
     moviePresenter.addFilter(filters.YearFilter, row=0, column=0, sticky=tk.EW)
@@ -184,9 +189,8 @@ class Main(object):
     moviePresenter.addFilter(filters.CountryFilter, row=0, column=2, rowspan=3, sticky=tk.NW)
     moviePresenter.addFilter(filters.DirectorFilter, row=0, column=3, rowspan=3, sticky=tk.NW)
     moviePresenter.placeInTab('Filmy')
-    moviePresenter.totalUpdate()
     self.presenters.append(moviePresenter)
-    seriesDatabase = Database.restoreFromString('Series', userdata.series_data, self.api, self._setProgress)
+    seriesDatabase = Database('Series', self.api, self._setProgress, compact=True)
     self.databases.append(seriesDatabase)
     seriesPresenter = Presenter(self, self.api, seriesDatabase, userdata.series_conf)
     seriesPresenter.addFilter(filters.YearFilter, row=0, column=0, sticky=tk.EW)
@@ -196,9 +200,8 @@ class Main(object):
     seriesPresenter.addFilter(filters.CountryFilter, row=0, column=2, rowspan=3, sticky=tk.NW)
     seriesPresenter.addFilter(filters.DirectorFilter, row=0, column=3, rowspan=3, sticky=tk.NW)
     seriesPresenter.placeInTab('Seriale')
-    seriesPresenter.totalUpdate()
     self.presenters.append(seriesPresenter)
-    gameDatabase = Database.restoreFromString('Game', userdata.games_data, self.api, self._setProgress)
+    gameDatabase = Database('Game', self.api, self._setProgress, compact=True)
     self.databases.append(gameDatabase)
     gamePresenter = Presenter(self, self.api, gameDatabase, userdata.games_conf)
     gamePresenter.addFilter(filters.YearFilter, row=0, column=0, sticky=tk.EW)
@@ -208,8 +211,14 @@ class Main(object):
     gamePresenter.addFilter(filters.PlatformFilter, row=0, column=2, rowspan=3, sticky=tk.NW)
     gamePresenter.addFilter(filters.GamemakerFilter, row=0, column=3, rowspan=3, sticky=tk.NW)
     gamePresenter.placeInTab('Gry')
-    gamePresenter.totalUpdate()
     self.presenters.append(gamePresenter)
+    # databases are restored only when their tabs are first shown
+    self.userdata = userdata
+    self.loaded = set()
+    self.journaled = {} # field -> number of its changes in the journal
+    self.snapshotted = {} # field -> number of those that its snapshot includes
+    self.notebook.bind('<<NotebookTabChanged>>', self._tabChanged)
+    self.loadTab(0)
     #center window AFTER creating everything (including plot)
     self.centerWindow()
     #ensure a controlled exit no matter what user does (X-button, alt+f4)
@@ -245,6 +254,109 @@ class Main(object):
 
   # USER DATA MANAGEMENT
 
+  def openSQLStore(self, userdata):
+    """Open the SQL store of the databases, if the user has chosen to use one.
+
+    A new store is filled with the databases from the user data file right away.
+    """
+    if not Options.get('useSQLStore'):
+      return None
+    path = self.dataManager.path + '.sqlite'
+    is_new = not os.path.exists(path)
+    store = SQLStore(path)
+    if is_new:
+      store.migrate(userdata)
+    return store
+
+  def loadTab(self, index:int):
+    """Restore the database of a tab, unless it's been done already."""
+    if index in self.loaded:
+      return
+    self.loaded.add(index)
+    field = self.tab_data[index]
+    database = self.databases[index]
+    # the changes saved since, if any (see DataManager.replayJournal)
+    changes = self.userdata.changes.pop(field, [])
+    self.journaled[field] = len(changes)
+    stamp = self.userdata.stamps.get(field, None)
+    # the SQL store might hold the database with all those changes already
+    if self.sqlStore and stamp is not None and self.sqlStore.getState(field) == (stamp, len(changes)):
+      self.sqlStore.restoreDatabase(database)
+      self.presenters[index].totalUpdate()
+      return
+    # a snapshot of the database spares reading and decoding it altogether
+    path, applied = None, 0
+    if stamp is not None:
+      path, applied = self.dataManager.findSnapshot(field, stamp, len(changes))
+    if path:
+      try:
+        database.loadSnapshot(path)
+        self.snapshotted[field] = applied
+      except (OSError, ValueError):
+        path, applied = None, 0
+    if not path:
+      # reading the attribute is what actually reads the data from the file
+      database.loadString(getattr(self.userdata, field))
+    if field in self.userdata.damaged:
+      # the database could not be read - reload it, as on the first run
+      self.userdata.damaged.discard(field)
+      database.hardUpdate()
+    else:
+      # only the changes that the snapshot does not include (see refreshSnapshots)
+      database.applyChanges(changes[applied:])
+      # the store is new or has fallen behind the file - bring it up to date
+      if self.sqlStore:
+        self.sqlStore.saveDatabase(database)
+        self.sqlStore.setState(field, stamp, len(changes))
+    self.presenters[index].totalUpdate()
+
+  def loadAllTabs(self):
+    for index in range(len(self.databases)):
+      self.loadTab(index)
+
+  def saveSnapshot(self, index:int):
+    """Dump a database to a new snapshot, removing the older ones.
+
+    Snapshots are only a cache, so failing to write one is not an error.
+    The SQL store, if used, takes their place.
+    """
+    if self.sqlStore:
+      return
+    field = self.tab_data[index]
+    path = self.dataManager.snapshotPath(field, self.userdata.stamps[field], self.journaled[field])
+    try:
+      self.databases[index].storeToSnapshot(path)
+    except OSError:
+      return
+    self.snapshotted[field] = self.journaled[field]
+    self.dataManager.removeSnapshots(field, keep=path)
+
+  def refreshSnapshots(self):
+    """Dump the databases whose snapshots lack some of the journaled changes.
+
+    Done only at exit: writing a whole snapshot on every save would undo the
+    point of the journal, and the next run can as well replay the changes that
+    a snapshot lacks.
+    """
+    for index in sorted(self.loaded):
+      field = self.tab_data[index]
+      if field in self.userdata.stamps.keys() and self.snapshotted.get(field, None) != self.journaled[field]:
+        self.saveSnapshot(index)
+
+  def storeDatabases(self, changes:dict=None):
+    """Save the databases to the SQL store (if used), as just saved to the file.
+
+    Changes are the same that went to the journal, by field - or None if the
+    databases have all been saved as a whole. Databases not restored yet have
+    not changed, so they are left as they are.
+    """
+    if not self.sqlStore:
+      return
+    for index in sorted(self.loaded):
+      field = self.tab_data[index]
+      self.sqlStore.saveDatabase(self.databases[index], changes[field] if changes else None)
+      self.sqlStore.setState(field, self.userdata.stamps.get(field, None), self.journaled[field])
+
   def getFilename(self):
     if self.debugMode:
       return self.filename
@@ -253,7 +365,13 @@ class Main(object):
     return os.path.join(userdir, subpath)
 
   def saveUserData(self):
-    """Save the user data, if any of it has changed during the run time."""
+    """Save the user data, if any of it has changed during the run time.
+
+    Usually only the changes are appended to the journal. Everything is saved
+    to a new file if a database has been reloaded, or if the journal has grown
+    too big - and then all the databases are dumped to new snapshots.
+    The SQL store, if used, is saved the same way as the file (storeDatabases).
+    """
     # if for any reason the first update hasn't commenced - don't save anything
     if self.api.username is None:
       return
@@ -273,20 +391,56 @@ class Main(object):
         session_isDirty
       ):
       return
-    # construct the UserData object
-    serialized_data = UserData(
-      username=self.api.username,
-      movies_conf=self.presenters[0].storeToString(),
-      movies_data=self.databases[0].storeToString(),
-      series_conf=self.presenters[1].storeToString(),
-      series_data=self.databases[1].storeToString(),
-      games_conf=self.presenters[2].storeToString(),
-      games_data=self.databases[2].storeToString(),
-      options_json=Options.storeToString(),
-      session_pkl=session_pkl,
+    # collect the current state of everything except the databases
+    fields = {
+      'username': self.api.username,
+      'options_json': Options.storeToString(),
+      'session_pkl': session_pkl,
+      'movies_conf': self.presenters[0].storeToString(),
+      'series_conf': self.presenters[1].storeToString(),
+      'games_conf': self.presenters[2].storeToString(),
+    }
+    changes = {
+      self.tab_data[index]: db.popChanges() for index, db in enumerate(self.databases)
+    }
+    full_save = (
+      None in changes.values() or
+      set(self.userdata.stamps.keys()) != set(UserData.DATABASES) or
+      self.dataManager.needsCompaction()
     )
-    # request the manager to save it
-    self.dataManager.save(serialized_data)
+    if full_save:
+      # The changes from the journal have not been applied to the databases of
+      # the tabs that haven't been shown yet - so restore them first.
+      self.loadAllTabs()
+      serialized_data = UserData(
+        movies_data=self.databases[0].storeToString(),
+        series_data=self.databases[1].storeToString(),
+        games_data=self.databases[2].storeToString(),
+        **fields
+      )
+      serialized_data.stamps = {
+        field: self.dataManager.makeStamp(getattr(serialized_data, field))
+        for field in self.tab_data
+      }
+      self.dataManager.save(serialized_data)
+      self.userdata.stamps = serialized_data.stamps
+      self.journaled = {field: 0 for field in self.tab_data}
+      self.storeDatabases()
+      for index in range(len(self.databases)):
+        self.saveSnapshot(index)
+    else:
+      changed_fields = {
+        name: value for name, value in fields.items()
+        if value != getattr(self.userdata, name)
+      }
+      self.dataManager.appendChanges(changed_fields, changes)
+      for field, field_changes in changes.items():
+        if field in self.journaled.keys():
+          self.journaled[field] += len(field_changes)
+      self.storeDatabases(changes)
+    # remember what has been saved
+    for name, value in fields.items():
+      setattr(self.userdata, name, value)
     # notify the objects that they were saved
     for db in self.databases:
       db.isDirty = False
@@ -309,8 +463,12 @@ class Main(object):
       self.progressVar.set(value)
     self.root.update()
 
+  def _tabChanged(self, event=None):
+    self.loadTab(self.notebook.index('current'))
+
   def _updateData(self):
     # call softUpdate on all the databases and update all the presenters
+    self.loadAllTabs()
     for db, ps in zip(self.databases, self.presenters):
       db.softUpdate()
       ps.totalUpdate()
@@ -321,6 +479,7 @@ class Main(object):
     self.saveUserData()
 
   def _reloadData(self):
+    self.loadAllTabs()
     for db, ps in zip(self.databases, self.presenters):
       db.hardUpdate()
       ps.totalUpdate()
@@ -330,6 +489,10 @@ class Main(object):
 
   def _quit(self, restart=False):
     self.saveUserData()
+    self.refreshSnapshots()
+    if self.sqlStore:
+      self.sqlStore.close()
+    DetailWindow.getDetailWindow().close()
     self.root.quit()
     # Updater might request the whole app to restart. In this case, a request
     # is passed higher to the system shell to launch the app again.
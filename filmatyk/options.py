@@ -34,6 +34,8 @@ class _Options():
   """
   option_prototypes = [
     ('rememberLogin', tk.BooleanVar, True),
+    ('posterCacheSize', tk.IntVar, 200), # MB
+    ('useSQLStore', tk.BooleanVar, False), # takes effect on the next start
   ]
 
   def __init__(self):
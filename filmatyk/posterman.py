@@ -1,13 +1,42 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 import os
-import requests_html
+import threading
+
+import requests
 
 class PosterManager():
+  # Downloads posters and keeps them in a cache folder, named by the poster ID.
+  # Downloads happen on a small pool of background threads, sharing a single
+  # session (so the connections to the CDN are reused). Callers get a Future of
+  # the poster path, so the GUI never has to wait for the network.
+  # The cache is limited in size: when it grows too big, the posters that have
+  # not been used for the longest time are removed. Time of the last use is
+  # the modification time of the file, so the order survives restarts.
   CACHE_DIR = os.path.join('..', 'cache')
   NO_POSTER = 'https://2.fwcdn.pl/gf/beta/ic/plugs/v01/fNoImg140.jpg'
+  WORKERS = 4
+  TIMEOUT = 10.0
+  MAX_SIZE = 200 * 2**20 # bytes
+  EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+  }
 
-  def __init__(self):
-    self.session = requests_html.HTMLSession()
-    self.cached = []
+  def __init__(self, max_size:int=None):
+    self.max_size = max_size or self.MAX_SIZE
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.WORKERS)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self.executor = ThreadPoolExecutor(max_workers=self.WORKERS)
+    self.lock = threading.Lock()
+    self.pending = {}   # futures of the posters being downloaded, by ID
+    self.prefetched = set() # futures of the last prefetch request
+    self.cached = OrderedDict() # (file name, size) of each poster, least recently used first
+    self.size = 0
     # create the cache folder if necessary
     if not os.path.exists(self.CACHE_DIR):
       os.mkdir(self.CACHE_DIR)
@@ -15,40 +44,156 @@ class PosterManager():
       os.remove(self.CACHE_DIR)
       os.mkdir(self.CACHE_DIR)
     else:
-      self.cached = [int(os.path.splitext(f)[0]) for f in os.listdir(self.CACHE_DIR)]
-    # acquire the blank poster icon
-    if 0 not in self.cached:
-      self.downloadPoster(self.NO_POSTER, self.makePosterPath(0))
-      self.cached.append(0)
-  def makePosterPath(self, pid:int):
-    return os.path.join(self.CACHE_DIR, '{}.png'.format(pid))
-  def downloadPoster(self, url:str, path:str):
-    # downloads from url, stores under path
+      self.scanCache()
+    # acquire the blank poster icon (in the background, like any other poster)
+    if 0 not in self.cached.keys():
+      self.submit(0, self.NO_POSTER)
+  def scanCache(self):
+    # index the posters already in the cache folder, in order of their last use
+    entries = []
+    with os.scandir(self.CACHE_DIR) as scan:
+      for entry in scan:
+        name, ext = os.path.splitext(entry.name)
+        if not name.isdigit() or ext not in self.EXTENSIONS.values():
+          continue
+        stat = entry.stat()
+        entries.append((stat.st_mtime, int(name), entry.name, stat.st_size))
+    for _, pid, filename, size in sorted(entries):
+      self.cached[pid] = (filename, size)
+      self.size += size
+    self.evict()
+  def makePosterPath(self, filename:str):
+    return os.path.join(self.CACHE_DIR, filename)
+  @staticmethod
+  def getPosterID(url:str):
+    # URL is like: 'https://1.fwcdn.pl/po/60/10/796010/7814354.6.jpg'
+    # "796010" is actually the item ID -- can be used for caching
+    if not url:
+      return 0
+    return int(url.split('/')[-2])
+  def getExtension(self, url:str, content_type:str):
+    # the file is named after its actual type, as told by the server
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in self.EXTENSIONS.keys():
+      return self.EXTENSIONS[content_type]
+    ext = os.path.splitext(url)[1].lower()
+    if ext == '.jpeg':
+      return '.jpg'
+    return ext if ext in self.EXTENSIONS.values() else '.jpg'
+  def downloadPoster(self, url:str, pid:int):
+    # downloads from url, stores in the cache under the poster ID
     try:
-      response = self.session.get(url)
+      response = self.session.get(url, timeout=self.TIMEOUT)
     except:
-      return False
+      return None
     if not response.ok:
-      return False
-    with open(path, 'wb') as ifile:
-      ifile.write(response.content)
-    return True
+      return None
+    filename = '{}{}'.format(pid, self.getExtension(url, response.headers.get('Content-Type')))
+    path = self.makePosterPath(filename)
+    # write to a temporary file first, so that a poster is never seen half-written
+    temp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+    try:
+      with open(temp_path, 'wb') as ifile:
+        ifile.write(response.content)
+      os.replace(temp_path, path)
+    except OSError:
+      # e.g. the disk is full, the folder is read-only or the file is locked
+      try:
+        os.remove(temp_path)
+      except OSError:
+        pass
+      return None
+    return filename, len(response.content)
+  def __download(self, pid:int, url:str):
+    # runs on a worker thread
+    try:
+      downloaded = self.downloadPoster(url, pid)
+    except:
+      downloaded = None
+    with self.lock:
+      # whatever happened, a next request must be able to try again
+      self.pending.pop(pid, None)
+      if downloaded:
+        self.cached[pid] = downloaded
+        self.size += downloaded[1]
+        self.evict()
+        return self.makePosterPath(downloaded[0])
+      # on failure, return the default, blank poster
+      return self.getPath(0)
+  def evict(self):
+    # remove the least recently used posters until the cache fits in its size
+    # (call under lock); the blank poster and the one just used are always kept
+    victims = iter(list(self.cached.keys())[:-1])
+    while self.size > self.max_size:
+      pid = next(victims, None)
+      if pid is None:
+        break
+      if pid == 0:
+        continue
+      filename, size = self.cached.pop(pid)
+      self.size -= size
+      try:
+        os.remove(self.makePosterPath(filename))
+      except OSError:
+        pass
+  def getPath(self, pid:int):
+    # path to a cached poster, marked as just used (call under lock)
+    if pid not in self.cached.keys():
+      return None
+    self.cached.move_to_end(pid)
+    path = self.makePosterPath(self.cached[pid][0])
+    try:
+      os.utime(path)
+    except OSError:
+      # it was removed from outside
+      _, size = self.cached.pop(pid)
+      self.size -= size
+      return None
+    return path
+  def submit(self, pid:int, url:str):
+    # start downloading a poster, unless that is already happening (call under lock)
+    if pid not in self.pending.keys():
+      self.pending[pid] = self.executor.submit(self.__download, pid, url)
+    return self.pending[pid]
+  def getCachedPath(self, url:str):
+    # path to the poster if it's already in the cache, None otherwise
+    with self.lock:
+      return self.getPath(self.getPosterID(url))
+  def requestPoster(self, url:str):
+    # return a Future of the path to the poster, downloading it if necessary
+    pid = self.getPosterID(url)
+    with self.lock:
+      path = self.getPath(pid)
+      if path is None:
+        future = self.submit(pid, url or self.NO_POSTER)
+        # it's needed now, so a next prefetch must not cancel it
+        self.prefetched.discard(future)
+        return future
+    future = Future()
+    future.set_result(path)
+    return future
+  def prefetch(self, urls:list):
+    # warm the cache with the given posters, in the background; posters from the
+    # previous request that have not started downloading yet are no longer needed
+    with self.lock:
+      for future in self.prefetched:
+        future.cancel()
+      # cancelled downloads will never run, so they are not pending anymore
+      self.pending = {pid: f for pid, f in self.pending.items() if not f.cancelled()}
+      self.prefetched = set()
+      for url in urls:
+        pid = self.getPosterID(url)
+        if pid == 0 or pid in self.cached.keys() or pid in self.pending.keys():
+          continue
+        self.prefetched.add(self.submit(pid, url))
   def getPosterByURL(self, url:str):
-    if not url:
-      return self.makePosterPath(0)
-    # URL is like: 'https://1.fwcdn.pl/po/60/10/796010/7814354.6.jpg'
-    # "796010" is actually the item ID -- can be used for caching
-    splits = url.split('/')
-    pid = int(splits[-2])
-    # if such poster ID has been cached - retrieve it
-    if pid in self.cached:
-      return self.makePosterPath(pid)
-    else:
-      # otherwise, try downloading it
-      path = self.makePosterPath(pid)
-      if not self.downloadPoster(url, path):
-        # on failure, return the default, blank poster
-        return self.makePosterPath(0)
-      # on success - remember to add to cached
-      self.cached.append(pid)
-      return path
+    # blocking version of requestPoster
+    return self.requestPoster(url).result()
+  def close(self):
+    # downloads that have not started are dropped (by hand, as the executor can
+    # only do that itself since Python 3.9), the running ones are not waited for
+    with self.lock:
+      for future in self.pending.values():
+        future.cancel()
+      self.pending = {pid: f for pid, f in self.pending.items() if not f.cancelled()}
+    self.executor.shutdown(wait=False)
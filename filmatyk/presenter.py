@@ -1,8 +1,11 @@
+from bisect import bisect_left
 from collections import OrderedDict
 import json
 import tkinter as tk
 from tkinter import ttk
 
+import numpy as np
+
 import containers
 from defaults import DEFAULT_CONFIGS, DEFAULT_SORTING
 from detailviews import DetailWindow
@@ -14,9 +17,10 @@ class Config(object):
   # deserialization, as well as config changes. Presenter owns one and queries
   # it when displaying items.
 
-  def __init__(self, itemtype:str, columns:OrderedDict, parent:object):
+  def __init__(self, itemtype:str, columns:OrderedDict, parent:object, sorting:list=None):
     self.parent = parent
     self.rawConfig = columns
+    self.sorting = sorting # None means the default
     self.itemtype = itemtype
     itemclass = containers.classByString[itemtype]
     self.allColumns = [name for name, bp in itemclass.blueprints.items() if name != 'id']
@@ -226,6 +230,8 @@ class Config(object):
     return self.columns[column]
   def getHeading(self, column):
     return self.columnHeaders[column]
+  def getSorting(self):
+    return self.sorting
   # setters
   @setDirtyBit
   def manualResize(self, column):
@@ -240,6 +246,9 @@ class Config(object):
       self.rawConfig[column] = newWidth
       self.columns[column] = newWidth
   @setDirtyBit
+  def setSorting(self, sorting:list):
+    self.sorting = sorting
+  @setDirtyBit
   def manualDefault(self, column):
     # the user has requested this column to return to the default setting
     self.rawConfig[column] = None
@@ -247,86 +256,164 @@ class Config(object):
     self.columns[column] = defWidth
     self.parent.tree.column(column=column, width=defWidth)
   @staticmethod
-  def restoreFromString(itemtype:str, string:str, parent:object):
-    # The config string is a JSON dump of a dict that contains columns to be
-    # presented as keys, and their widths as values (or None for defaults).
+  def parseString(itemtype:str, string:str):
+    # The config string is a JSON dump of a dict of two keys: "columns", a dict
+    # that contains columns to be presented as keys, and their widths as values
+    # (or None for defaults), and "sorting", a list of [column, ascending] pairs
+    # (or None for default). Older versions only stored the "columns" dict.
     if string == '':
-      config = DEFAULT_CONFIGS[itemtype]
-    else:
-      config = json.loads(string, object_pairs_hook=OrderedDict) # preserve order
-    return Config(itemtype, config, parent)
+      return DEFAULT_CONFIGS[itemtype], None
+    config = json.loads(string, object_pairs_hook=OrderedDict) # preserve order
+    if isinstance(config.get('columns', None), dict):
+      return config['columns'], config.get('sorting', None)
+    return config, None
+  @staticmethod
+  def restoreFromString(itemtype:str, string:str, parent:object):
+    columns, sorting = Config.parseString(itemtype, string)
+    return Config(itemtype, columns, parent, sorting)
   def storeToString(self):
-    return json.dumps(self.rawConfig)
+    return json.dumps(OrderedDict(columns=self.rawConfig, sorting=self.sorting))
 
 class SortingMachine(object):
   # Changes the column heading to indicate the chosen sorting
-  # Returns a dict of parameters for the sort function
+  # Sorts rows of the ColumnStore that have passed the filters. Items can be
+  # sorted by a chain of columns: the first one decides, and each next one only
+  # orders the items that are equal in all the previous ones. Values of each
+  # column are turned into numeric ranks once per store, and a permutation of
+  # all rows that sorts them by a given chain is computed (in a single lexsort
+  # over all the columns) and remembered. Sorting the filtered rows is then a
+  # single walk through the permutation, skipping the rows that did not pass.
+  # Opposite direction is the same permutation walked backwards.
   ASC_CHAR = '▲ '
   DSC_CHAR = '▼ '
   @staticmethod
-  def makeLambda(key):
-    return lambda x: x.properties[key]
+  def makeKeys(column):
+    # numeric keys that sort like the values of a column, missing values first
+    values = column.values
+    if isinstance(values, np.ndarray):
+      # missing integers (and dates) are already the lowest, but NaNs sort last
+      if values.dtype.kind == 'f':
+        return np.where(np.isnan(values), -np.inf, values)
+      return values
+    # objects (strings, tuples) are replaced by their ranks among all values
+    distinct = sorted(set(value for value in values if value is not None))
+    ranks = {value: rank for rank, value in enumerate(distinct)}
+    return np.array([ranks.get(value, -1) for value in values], dtype=np.int64)
 
-  def __init__(self, tree, columns:list, itemtype:str):
+  def __init__(self, tree, columns:list, itemtype:str, sorting:list=None):
     self.tree = tree
     self.columns = columns
-    self.current_id = ''
-    self.original_heading = ''
-    self.sorting = None
-    self.ascending = False
-    self.firstRun(itemtype)
-  def firstRun(self, itemtype:str):
-    default_key, default_asc = DEFAULT_SORTING[itemtype]
-    if default_key not in self.columns:
-      return
-    self.update(default_key)
-    self.ascending = default_asc
-  def update(self, column_id:str):
-    # retrieve the column's original heading
-    column_heading = self.tree.heading(column=column_id, option='text')
-    # first run
-    if not self.current_id:
-      self.current_id = column_id
-      self.original_heading = column_heading
-      self.setMarker()
-      self.sorting = dict(key=self.makeLambda(column_id), reverse=self.ascending)
-      return self.sorting
-    # on every other run, check whether the same column was clicked again
-    elif column_id == self.current_id:
-      # only switch the order in this case
-      self.ascending = not self.ascending
-      self.setMarker()
-      self.sorting['reverse'] = self.ascending
-      return self.sorting
+    self.chain = [] # [column name, ascending] pairs, most important first
+    self.original_headings = {}
+    self.store = None
+    self.ranks = {}        # column name -> ranks of the values in the current store
+    self.permutations = {} # chain -> sorted rows of the current store
+    self.firstRun(itemtype, sorting)
+  def firstRun(self, itemtype:str, sorting:list=None):
+    # restore the sorting from the config, or the default one
+    if not sorting:
+      sorting = [DEFAULT_SORTING[itemtype]]
+    for column_id, ascending in sorting:
+      if column_id not in self.columns or self.findColumn(column_id) >= 0:
+        continue
+      self.original_headings[column_id] = self.tree.heading(column=column_id, option='text')
+      self.chain.append([column_id, ascending])
+    self.setMarker()
+  def findColumn(self, column_id:str):
+    # position of a column in the chain, or -1
+    for position, (sorted_id, _) in enumerate(self.chain):
+      if sorted_id == column_id:
+        return position
+    return -1
+  def update(self, column_id:str, add:bool=False):
+    position = self.findColumn(column_id)
+    # a column added to the chain (shift-click)
+    if add and position < 0:
+      self.original_headings[column_id] = self.tree.heading(column=column_id, option='text')
+      self.chain.append([column_id, False])
+    # shift-click on a column already in the chain only switches its order,
+    # and so does a regular click on the most important column
+    elif (add and position >= 0) or position == 0:
+      self.chain[position][1] = not self.chain[position][1]
     # otherwise, a different column was clicked
     else:
-      # in this case, restore the original column's heading
-      self.tree.heading(column=self.current_id, text=self.original_heading)
-      self.current_id = column_id
-      self.original_heading = column_heading
-      self.ascending = False
-      self.setMarker()
-      self.sorting = dict(key=self.makeLambda(column_id), reverse=self.ascending)
-      return self.sorting
+      # in this case, restore the original headings of all sorted columns
+      for sorted_id, _ in self.chain:
+        self.tree.heading(column=sorted_id, text=self.original_headings.pop(sorted_id))
+      self.original_headings[column_id] = self.tree.heading(column=column_id, option='text')
+      self.chain = [[column_id, False]]
+    self.setMarker()
   def setMarker(self):
-    # prefixes the currently selected column's heading with a marker indicating sort direction
-    char = self.ASC_CHAR if self.ascending else self.DSC_CHAR
-    self.tree.heading(column=self.current_id, text=char + self.original_heading)
+    # prefixes the headings of the sorted columns with markers indicating sort
+    # direction (and their positions in the chain, if there's more than one)
+    for position, (column_id, ascending) in enumerate(self.chain):
+      char = self.ASC_CHAR if ascending else self.DSC_CHAR
+      if len(self.chain) > 1:
+        char = '{}{} '.format(char.strip(), position + 1)
+      self.tree.heading(column=column_id, text=char + self.original_headings[column_id])
   def getSorting(self):
-    return self.sorting
+    return [list(link) for link in self.chain]
+  def getRanks(self, store, column_id:str):
+    # ranks of the values of a column (equal values have equal ranks)
+    if column_id not in self.ranks.keys():
+      keys = self.makeKeys(store.getColumn(column_id))
+      self.ranks[column_id] = np.unique(keys, return_inverse=True)[1].reshape(-1)
+    return self.ranks[column_id]
+  def getPermutation(self, store, chain:list):
+    # rows of the store sorted by a chain, ascending by its first column; since
+    # the opposite is the same permutation reversed, the directions of the next
+    # columns only matter relative to the first one
+    if store is not self.store:
+      self.store = store
+      self.ranks = {}
+      self.permutations = {}
+    first_ascending = chain[0][1]
+    key = tuple((column_id, ascending != first_ascending) for column_id, ascending in chain)
+    if key not in self.permutations.keys():
+      # lexsort sorts by the last key first
+      keys = [
+        -self.getRanks(store, column_id) if opposite else self.getRanks(store, column_id)
+        for column_id, opposite in reversed(key)
+      ]
+      self.permutations[key] = np.lexsort(keys)
+    return self.permutations[key]
+  def sortRows(self, store, mask):
+    # rows that passed the filters (mask), in the order of the item list
+    # (which is displayed from the end, so the "ascending" order is reversed)
+    if not self.chain:
+      return np.flatnonzero(mask)
+    permutation = self.getPermutation(store, self.chain)
+    if self.chain[0][1]:
+      permutation = permutation[::-1]
+    return permutation[mask[permutation]]
 
 class Presenter(object):
   """ TODO MAJOR
       1. Presenter has a switch whether to display ratings or want-tos
   """
+  # The tree only ever holds the visible rows and a buffer of rows below them,
+  # more are inserted (DISPLAY_CHUNK at a time) as the user scrolls down.
+  # Rows are identified by item IDs, and are never deleted unless the items
+  # have changed - only detached from the tree, to be reattached when needed.
+  TREE_HEIGHT = 28
+  DISPLAY_CHUNK = 100
   def __init__(self, root, api, database, config:str, displayRating=True):
     self.root = root
     self.main = ttk.Frame(root.notebook)
     self.database = database
+    self.store = database.getStore()
+    self.o_items = []
     self.items = []
+    self.mask = np.ones(len(self.store), dtype=bool) # items that pass the filters
+    self.displayed = 0 # number of items inserted into the tree
+    self.shown = []     # IDs of these items, in the order of display
+    self.known = set()  # IDs of all items in the tree, including detached ones
+    self.firstVisible = 0 # position of the topmost row in the view
     self.config = Config.restoreFromString(database.itemtype, config, self)
     self.__construct()
-    self.sortMachine = SortingMachine(self.tree, self.config.getColumns(), self.database.itemtype)
+    self.sortMachine = SortingMachine(
+      self.tree, self.config.getColumns(), self.database.itemtype, self.config.getSorting()
+    )
     self.filtMachine = FilterMachine(self.filtersUpdate)
     self.detailWindow = DetailWindow.getDetailWindow()
     self.__placeTitleFilter()
@@ -337,21 +424,22 @@ class Presenter(object):
     # TREEVIEW
     self.tree = tree = ttk.Treeview(
       self.left,
-      height=28,
+      height=self.TREE_HEIGHT,
       selectmode=tk.BROWSE,
       columns=['id'] + self.config.getAllColumns()
     )
     self.configureColumns()
     tree.column(column='#0', width=0, minwidth=0, stretch=False)
     tree.grid(row=1, column=0, sticky=tk.NW)
-    yScroll = ttk.Scrollbar(self.left, command=tree.yview)
-    yScroll.grid(row=1, column=1, sticky=tk.NS)
-    tree.configure(yscrollcommand=yScroll.set)
+    self.yScroll = ttk.Scrollbar(self.left, command=tree.yview)
+    self.yScroll.grid(row=1, column=1, sticky=tk.NS)
+    tree.configure(yscrollcommand=self._treeScrolled)
     # POP-UP MENU
     self.menu = tk.Menu(self.left, tearoff=0)
     self.menu.add_command(label='Konfiguracja', command=self.config.popUp)
     # BIND CALLBACKS
     tree.bind('<Button-1>', self._singleClick)
+    tree.bind('<Shift-Button-1>', self._shiftClick)
     tree.bind('<Double-Button-1>', self._doubleClick)
     tree.bind('<ButtonRelease-1>', self._leftRelease)
     tree.bind('<Button-3>', self._rightClick)
@@ -386,6 +474,8 @@ class Presenter(object):
     self.filtMachine.registerFilter(titleFilter)
     titleFilter.grid(row=0, column=0, columnspan=2, pady=2, sticky=tk.EW)
   def configureColumns(self):
+    # values of the rows have been formatted for the old columns
+    self.clearTree()
     for column in self.config.getColumns():
       self.tree.column(column=column, width=self.config.getWidth(column), stretch=False)
       self.tree.heading(column=column, text=self.config.getHeading(column), anchor=tk.W)
@@ -434,9 +524,13 @@ class Presenter(object):
   # has changed - the update can be triggered only from this specific point.
   def totalUpdate(self):
     # acquire from database to an internal state
+    # the store and the list of items share the order (store row == list index)
     self.o_items = self.database.getItems()
+    self.store = self.database.getStore()
     self.items = self.o_items
-    self.filtMachine.populateChoices(self.o_items)
+    # the items might have changed, so the rows have to be made again
+    self.clearTree()
+    self.filtMachine.populateChoices(self.store)
     # The first update is the first moment where all of the Filters have been
     # placed for sure. This is the time when a resetAll button can be placed.
     if not self.isResetAllButtonPlaced:
@@ -444,38 +538,120 @@ class Presenter(object):
       self.isResetAllButtonPlaced = True
     self.filtersUpdate()
   def filtersUpdate(self):
-    filtering = self.filtMachine.getFiltering()
-    self.items = list(filter(filtering, self.o_items))
+    self.mask = self.filtMachine.getMask(self.store)
+    # statistics do not depend on the sorting, so they are updated here
+    self.stats.update(self.store, self.mask)
     self.sortingUpdate()
   def sortingUpdate(self):
-    sorting = self.sortMachine.getSorting()
-    if sorting:
-      self.items.sort(**sorting)
+    rows = self.sortMachine.sortRows(self.store, self.mask)
+    self.items = [self.o_items[row] for row in rows]
     self.displayUpdate()
   def displayUpdate(self):
-    # clear existing results
-    for item in self.tree.get_children():
-      self.tree.delete(item)
+    # Instead of rebuilding the tree, only change what is necessary: detach the
+    # rows that are no longer displayed, and of those that remain, move only the
+    # ones that have changed their order. Rows that stay in the same order are
+    # the longest increasing subsequence of their new positions.
+    # Keep as many items as there were, so the view does not jump if scrolled.
+    count = min(len(self.items), max(self.displayed, self.TREE_HEIGHT + self.DISPLAY_CHUNK))
+    # items are displayed in the reverse order of the list
+    new_items = [self.items[-1 - position] for position in range(count)]
+    new_ids = [item['id'] for item in new_items]
+    new_positions = {iid: position for position, iid in enumerate(new_ids)}
+    kept = [iid for iid in self.shown if iid in new_positions.keys()]
+    stable = set(kept[i] for i in self.longestIncreasing([new_positions[iid] for iid in kept]))
+    unstable = [iid for iid in self.shown if iid not in stable]
+    if unstable:
+      self.tree.detach(*unstable)
+    # now the only attached rows are the stable ones, and they are in order
+    for position, (item, iid) in enumerate(zip(new_items, new_ids)):
+      if iid not in stable:
+        self.attachRow(item, iid, position)
+    self.shown = new_ids
+    self.displayed = count
+    # the view will show the top of the list - get the posters ready for it
+    self.firstVisible = 0
+    self.prefetchPosters(0)
+  def materializeRows(self, count:int):
+    # append the next count items that are not yet displayed
+    stop = min(self.displayed + count, len(self.items))
+    for position in range(self.displayed, stop):
+      item = self.items[-1 - position]
+      iid = item['id']
+      self.attachRow(item, iid, tk.END)
+      self.shown.append(iid)
+    self.displayed = stop
+  def prefetchPosters(self, first:int):
+    # download posters of a screenful of items in the background, starting at a
+    # given position, so that previewing any of them will not have to wait
+    stop = min(first + self.TREE_HEIGHT, len(self.items))
+    urls = [self.items[-1 - position].getRawProperty('imglink') for position in range(first, stop)]
+    self.detailWindow.posterManager.prefetch(urls)
+  def attachRow(self, item, iid:str, index):
+    # reattach the row of an item if it's already in the tree, or make a new one
+    if iid in self.known:
+      self.tree.move(iid, '', index)
+      return
     # list all properties that the TV needs to describe an item when inserting
     all_columns = self.config.getAllColumns()
     # only some of those will actually be displayed - list them separately
-    display_these = self.config.getColumns()
-    # retrieve only the necessary properties of every displayed item
-    for item in self.items:
-      # list of values to put into the tree, always starts with the id
-      values = [item['id']]
-      # go through all the properties required logically by the TV (at insert)
-      for col in all_columns:
-        # but only actually query the item for those that will be displayed
-        if col not in display_these:
-          values.append('')
-        else:
-          values.append(item[col])
-      self.tree.insert(parent='', index=0, text='', values=values)
-    # update statistics
-    self.stats.update(self.items)
+    display_these = set(self.config.getColumns())
+    values = self.formatValues(item, all_columns, display_these)
+    self.tree.insert(parent='', index=index, iid=iid, text='', values=values)
+    self.known.add(iid)
+  def clearTree(self):
+    # delete all rows, displayed or detached
+    if self.known:
+      self.tree.delete(*self.known)
+    self.known = set()
+    self.shown = []
+    self.displayed = 0
+  @staticmethod
+  def longestIncreasing(sequence:list):
+    # indices of the longest increasing subsequence of a sequence of numbers
+    tails = []    # last values of the best subsequences of each length
+    tail_ids = [] # indices of those values
+    previous = [-1] * len(sequence)
+    for i, value in enumerate(sequence):
+      length = bisect_left(tails, value)
+      if length == len(tails):
+        tails.append(value)
+        tail_ids.append(i)
+      else:
+        tails[length] = value
+        tail_ids[length] = i
+      previous[i] = tail_ids[length - 1] if length > 0 else -1
+    indices = []
+    i = tail_ids[-1] if tail_ids else -1
+    while i >= 0:
+      indices.append(i)
+      i = previous[i]
+    return indices[::-1]
+  @staticmethod
+  def formatValues(item, all_columns:list, display_these:set):
+    # list of values to put into the tree, always starts with the id
+    values = [item['id']]
+    # go through all the properties required logically by the TV (at insert)
+    for col in all_columns:
+      # but only actually query the item for those that will be displayed
+      if col not in display_these:
+        values.append('')
+      else:
+        values.append(item[col])
+    return values
 
   # Interface
+  def _treeScrolled(self, first, last):
+    # pass the view to the scrollbar, and if there's less than a screen of rows
+    # left below it, insert some more
+    self.yScroll.set(first, last)
+    first_row = int(float(first) * self.displayed)
+    if first_row != self.firstVisible:
+      self.firstVisible = first_row
+      self.prefetchPosters(first_row)
+    if self.displayed < len(self.items):
+      rows_below = (1.0 - float(last)) * self.displayed
+      if rows_below < self.TREE_HEIGHT:
+        self.materializeRows(self.DISPLAY_CHUNK)
   def _singleClick(self, event=None):
     if event is None:
       return
@@ -483,6 +659,13 @@ class Presenter(object):
     click_region = self.tree.identify_region(event.x, event.y)
     if click_region == 'heading':
       self.changeSorting(event)
+  def _shiftClick(self, event=None):
+    if event is None:
+      return
+    # if a treeview heading was clicked - add it to the sorting
+    click_region = self.tree.identify_region(event.x, event.y)
+    if click_region == 'heading':
+      self.changeSorting(event, add=True)
   def _doubleClick(self, event=None):
     if event is None:
       return
@@ -518,10 +701,11 @@ class Presenter(object):
     column_id = self.tree.identify_column(event.x)
     column_name = self.tree.column(column=column_id, option='id')
     self.config.manualDefault(column_name)
-  def changeSorting(self, event):
+  def changeSorting(self, event, add=False):
     column_id = self.tree.identify_column(event.x)
     column_name = self.tree.column(column=column_id, option='id')
-    self.sortMachine.update(column_name)
+    self.sortMachine.update(column_name, add)
+    self.config.setSorting(self.sortMachine.getSorting())
     self.sortingUpdate()
   def resizeColumn(self, event):
     column_id = self.tree.identify_column(event.x)
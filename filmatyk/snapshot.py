@@ -0,0 +1,241 @@
+"""Snapshots of ColumnStores, read lazily from memory-mapped files.
+
+Restoring a Database from the user data means decoding all of its JSON and
+building the store, before anything can be displayed. A snapshot is the store
+itself, dumped to a file in a layout that can be used without decoding:
+numeric columns (numbers and dates, see Blueprint.kind) are plain arrays, which
+are mapped into memory and used by numpy as they are. Strings (and lists of
+strings) are kept in a single heap, and each text column holds just the offsets
+of its values in the heap - a value is only decoded when it's first needed.
+Showing the first rows (and statistics of the ratings) only touches the pages
+of the file that hold them.
+
+Layout: a header (magic string, revision, number of columns and rows, the item
+type, and the position of the heap), a table of contents with the name, kind,
+offset and length of each column, then the columns, each aligned to 8 bytes,
+and finally the heap. A text column consists of an array of the offsets of its
+values in the heap (one more than the rows, each value ends where the next one
+starts) and an array of flags telling which values are present. Values of list
+columns are stored with each string terminated by a NUL character.
+
+A snapshot is never modified: the file is mapped copy-on-write, so changing a
+value of the store only changes its copy in memory. Snapshots are disposable
+caches - the user data file remains the actual storage (see userdata.py).
+"""
+
+import copy
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+from columnstore import ColumnStore, DateColumn, ListColumn, NumericColumn, ObjectColumn
+import containers
+
+MAGIC = b'FMTKSNAP'
+REVISION = 1
+HEADER = struct.Struct('<8sHHQ16sQQ')
+ENTRY = struct.Struct('<16s8sQQ')
+ALIGNMENT = 8
+SEPARATOR = '\x00'
+
+
+def getDtype(kind:str):
+  # all numbers are stored little-endian, dates as int32 ordinals
+  return np.dtype('int32' if kind == 'date' else kind).newbyteorder('<')
+
+
+def encodeValue(kind:str, value):
+  if kind == 'list':
+    # each string is terminated, so that an empty list differs from ['']
+    value = ''.join(string + SEPARATOR for string in value)
+  return value.encode('utf-8')
+
+
+def write(path:str, store:ColumnStore):
+  """Dump a ColumnStore to a snapshot file.
+
+  The file is written under a temporary name first, so that a snapshot is never
+  seen half-written.
+  """
+  blueprints = store.itemclass.blueprints
+  length = len(store)
+  regions = [] # (name, kind, bytes) of each column
+  heap = []
+  heap_size = 0
+  for name, blueprint in blueprints.items():
+    kind = blueprint.getKind()
+    column = store.getColumn(name)
+    if kind not in ['str', 'list']:
+      data = column.values.astype(getDtype(kind), copy=False).tobytes()
+    else:
+      offsets = np.zeros(length + 1, dtype=getDtype('int64'))
+      present = np.zeros(length, dtype=np.uint8)
+      offsets[0] = heap_size
+      for row in range(length):
+        value = column.get(row)
+        if value is not None:
+          encoded = encodeValue(kind, value)
+          heap.append(encoded)
+          heap_size += len(encoded)
+          present[row] = 1
+        offsets[row + 1] = heap_size
+      data = offsets.tobytes() + present.tobytes()
+    regions.append((name, kind, data))
+  # lay the columns out after the header and the table
+  position = HEADER.size + ENTRY.size * len(regions)
+  table = []
+  for name, kind, data in regions:
+    position += -position % ALIGNMENT
+    table.append((name, kind, position, len(data)))
+    position += len(data)
+  heap_offset = position + -position % ALIGNMENT
+  temp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+  with open(temp_path, 'wb') as snapshot_file:
+    snapshot_file.write(HEADER.pack(
+      MAGIC, REVISION, len(regions), length, store.itemtype.encode('utf-8'), heap_offset, heap_size
+    ))
+    for name, kind, offset, size in table:
+      snapshot_file.write(ENTRY.pack(name.encode('utf-8'), kind.encode('utf-8'), offset, size))
+    for (_, _, offset, _), (_, _, data) in zip(table, regions):
+      snapshot_file.write(b'\x00' * (offset - snapshot_file.tell()))
+      snapshot_file.write(data)
+    snapshot_file.write(b'\x00' * (heap_offset - snapshot_file.tell()))
+    for encoded in heap:
+      snapshot_file.write(encoded)
+  os.replace(temp_path, path)
+
+
+def load(path:str, itemtype:str):
+  """Return a ColumnStore backed by a snapshot file.
+
+  Raises ValueError if the file is not a snapshot of the given item type.
+  """
+  with open(path, 'rb') as snapshot_file:
+    mapping = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_COPY)
+  if len(mapping) < HEADER.size:
+    raise ValueError('Not a snapshot file: {}'.format(path))
+  magic, revision, count, length, stored_type, heap_offset, heap_size = HEADER.unpack_from(mapping)
+  if magic != MAGIC or revision != REVISION:
+    raise ValueError('Not a snapshot file: {}'.format(path))
+  if stored_type.rstrip(b'\x00').decode('utf-8') != itemtype:
+    raise ValueError('Snapshot of a different item type: {}'.format(path))
+  if heap_offset + heap_size > len(mapping):
+    raise ValueError('Snapshot file is truncated: {}'.format(path))
+  heap = Heap(mapping, heap_offset)
+  blueprints = containers.classByString[itemtype].blueprints
+  columns = {}
+  for i in range(count):
+    name, kind, offset, size = ENTRY.unpack_from(mapping, HEADER.size + i * ENTRY.size)
+    name = name.rstrip(b'\x00').decode('utf-8')
+    kind = kind.rstrip(b'\x00').decode('utf-8')
+    if name not in blueprints.keys() or blueprints[name].getKind() != kind:
+      # the Blueprints have changed since - the column is no longer valid
+      continue
+    if offset + size > len(mapping):
+      raise ValueError('Snapshot file is truncated: {}'.format(path))
+    if kind in ['str', 'list']:
+      offsets = np.frombuffer(mapping, dtype=getDtype('int64'), count=length + 1, offset=offset)
+      present = np.frombuffer(mapping, dtype=np.uint8, count=length, offset=offset + 8 * (length + 1))
+      column_class = MappedListColumn if kind == 'list' else MappedObjectColumn
+      columns[name] = column_class(heap, offsets[:-1], offsets[1:], present.view(bool))
+    else:
+      column = DateColumn([]) if kind == 'date' else NumericColumn(kind, [])
+      column.values = np.frombuffer(mapping, dtype=getDtype(kind), count=length, offset=offset)
+      columns[name] = column
+  return ColumnStore.fromColumns(itemtype, length, columns)
+
+
+class Heap(object):
+  """Strings of a snapshot, decoded by their offsets."""
+  def __init__(self, mapping:mmap.mmap, offset:int):
+    self.mapping = mapping
+    self.offset = offset
+
+  def read(self, start:int, end:int):
+    return self.mapping[self.offset + start:self.offset + end].decode('utf-8')
+
+
+class MappedObjectColumn(ObjectColumn):
+  """Column of strings in a snapshot's heap, each decoded when first needed.
+
+  Values that are set are only kept in memory, along with the decoded ones.
+  Accessing all the values at once (e.g. to index them) decodes them all, and
+  from then on the column is an ordinary ObjectColumn.
+  """
+  def __init__(self, heap:Heap, starts:np.ndarray, ends:np.ndarray, present:np.ndarray):
+    self.heap = heap
+    self.starts = starts # where the value of each row begins in the heap
+    self.ends = ends
+    self.mask = present
+    self.decoded = {} # row -> value, until all of them are decoded
+    self.all_values = None
+
+  @property
+  def values(self):
+    if self.all_values is None:
+      self.all_values = [self.get(row) for row in range(len(self.mask))]
+      self.decoded = None
+    return self.all_values
+
+  @values.setter
+  def values(self, values:list):
+    self.all_values = values
+
+  def decode(self, string:str):
+    return string
+
+  def present(self):
+    if self.all_values is not None:
+      return super(MappedObjectColumn, self).present()
+    return self.mask.copy()
+
+  def get(self, row:int):
+    if self.all_values is not None:
+      return self.all_values[row]
+    if row not in self.decoded.keys():
+      value = None
+      if self.mask[row]:
+        value = self.decode(self.heap.read(int(self.starts[row]), int(self.ends[row])))
+      self.decoded[row] = value
+    return self.decoded[row]
+
+  def set(self, row:int, value):
+    if self.all_values is not None:
+      return super(MappedObjectColumn, self).set(row, value)
+    self.decoded[row] = None if value is None else self.encode(value)
+    self.mask[row] = value is not None
+
+  def take(self, rows:np.ndarray):
+    """Return a column of the values at the given rows, still to be decoded."""
+    if self.all_values is not None:
+      return super(MappedObjectColumn, self).take(rows)
+    column = copy.copy(self)
+    taken = rows >= 0
+    source = rows[taken]
+    column.starts = np.zeros(len(rows), dtype=self.starts.dtype)
+    column.starts[taken] = self.starts[source]
+    column.ends = np.zeros(len(rows), dtype=self.ends.dtype)
+    column.ends[taken] = self.ends[source]
+    column.mask = np.zeros(len(rows), dtype=bool)
+    column.mask[taken] = self.mask[source]
+    # values decoded (or set) so far move along with their rows
+    positions = np.full(len(self.mask), -1, dtype=np.int64)
+    positions[source] = np.flatnonzero(taken)
+    column.decoded = {}
+    for row, value in self.decoded.items():
+      if positions[row] >= 0:
+        column.decoded[int(positions[row])] = value
+    return column
+
+
+class MappedListColumn(MappedObjectColumn, ListColumn):
+  """Column of lists of strings in a snapshot's heap (see ListColumn)."""
+  def __init__(self, heap:Heap, starts:np.ndarray, ends:np.ndarray, present:np.ndarray):
+    self.shared = {}
+    super(MappedListColumn, self).__init__(heap, starts, ends, present)
+
+  def decode(self, string:str):
+    return self.encode(string.split(SEPARATOR)[:-1])
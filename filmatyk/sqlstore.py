@@ -0,0 +1,411 @@
+"""SQLite storage engine for the item data.
+
+By default, all Items of a Database are saved as a single JSON string (see
+Database.storeToString), which has to be written in whole and read in whole.
+SQLStore is an alternative: Items are kept in an SQLite database, one table per
+item type, with a column per property and a row per item. Values of the list
+properties (genres, countries, cast etc.) are kept in a table of their own (a
+vocabulary, shared by all item types), and related to the items by junction
+tables. Year, rating and the date of rating are indexed.
+
+This allows saving just the changed items, as upserts in a single transaction
+(either all of them are saved or none), and selecting items by their property
+values, in a given order, without loading any of them (see select).
+
+Items go in and out of the store as records (see Item.asDict), so a Database
+can be saved to and restored from it just like from a string (saveDatabase,
+restoreDatabase). migrate copies the databases from a UserData (as loaded by
+any of the DataManager loaders) into the store, and exportString produces the
+string that the user data file would hold.
+
+Main uses the store if the useSQLStore option is set. The user data file is
+still saved as usual, so the store can always be brought up to date from it:
+the store remembers the stamp of each database and the number of its journaled
+changes that it holds (see getState), and a database whose state does not
+match that of the file is restored from the file and saved to the store again.
+"""
+
+from datetime import date
+import sqlite3
+
+import containers
+import fastjson
+
+
+def quote(name:str):
+  # property names are not necessarily safe as SQL identifiers (e.g. "cast")
+  return '"{}"'.format(name)
+
+
+class SQLStore(object):
+  """Items of all types in an SQLite database (a file, or in memory).
+
+  Each item type has a table named after it (e.g. "movie") with a column for
+  each scalar property, a column telling the position of the item in the list
+  (items are loaded in that order), and a column for each list property, which
+  holds its length (NULL if the item does not have that property). The values
+  themselves are held in tables named after the properties (e.g. "genres"),
+  and related to the items via junction tables (e.g. "movie_genres").
+  Dates are held as ISO strings, so that they sort correctly.
+  """
+  # Properties for which the range queries are expected to be common
+  INDEXED = ['year', 'rating', 'dateOf']
+  # UserData fields holding the databases of each item type
+  FIELDS = {'Movie': 'movies_data', 'Series': 'series_data', 'Game': 'games_data'}
+
+  def __init__(self, path:str=':memory:'):
+    self.connection = sqlite3.connect(path)
+    self.connection.execute('PRAGMA foreign_keys = ON')
+    self.tables = {} # item type -> Table, created on first use
+    with self.connection:
+      self.connection.execute(
+        'CREATE TABLE IF NOT EXISTS state (field TEXT PRIMARY KEY, stamp INTEGER, journaled INTEGER NOT NULL)'
+      )
+
+  def getTable(self, itemtype:str):
+    if itemtype not in self.tables.keys():
+      table = Table(itemtype)
+      with self.connection:
+        for statement in table.makeSchema():
+          self.connection.execute(statement)
+      self.tables[itemtype] = table
+    return self.tables[itemtype]
+
+  def count(self, itemtype:str):
+    table = self.getTable(itemtype)
+    query = 'SELECT COUNT(*) FROM {}'.format(quote(table.name))
+    return self.connection.execute(query).fetchone()[0]
+
+  def save(self, itemtype:str, records:list):
+    """Replace all the stored items of a type with the given records, in order.
+
+    Items that are already stored are only updated, those missing from the
+    records are removed. Nothing is changed if any of the records fails.
+    """
+    table = self.getTable(itemtype)
+    ids = set(record['id'] for record in records)
+    with self.connection:
+      removed = [(id,) for id in self.getIDs(table) if id not in ids]
+      self.connection.executemany(
+        'DELETE FROM {} WHERE id = ?'.format(quote(table.name)), removed
+      )
+      self.upsert(table, records, range(len(records)))
+
+  def applyChanges(self, itemtype:str, changes:list):
+    """Replay the given changes (see Database.popChanges) on the stored items.
+
+    The result is the same as that of Database.applyChanges, but only the
+    changed items are written.
+    """
+    table = self.getTable(itemtype)
+    with self.connection:
+      for change in changes:
+        head = change['head']
+        head_ids = set(head)
+        stored = set(self.getIDs(table, head_ids.union(
+          change['removed'], (record['id'] for record in change['records'])
+        )))
+        self.connection.executemany(
+          'DELETE FROM {} WHERE id = ?'.format(quote(table.name)),
+          [(id,) for id in change['removed'] if id in stored and id not in head_ids]
+        )
+        # items that are not at the head can only be modified, never added
+        records = [
+          record for record in change['records']
+          if record['id'] in head_ids or record['id'] in stored
+        ]
+        self.upsert(table, records, None)
+        stored.update(record['id'] for record in records)
+        # the head goes before all the other items, which keep their order
+        first = self.connection.execute(
+          'SELECT MIN(position) FROM {}'.format(quote(table.name))
+        ).fetchone()[0] or 0
+        head = [id for id in head if id in stored]
+        self.connection.executemany(
+          'UPDATE {} SET position = ? WHERE id = ?'.format(quote(table.name)),
+          [(first - len(head) + i, id) for i, id in enumerate(head)]
+        )
+
+  def getIDs(self, table, ids=None):
+    """Return IDs of all the stored items (or only of those among the given)."""
+    query = 'SELECT id FROM {}'.format(quote(table.name))
+    if ids is None:
+      return [id for id, in self.connection.execute(query)]
+    ids = list(ids)
+    found = []
+    # SQLite limits the number of parameters of a single statement
+    for start in range(0, len(ids), 500):
+      chunk = ids[start:start+500]
+      found.extend(id for id, in self.connection.execute(
+        '{} WHERE id IN ({})'.format(query, ','.join('?' * len(chunk))), chunk
+      ))
+    return found
+
+  def upsert(self, table, records:list, positions):
+    """Insert or update the records, with their positions (or keeping the old ones)."""
+    keep_position = positions is None
+    if keep_position:
+      # new items get their positions afterwards
+      positions = [0] * len(records)
+    self.connection.executemany(
+      table.makeUpsert(keep_position),
+      [table.encodeRecord(record, position) for record, position in zip(records, positions)]
+    )
+    ids = [(record['id'],) for record in records]
+    for prop in table.lists:
+      junction = quote(table.junctions[prop])
+      self.connection.executemany('DELETE FROM {} WHERE item = ?'.format(junction), ids)
+      values = [
+        (value,) for record in records for value in record.get(prop, None) or ()
+      ]
+      self.connection.executemany(
+        'INSERT OR IGNORE INTO {} (value) VALUES (?)'.format(quote(prop)), values
+      )
+      self.connection.executemany(
+        'INSERT INTO {} (item, position, value) SELECT ?, ?, id FROM {} WHERE value = ?'.format(
+          junction, quote(prop)
+        ),
+        [
+          (record['id'], position, value)
+          for record in records
+          for position, value in enumerate(record.get(prop, None) or ())
+        ]
+      )
+
+  def load(self, itemtype:str):
+    """Return records of all the stored items of a type, in order."""
+    table = self.getTable(itemtype)
+    query = 'SELECT {} FROM {} ORDER BY position'.format(
+      ', '.join(quote(column) for column in table.columns), quote(table.name)
+    )
+    rows = self.connection.execute(query).fetchall()
+    values = {prop: self.loadValues(table, prop) for prop in table.lists}
+    return [table.decodeRow(row, values) for row in rows]
+
+  def loadValues(self, table, prop:str):
+    """Return values of a list property of all items, by the item ID."""
+    values = {}
+    query = 'SELECT j.item, v.value FROM {} j JOIN {} v ON v.id = j.value ORDER BY j.item, j.position'
+    for id, value in self.connection.execute(query.format(quote(table.junctions[prop]), quote(prop))):
+      values.setdefault(id, []).append(value)
+    return values
+
+  def select(self, itemtype:str, ranges:dict={}, values:dict={}, sorting:list=[]):
+    """Return IDs of the items that match the conditions, sorted.
+
+    Conditions are given by property names: ranges as (low, high) for scalar
+    properties (either can be None; items lacking the property never match),
+    values as (mode, values) for list properties, where mode is "any" (item has
+    at least one of the values), "all" (has all of them) or "exactly" (has all
+    of them and nothing else) - like the modes of the GenreFilter.
+    Sorting is a list of (property, ascending) pairs, most important first
+    (like SortingMachine.chain); missing values are the lowest, and equal items
+    remain in their order.
+    """
+    table = self.getTable(itemtype)
+    conditions = []
+    parameters = []
+    for prop, (low, high) in ranges.items():
+      column = quote(table.getScalar(prop))
+      conditions.append('{} IS NOT NULL'.format(column))
+      for bound, operator in [(low, '>='), (high, '<=')]:
+        if bound is not None:
+          conditions.append('{} {} ?'.format(column, operator))
+          parameters.append(table.encodeValue(bound))
+    for prop, (mode, selected) in values.items():
+      selected = sorted(set(selected))
+      matches = (
+        '(SELECT COUNT(DISTINCT j.value) FROM {} j JOIN {} v ON v.id = j.value'
+        ' WHERE j.item = t.id AND v.value IN ({}))'
+      ).format(quote(table.getJunction(prop)), quote(prop), ','.join('?' * len(selected)))
+      if mode == 'any':
+        conditions.append('{} > 0'.format(matches))
+      elif mode == 'all':
+        conditions.append('{} = {}'.format(matches, len(selected)))
+      elif mode == 'exactly':
+        conditions.append('{} = {} AND t.{} = {}'.format(
+          matches, len(selected), quote(table.counts[prop]), len(selected)
+        ))
+      else:
+        raise ValueError('Unknown mode of selection: {}'.format(mode))
+      parameters.extend(selected)
+    order = [
+      't.{} {}'.format(quote(table.getScalar(prop)), 'ASC' if ascending else 'DESC')
+      for prop, ascending in sorting
+    ]
+    query = 'SELECT t.id FROM {} t'.format(quote(table.name))
+    if conditions:
+      query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY ' + ', '.join(order + ['t.position'])
+    return [id for id, in self.connection.execute(query, parameters)]
+
+  # Databases
+  def saveDatabase(self, database, changes:list=None):
+    """Save the Items of a Database: all of them, or only the given changes.
+
+    Changes are those returned by Database.popChanges (None means that all the
+    items have been reloaded). They are not taken from the Database itself, so
+    as not to take them away from the user data journal.
+    """
+    if changes is None:
+      self.save(database.itemtype, [item.asDict() for item in database])
+    else:
+      self.applyChanges(database.itemtype, changes)
+
+  def restoreDatabase(self, database):
+    """Replace all Items of a Database with those stored."""
+    database.loadRecords(self.load(database.itemtype))
+
+  # Migration from and to the user data file
+  def getState(self, field:str):
+    """Return what version of a database from the user data file is stored.
+
+    That is the stamp of the database (see DataManager.makeStamp) and the
+    number of its changes from the journal, or None if it is not stored.
+    """
+    state = self.connection.execute(
+      'SELECT stamp, journaled FROM state WHERE field = ?', (field,)
+    ).fetchone()
+    return tuple(state) if state else None
+
+  def setState(self, field:str, stamp:int, journaled:int):
+    with self.connection:
+      self.connection.execute(
+        'INSERT OR REPLACE INTO state (field, stamp, journaled) VALUES (?, ?, ?)',
+        (field, stamp, journaled)
+      )
+
+  def migrate(self, userdata):
+    """Copy the databases from a UserData (and their changes from the journal)."""
+    for itemtype, field in self.FIELDS.items():
+      # until it is all copied, the database is not considered stored
+      with self.connection:
+        self.connection.execute('DELETE FROM state WHERE field = ?', (field,))
+      string = getattr(userdata, field)
+      if not string:
+        continue
+      self.save(itemtype, fastjson.loads(string))
+      changes = getattr(userdata, 'changes', {}).get(field, [])
+      if changes:
+        self.applyChanges(itemtype, changes)
+      self.setState(field, getattr(userdata, 'stamps', {}).get(field, None), len(changes))
+
+  def exportString(self, itemtype:str):
+    """Serialize the stored items of a type as Database.storeToString would."""
+    return fastjson.dumps(self.load(itemtype))
+
+  def close(self):
+    self.connection.close()
+
+
+class Table(object):
+  """Layout of the table of a single item type, derived from its Blueprints.
+
+  Translates records (see Item.asDict) to rows of the table and back.
+  """
+  TYPES = {'str': 'TEXT', 'date': 'TEXT'}
+
+  def __init__(self, itemtype:str):
+    self.itemclass = containers.classByString[itemtype]
+    self.name = itemtype.lower()
+    blueprints = self.itemclass.blueprints
+    self.scalars = [
+      name for name, blueprint in blueprints.items()
+      if blueprint.getKind() != 'list' and name != 'id'
+    ]
+    self.lists = [name for name, blueprint in blueprints.items() if blueprint.getKind() == 'list']
+    self.counts = {prop: '{}_count'.format(prop) for prop in self.lists}
+    self.junctions = {prop: '{}_{}'.format(self.name, prop) for prop in self.lists}
+    self.columns = ['id', 'position'] + self.scalars + [self.counts[prop] for prop in self.lists]
+
+  def getType(self, name:str):
+    kind = self.itemclass.blueprints[name].getKind()
+    if kind in self.TYPES.keys():
+      return self.TYPES[kind]
+    return 'REAL' if kind.startswith('float') else 'INTEGER'
+
+  def getScalar(self, prop:str):
+    if prop != 'id' and prop not in self.scalars:
+      raise KeyError('Not a scalar property of {}: {}'.format(self.name, prop))
+    return prop
+
+  def getJunction(self, prop:str):
+    if prop not in self.lists:
+      raise KeyError('Not a list property of {}: {}'.format(self.name, prop))
+    return self.junctions[prop]
+
+  def makeSchema(self):
+    """Return the statements creating the tables and indexes."""
+    columns = ['id INTEGER PRIMARY KEY', 'position INTEGER NOT NULL']
+    columns += ['{} {}'.format(quote(name), self.getType(name)) for name in self.scalars]
+    columns += ['{} INTEGER'.format(quote(self.counts[prop])) for prop in self.lists]
+    statements = ['CREATE TABLE IF NOT EXISTS {} ({})'.format(quote(self.name), ', '.join(columns))]
+    for prop in self.lists:
+      statements.append(
+        'CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, value TEXT UNIQUE NOT NULL)'.format(quote(prop))
+      )
+      statements.append((
+        'CREATE TABLE IF NOT EXISTS {} ('
+        'item INTEGER NOT NULL REFERENCES {} (id) ON DELETE CASCADE, '
+        'position INTEGER NOT NULL, '
+        'value INTEGER NOT NULL REFERENCES {} (id), '
+        'PRIMARY KEY (item, position))'
+      ).format(quote(self.junctions[prop]), quote(self.name), quote(prop)))
+      statements.append('CREATE INDEX IF NOT EXISTS {} ON {} (value, item)'.format(
+        quote(self.junctions[prop] + '_value'), quote(self.junctions[prop])
+      ))
+    for name in ['position'] + [name for name in SQLStore.INDEXED if name in self.scalars]:
+      statements.append('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+        quote('{}_{}'.format(self.name, name)), quote(self.name), quote(name)
+      ))
+    return statements
+
+  def makeUpsert(self, keep_position:bool=False):
+    updated = [column for column in self.columns[1:] if not (keep_position and column == 'position')]
+    return 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT (id) DO UPDATE SET {}'.format(
+      quote(self.name),
+      ', '.join(quote(column) for column in self.columns),
+      ', '.join('?' * len(self.columns)),
+      ', '.join('{0} = excluded.{0}'.format(quote(column)) for column in updated)
+    )
+
+  def encodeValue(self, value):
+    if isinstance(value, date):
+      return value.isoformat()
+    return value
+
+  def encodeRecord(self, record:dict, position:int):
+    """Return values of the columns of the row holding a record."""
+    values = {name: record.get(name, None) for name in self.scalars}
+    rating = record.get('userdata', {}).get('rating', None)
+    if rating is not None:
+      dateOf = rating['dateOf']
+      values['rating'] = rating['rating']
+      values['comment'] = rating['comment']
+      values['faved'] = rating['faved']
+      values['dateOf'] = date(year=dateOf['y'], month=dateOf['m'], day=dateOf['d']).isoformat()
+    for prop in self.lists:
+      value = record.get(prop, None)
+      values[self.counts[prop]] = len(value) if value is not None else None
+    return [record['id'], position] + [values[column] for column in self.columns[2:]]
+
+  def decodeRow(self, row:tuple, values:dict):
+    """Reconstruct a record from a row, and values of the list properties by ID."""
+    columns = dict(zip(self.columns, row))
+    record = {}
+    for name in self.itemclass.storables:
+      if name in self.lists:
+        if columns[self.counts[name]] is not None:
+          record[name] = values[name].get(columns['id'], [])
+      elif columns[name] is not None:
+        record[name] = columns[name]
+    record['userdata'] = {}
+    if columns['rating'] is not None:
+      dateOf = date.fromisoformat(columns['dateOf'])
+      record['userdata']['rating'] = {
+        'rating':  columns['rating'],
+        'comment': columns['comment'],
+        'dateOf':  {'y': dateOf.year, 'm': dateOf.month, 'd': dateOf.day},
+        'faved':   columns['faved']
+      }
+    return record
@@ -0,0 +1,194 @@
+import numpy as np
+
+
+class RatingStats(object):
+  """Statistics of a set of ratings, all derived from their histogram.
+
+  Histogram holds the count of each rating value, from 0 (no rating) up. Items
+  with no rating are counted, but do not contribute to the mean and median.
+  """
+  def __init__(self, histogram:np.ndarray):
+    self.histogram = histogram
+    self.count = int(histogram.sum())
+    self.rated = self.count - int(histogram[0])
+    if self.rated:
+      self.mean = float(np.dot(np.arange(len(histogram)), histogram)) / self.rated
+      self.median = self.findMedian()
+    else:
+      self.mean = 0.0
+      self.median = 0.0
+
+  def findMedian(self):
+    # the middle one (or two) of the sorted ratings, found in the cumulative sum
+    cumulative = np.cumsum(self.histogram[1:])
+    lower = np.searchsorted(cumulative, (self.rated - 1) // 2, side='right') + 1
+    upper = np.searchsorted(cumulative, self.rated // 2, side='right') + 1
+    return float(lower + upper) / 2
+
+
+class StatEngine(object):
+  """Computes statistics of ratings of the items that have passed the filters.
+
+  The whole computation is a single numpy.bincount over the rating column of a
+  ColumnStore, restricted to the rows selected by a boolean mask. Result of the
+  last computation is remembered, so that asking again for the same rows (e.g.
+  when only the sorting has changed) costs nothing.
+  """
+  RATINGS = 11 # 0 (no rating) to 10
+
+  def __init__(self):
+    self.store = None
+    self.mask = None
+    self.stats = None
+
+  @classmethod
+  def computeStats(cls, ratings:np.ndarray):
+    # missing ratings are stored as negative numbers - count them as no rating
+    histogram = np.bincount(np.maximum(ratings, 0), minlength=cls.RATINGS)
+    return RatingStats(histogram)
+
+  def compute(self, store, mask:np.ndarray):
+    """Return statistics of the selected rows and whether they have changed."""
+    if store is self.store and self.mask is not None and np.array_equal(mask, self.mask):
+      return self.stats, False
+    self.store = store
+    self.mask = mask.copy()
+    self.stats = self.computeStats(store.getColumn('rating').values[mask])
+    return self.stats, True
+
+
+class Grouping(object):
+  """Assignment of rows of a ColumnStore to groups (e.g. years, genres).
+
+  Held as two parallel arrays of (row, group code) pairs, since a single row
+  can belong to many groups (e.g. a movie of two genres) or to none at all.
+  """
+  # ordinal of 1970-01-01, numpy's epoch
+  EPOCH = 719163
+
+  def __init__(self, rows:np.ndarray, codes:np.ndarray, labels:list):
+    self.rows = rows
+    self.codes = codes
+    self.labels = labels
+
+  @classmethod
+  def single(cls, store):
+    """All rows in one group."""
+    length = len(store)
+    return cls(np.arange(length), np.zeros(length, dtype=np.int64), [''])
+
+  @classmethod
+  def byYear(cls, store, name:str='dateOf'):
+    """Rows grouped by the year of a date column (rows with no date are left out)."""
+    ordinals = store.getColumn(name).values
+    rows = np.flatnonzero(ordinals > 0)
+    days = (ordinals[rows] - cls.EPOCH).astype('datetime64[D]')
+    years = days.astype('datetime64[Y]').astype(np.int64) + 1970
+    labels, codes = np.unique(years, return_inverse=True)
+    return cls(rows, codes.reshape(-1), [int(year) for year in labels])
+
+  @classmethod
+  def byValues(cls, store, name:str):
+    """Rows grouped by values of a list column (e.g. each genre is a group)."""
+    rows = []
+    codes = []
+    code_of = {}
+    for row, values in enumerate(store.getColumn(name).values):
+      for value in values or ():
+        rows.append(row)
+        codes.append(code_of.setdefault(value, len(code_of)))
+    return cls(np.array(rows, dtype=np.int64), np.array(codes, dtype=np.int64), list(code_of.keys()))
+
+
+class Aggregate(object):
+  """Count and sum of some per-row variable in each group, over selected rows.
+
+  The sums can be updated incrementally: rows can be added to the selection
+  and removed from it, at a cost proportional to the number of those rows.
+  """
+  def __init__(self, grouping:Grouping, values:np.ndarray, valid:np.ndarray):
+    self.grouping = grouping
+    # only the pairs whose rows have a valid value are ever counted
+    pairs = valid[grouping.rows]
+    self.rows = grouping.rows[pairs]
+    self.codes = grouping.codes[pairs]
+    self.values = values[self.rows]
+    self.clear()
+
+  def clear(self):
+    size = len(self.grouping.labels)
+    self.counts = np.zeros(size, dtype=np.int64)
+    self.sums = np.zeros(size, dtype=np.float64)
+
+  def add(self, selected:np.ndarray, sign:int=1):
+    """Add (or, with sign=-1, remove) the selected rows, given as a boolean mask."""
+    pairs = selected[self.rows]
+    codes = self.codes[pairs]
+    size = len(self.counts)
+    self.counts += sign * np.bincount(codes, minlength=size)
+    self.sums += sign * np.bincount(codes, weights=self.values[pairs], minlength=size)
+
+  def getTotal(self):
+    """Return the count and the sum in the first group (see Grouping.single)."""
+    return int(self.counts[0]), float(self.sums[0])
+
+  def getGroups(self):
+    """Return (label, count, mean) of each non-empty group."""
+    present = np.flatnonzero(self.counts > 0)
+    means = self.sums[present] / self.counts[present]
+    return [
+      (self.grouping.labels[code], int(self.counts[code]), float(mean))
+      for code, mean in zip(present, means)
+    ]
+
+
+class AggregateEngine(object):
+  """Grouped aggregates of the items that have passed the filters.
+
+  For each store, computes rating per year of watching, per genre, and (if the
+  items have such properties) per country and director, as well as the total
+  duration and the difference between user's and Filmweb's ratings. When the
+  selection changes, only the rows that entered or left it are accounted for,
+  unless they are so many that recomputing from scratch would be cheaper.
+  """
+  GROUPS = ['genres', 'countries', 'directors']
+
+  def __init__(self):
+    self.store = None
+    self.mask = None
+    self.aggregates = {}
+
+  def makeAggregates(self, store):
+    ratings = store.getColumn('rating').values.astype(np.float64)
+    rated = ratings > 0
+    self.aggregates = {'years': Aggregate(Grouping.byYear(store), ratings, rated)}
+    for name in self.GROUPS:
+      if name in store.columns.keys():
+        self.aggregates[name] = Aggregate(Grouping.byValues(store, name), ratings, rated)
+    if 'duration' in store.columns.keys():
+      duration = store.getColumn('duration')
+      values = duration.values.astype(np.float64)
+      self.aggregates['duration'] = Aggregate(Grouping.single(store), values, duration.present())
+    fwRatings = store.getColumn('fwRating')
+    self.aggregates['delta'] = Aggregate(
+      Grouping.single(store), ratings - fwRatings.values, rated & fwRatings.present()
+    )
+
+  def compute(self, store, mask:np.ndarray):
+    """Update the aggregates for the selected rows and return them (by name)."""
+    if store is not self.store:
+      self.store = store
+      self.mask = np.zeros(len(store), dtype=bool)
+      self.makeAggregates(store)
+    added = mask & ~self.mask
+    removed = self.mask & ~mask
+    if np.count_nonzero(added) + np.count_nonzero(removed) < np.count_nonzero(mask):
+      for aggregate in self.aggregates.values():
+        aggregate.add(added)
+        aggregate.add(removed, sign=-1)
+    else:
+      for aggregate in self.aggregates.values():
+        aggregate.clear()
+        aggregate.add(mask)
+    self.mask = mask.copy()
+    return self.aggregates
@@ -1,23 +1,191 @@
-from PIL import Image, ImageTk
-import matplotlib.pyplot as plt
-import statistics
+from math import ceil, floor, log10
 import tkinter as tk
+from tkinter import ttk
+
+import containers
+from statengine import AggregateEngine, StatEngine
+
+
+class Histogram(object):
+  """Bar chart of a rating histogram, drawn directly on a tk.Canvas.
+
+  All the canvas items (bars, grid lines, labels) are created once, and each
+  update only moves the bars and the grid lines, and changes the labels of the
+  latter. This is much faster than drawing a whole new chart every time.
+  """
+  WIDTH = 600
+  HEIGHT = 300
+  MARGINS = (40, 10, 10, 25) # left, top, right, bottom
+  TICKS = 5 # maximum number of horizontal grid lines (above zero)
+  LABELS = ['brak'] + [str(i) for i in range(1, 11)]
+  BAR_COLOR = '#1f77b4'
+  GRID_COLOR = '#b0b0b0'
+
+  def __init__(self, canvas):
+    self.canvas = canvas
+    left, top, right, bottom = self.MARGINS
+    self.x0 = left
+    self.x1 = self.WIDTH - right
+    self.y0 = self.HEIGHT - bottom # the zero line
+    self.height = self.y0 - top
+    # grid lines go first, so that they are drawn behind the bars
+    self.grid = []
+    for _ in range(self.TICKS + 1):
+      line = canvas.create_line(self.x0, self.y0, self.x1, self.y0, fill=self.GRID_COLOR)
+      label = canvas.create_text(self.x0 - 5, self.y0, text='', anchor=tk.E)
+      self.grid.append((line, label))
+    slot = (self.x1 - self.x0) / len(self.LABELS)
+    self.bars = []
+    for i, text in enumerate(self.LABELS):
+      center = self.x0 + slot * (i + 0.5)
+      left, right = center - slot / 4, center + slot / 4
+      bar = canvas.create_rectangle(left, self.y0, right, self.y0, fill=self.BAR_COLOR, width=0)
+      canvas.create_text(center, self.y0 + 5, text=text, anchor=tk.N)
+      self.bars.append((bar, left, right))
+    canvas.create_line(self.x0, self.y0, self.x1, self.y0)
+    self.message = canvas.create_text(self.WIDTH / 2, self.HEIGHT / 2, text='')
+
+  @staticmethod
+  def makeStep(maximum:int, count:int):
+    """Find a round step (1, 2 or 5 times a power of 10) to cover maximum in count steps."""
+    if maximum <= count:
+      return 1
+    raw = maximum / count
+    power = 10 ** floor(log10(raw))
+    for multiple in [1, 2, 5, 10]:
+      if multiple * power >= raw:
+        return int(multiple * power)
+
+  def update(self, values:list):
+    maximum = int(max(values))
+    step = self.makeStep(maximum, self.TICKS)
+    top = step * max(ceil(maximum / step), 1)
+    scale = self.height / top
+    for (bar, left, right), value in zip(self.bars, values):
+      self.canvas.coords(bar, left, self.y0 - value * scale, right, self.y0)
+    for i, (line, label) in enumerate(self.grid):
+      tick = i * step
+      if tick > top:
+        self.canvas.itemconfigure(line, state=tk.HIDDEN)
+        self.canvas.itemconfigure(label, state=tk.HIDDEN)
+        continue
+      y = self.y0 - tick * scale
+      self.canvas.coords(line, self.x0, y, self.x1, y)
+      self.canvas.coords(label, self.x0 - 5, y)
+      self.canvas.itemconfigure(line, state=tk.NORMAL)
+      self.canvas.itemconfigure(label, state=tk.NORMAL, text=str(tick))
+    self.canvas.itemconfigure(self.message, text='')
+
+  def notify(self, text:str):
+    self.canvas.itemconfigure(self.message, text=text)
+
+
+class StatPanel(object):
+  """Window with detailed statistics of the displayed items.
+
+  Shows the mean rating per year of watching, per genre, country and director
+  (as far as the items have such properties), total duration of the items and
+  how do the user's ratings compare to Filmweb's. All of these are computed by
+  an AggregateEngine, and only when the window is visible.
+  """
+  TOP = 30 # number of genres, countries, directors to show (most frequent)
+  HEADINGS = {
+    'years': 'Rok obejrzenia',
+    'genres': 'Gatunek',
+    'countries': 'Kraj produkcji',
+    'directors': 'Reżyser',
+  }
+  DURATION = 'Łączny czas: {}'
+  DELTA = 'Twoje oceny różnią się od ocen Filmwebu średnio o {:+.2f} (porównano {}).'
+
+  def __init__(self, itemtype:str):
+    self.itemtype = itemtype
+    self.engine = AggregateEngine()
+    self.store = None
+    self.mask = None
+    self.__construct()
+  def __construct(self):
+    self.window = tk.Toplevel()
+    self.window.title('Statystyki')
+    self.window.resizable(False, False)
+    self.window.protocol('WM_DELETE_WINDOW', self.window.withdraw)
+    self.summary = tk.Label(self.window, text='', justify=tk.LEFT)
+    self.summary.grid(row=0, column=0, columnspan=len(self.HEADINGS), padx=5, sticky=tk.NW)
+    blueprints = containers.classByString[self.itemtype].blueprints
+    self.tables = {}
+    for name, heading in self.HEADINGS.items():
+      if name != 'years' and name not in blueprints.keys():
+        continue
+      frame = tk.Frame(self.window)
+      table = ttk.Treeview(frame, height=20, selectmode='none', columns=['name', 'count', 'mean'])
+      table.column(column='#0', width=0, stretch=False)
+      table.column(column='name', width=150, stretch=False)
+      table.column(column='count', width=50, stretch=False)
+      table.column(column='mean', width=60, stretch=False)
+      table.heading(column='name', text=heading, anchor=tk.W)
+      table.heading(column='count', text='Liczba', anchor=tk.W)
+      table.heading(column='mean', text='Średnia', anchor=tk.W)
+      table.pack(side=tk.LEFT)
+      scroll = ttk.Scrollbar(frame, command=table.yview)
+      scroll.pack(side=tk.RIGHT, fill=tk.Y)
+      table.configure(yscrollcommand=scroll.set)
+      frame.grid(row=1, column=len(self.tables), padx=5, pady=5, sticky=tk.N)
+      self.tables[name] = table
+    self.window.withdraw()
+  def popUp(self):
+    self.window.deiconify()
+    self.refresh()
+  def update(self, store, mask):
+    # remember the selection, but only compute anything if it can be seen
+    self.store = store
+    self.mask = mask
+    if self.window.state() == 'normal':
+      self.refresh()
+  def refresh(self):
+    if self.store is None:
+      return
+    aggregates = self.engine.compute(self.store, self.mask)
+    for name, table in self.tables.items():
+      groups = aggregates[name].getGroups()
+      if name == 'years':
+        groups.sort(key=lambda group: group[0], reverse=True)
+      else:
+        groups.sort(key=lambda group: group[1], reverse=True)
+        groups = groups[:self.TOP]
+      children = table.get_children()
+      if children:
+        table.delete(*children)
+      for label, count, mean in groups:
+        table.insert(parent='', index=tk.END, values=[label, count, '{:.2f}'.format(mean)])
+    lines = []
+    # duration of a series is that of a single episode, so a sum makes no sense
+    if 'duration' in aggregates.keys() and self.itemtype != 'Series':
+      _, total = aggregates['duration'].getTotal()
+      lines.append(self.DURATION.format(containers.Blueprint._duration(int(total))))
+    count, total = aggregates['delta'].getTotal()
+    if count:
+      lines.append(self.DELTA.format(total / count, count))
+    self.summary['text'] = '\n'.join(lines)
+
 
 class StatView(object):
   STRINGS = {
     'Movie': {
       'summary': 'Wyświetlono {} z {} filmów.',
       'average': 'Średnia ocena wyświetlonych: {:.2f}',
+      'median': 'Mediana ocen wyświetlonych: {:.1f}',
       'missing': 'Wygląda na to, że nic tu nie ma.\nMożliwe, że nie masz ocenionych żadnych filmów?'
     },
     'Series': {
       'summary': 'Wyświetlono {} z {} seriali.',
       'average': 'Średnia ocena wyświetlonych: {:.2f}',
+      'median': 'Mediana ocen wyświetlonych: {:.1f}',
       'missing': 'Wygląda na to, że nic tu nie ma.\nMożliwe, że nie masz ocenionych żadnych seriali?'
     },
     'Game': {
       'summary': 'Wyświetlono {} z {} gier.',
       'average': 'Średnia ocena wyświetlonych: {:.2f}',
+      'median': 'Mediana ocen wyświetlonych: {:.1f}',
       'missing': 'Wygląda na to, że nic tu nie ma.\nMożliwe, że nie masz ocenionych żadnych gier?'
     }
   }
@@ -29,59 +197,43 @@ class StatView(object):
     self.summary.grid(row=0, column=0, sticky=tk.NW)
     self.average = tk.Label(self.main, text='')
     self.average.grid(row=1, column=0, sticky=tk.NW)
-    self.plot = tk.Label(self.main, text='', anchor=tk.CENTER)
-    self.plot.grid(row=2, column=0, sticky=tk.N)
-    self.figure = None
-    self.image = None
+    self.median = tk.Label(self.main, text='')
+    self.median.grid(row=2, column=0, sticky=tk.NW)
+    canvas = tk.Canvas(self.main, width=Histogram.WIDTH, height=Histogram.HEIGHT,
+      background='white', highlightthickness=0
+    )
+    canvas.grid(row=3, column=0, sticky=tk.N)
+    self.histogram = Histogram(canvas)
+    self.panel = StatPanel(itemtype)
+    ttk.Button(self.main, text='Więcej statystyk', command=self.panel.popUp).grid(
+      row=2, column=0, sticky=tk.NE
+    )
+    self.engine = StatEngine()
     self.strings = self.STRINGS[itemtype]
     self.everHadItems = False
-  def update(self, items:list):
-    item_count = len(items)
-    if item_count:
+  def update(self, store, mask):
+    # calculate statistics of the rows that passed the filters
+    stats, changed = self.engine.compute(store, mask)
+    if not changed:
+      return
+    if stats.count:
       self.everHadItems = True
     if not self.everHadItems:
       self.noItemsNotify()
       return
-    # calculate statistics
-    if item_count > self.total_length:
-      self.total_length = item_count # effectively: set total DB size *once*
-    item_histo = [0 for i in range(11)]
-    for item in items:
-      rating = item.getRawProperty('rating')
-      item_histo[rating] += 1
+    self.total_length = len(store)
     # update summaries and graphics
-    self.summary['text'] = self.strings['summary'].format(item_count, self.total_length)
-    self.printMeanRating(items)
-    self.drawHistogram(item_histo)
-  def printMeanRating(self, items:list):
-    ratings = [item.getRawProperty('rating') for item in items]
-    ratings = [r for r in ratings if r > 0]
-    fmt_str = self.strings['average']
-    if len(ratings) == 0:
-      mean = 0.0
-    else:
-      mean = statistics.mean(ratings)
-    self.average['text'] = fmt_str.format(mean)
+    self.summary['text'] = self.strings['summary'].format(stats.count, self.total_length)
+    self.printMeanRating(stats)
+    self.drawHistogram(stats.histogram)
+    self.panel.update(store, mask)
+  def printMeanRating(self, stats):
+    self.average['text'] = self.strings['average'].format(stats.mean)
+    self.median['text'] = self.strings['median'].format(stats.median)
   def drawHistogram(self, values):
-    # draw
-    if self.figure is None:
-      self.figure = plt.figure(figsize=(6,3))
-    self.figure.clf()
-    ax = self.figure.add_subplot(111)
-    ax.bar(range(11), values, width=0.5, zorder=1.0)
-    ax.grid(True, which='major', axis='y')
-    self.figure.axes[0].set_xticks(range(11))
-    self.figure.axes[0].set_xticklabels(['brak'] + [str(i) for i in range(1,11,1)])
-    # prepare for display
-    self.figure.canvas.draw()
-    w,h = self.figure.canvas.get_width_height()
-    idata = Image.frombytes('RGB', (w,h), self.figure.canvas.tostring_rgb())
-    self.image = ImageTk.PhotoImage('RGB', idata.size)
-    self.image.paste(idata)
-    # assign to label
-    self.plot.configure(image=self.image)
+    self.histogram.update(values)
   def noItemsNotify(self):
-    self.plot['text'] = self.strings['missing']
+    self.histogram.notify(self.strings['missing'])
 
   # TK interface
   def grid(self, **grid_args):
@@ -0,0 +1,107 @@
+from collections import defaultdict
+import unicodedata
+
+# Letters that do not decompose into a base letter and a diacritic
+FOLDING = str.maketrans({'ł': 'l', 'đ': 'd', 'ø': 'o'})
+
+
+def fold(text:str):
+  """Casefold a string and strip all diacritics (e.g. "Łódź" -> "lodz")."""
+  text = unicodedata.normalize('NFKD', text.casefold().translate(FOLDING))
+  return ''.join(char for char in text if not unicodedata.combining(char))
+
+
+class TitleIndex(object):
+  """Trigram index answering substring queries over titles of all Items.
+
+  Both the title and the original title of each Item are folded (see fold) and
+  each of their trigrams maps to a set of IDs of Items containing it. A query
+  intersects the sets of its own trigrams, which gives a (usually very small)
+  set of candidates, and only those have their texts checked directly. Queries
+  shorter than a trigram cannot use the index and fall back to a linear scan
+  over the folded texts.
+
+  The index is keyed by Item IDs, not store rows, so that it can be updated
+  incrementally: update(store) only reindexes the Items whose titles differ
+  from what has been indexed before.
+  """
+  N = 3
+  SEPARATOR = '\n'
+
+  def __init__(self):
+    self.sources = {} # id -> (title, otitle), as they were indexed
+    self.texts = {}   # id -> folded, searchable text
+    self.grams = defaultdict(set)
+
+  def __len__(self):
+    return len(self.texts)
+
+  @classmethod
+  def makeGrams(cls, text:str):
+    return {text[i:i+cls.N] for i in range(len(text) - cls.N + 1)}
+
+  @staticmethod
+  def getStrings(store, name:str):
+    if name not in store.columns.keys():
+      return [None] * len(store)
+    return store.getColumn(name).values
+
+  def update(self, store):
+    """Synchronize the index with the contents of a ColumnStore.
+
+    Returns the number of Items that had to be (re- or un-)indexed.
+    """
+    ids = store.getColumn('id').values.tolist()
+    titles = self.getStrings(store, 'title')
+    otitles = self.getStrings(store, 'otitle')
+    changed = 0
+    current = set()
+    for iid, title, otitle in zip(ids, titles, otitles):
+      current.add(iid)
+      source = (title, otitle)
+      if self.sources.get(iid, None) != source:
+        self.remove(iid)
+        self.add(iid, source)
+        changed += 1
+    for iid in set(self.sources.keys()) - current:
+      self.remove(iid)
+      changed += 1
+    return changed
+
+  def add(self, iid:int, source:tuple):
+    # separate the titles so that no match spans both of them
+    text = self.SEPARATOR.join(fold(string) for string in source if string)
+    self.sources[iid] = source
+    self.texts[iid] = text
+    for gram in self.makeGrams(text):
+      self.grams[gram].add(iid)
+
+  def remove(self, iid:int):
+    self.sources.pop(iid, None)
+    text = self.texts.pop(iid, None)
+    if text is None:
+      return
+    for gram in self.makeGrams(text):
+      ids = self.grams[gram]
+      ids.discard(iid)
+      if not ids:
+        del self.grams[gram]
+
+  def search(self, query:str):
+    """Return a set of IDs of Items whose title or original title contain the query."""
+    query = fold(query)
+    if self.SEPARATOR in query:
+      return set()
+    if len(query) < self.N:
+      return {iid for iid, text in self.texts.items() if query in text}
+    postings = []
+    for gram in self.makeGrams(query):
+      ids = self.grams.get(gram, None)
+      if not ids:
+        return set()
+      postings.append(ids)
+    postings.sort(key=len)
+    candidates = postings[0].intersection(*postings[1:])
+    # trigrams can all be there without forming the query string
+    texts = self.texts
+    return {iid for iid in candidates if query in texts[iid]}
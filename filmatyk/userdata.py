@@ -28,6 +28,29 @@ UserData instance and fills it with data. This function is responsible for
 translation of the old data format (as seen in the file) to the current format
 (as required by UserData and thus Main).
 
+Since 1.0.0-beta.5, the file is binary (see SectionFile): a table of contents
+followed by separately compressed sections, one per UserData field. Only the
+container is binary - each section holds the same text as the lines of the old
+files did (e.g. a database is still its JSON string). Loaders of such files are
+registered with binary=True, and instead of the lines of a text file, they
+receive the SectionFile itself. This lets them read the sections
+lazily - e.g. a database is only read from disk and decompressed when Main
+first needs it (see LazyUserData). Loaders of the text files are still used
+for files saved by the previous versions.
+
+Most of the time, nothing needs to be saved but a few small changes (e.g. a new
+session, a few new ratings). These are only appended to a journal next to the
+file (see DataManager.appendChanges), which is replayed after the file has
+been loaded. Once the journal grows big, Main saves everything to a new file,
+and the journal is removed.
+
+Restoring a database from its section still means decoding all of it. So once
+a database has been restored, Main also dumps it to a snapshot file (see
+snapshot.py), which the next run can use right away, without even reading the
+section. Snapshots are named after the stamp of the database they were made of
+(a checksum, saved in the file along with the databases) and the number of its
+changes from the journal that they include (see DataManager.findSnapshot).
+
 If a new version changes the UserData layout, the DataManager.save method must
 be updated to reflect that. Additionally, all previously registered loaders
 must be able to return the new object. When adding a new element to UserData,
@@ -36,13 +59,26 @@ layout removes some fields... this will need special handling - probably for
 *all* legacy loaders.
 """
 
+import json
 import os
+import struct
+import zlib
 from collections import OrderedDict
 from semantic_version import Version
 
 
 class UserData(object):
   """User data wrapper with simple semantics (simpler than a dict)."""
+  # all the fields that are saved, in order
+  FIELDS = [
+    'username', 'options_json', 'session_pkl',
+    'movies_conf', 'movies_data',
+    'series_conf', 'series_data',
+    'games_conf', 'games_data',
+  ]
+  # fields holding the databases
+  DATABASES = ['movies_data', 'series_data', 'games_data']
+
   def __init__(
     self,
     username='',
@@ -66,60 +102,236 @@ class UserData(object):
     self.games_conf = games_conf
     self.games_data = games_data
     self.is_empty = is_empty
+    # changes of the databases, read from the journal (see DataManager.replayJournal)
+    self.changes = {}
+    # stamps of the databases, by field (see DataManager.makeStamp)
+    self.stamps = {}
+    # fields that could not be read, and are default instead (see LazyUserData)
+    self.damaged = set()
+
+
+class LazyUserData(UserData):
+  """UserData whose fields are only read from a SectionFile when first accessed.
+
+  Fields that the file has no section for keep their default values. So do the
+  fields whose sections cannot be read (as would the whole data, if the file
+  could not be read at load time) - these are listed in damaged.
+  """
+  def __init__(self, sections):
+    super(LazyUserData, self).__init__()
+    self.sections = sections
+    # drop the defaults, so that accessing these falls through to __getattr__
+    for name in self.FIELDS:
+      if name in sections:
+        delattr(self, name)
+    # files saved before the stamps were introduced simply have none
+    if 'stamps' in sections:
+      try:
+        self.stamps = json.loads(sections.read('stamps'))
+      except (ValueError, zlib.error):
+        self.stamps = {}
+
+  def __getattr__(self, name):
+    # only called for the attributes that have not been read yet
+    if name == 'sections' or name not in self.sections:
+      raise AttributeError(name)
+    try:
+      value = self.sections.read(name)
+    except (OSError, ValueError, KeyError, zlib.error):
+      print("User data reading error.")
+      value = getattr(UserData(), name)
+      self.damaged.add(name)
+      # whatever the snapshots of this field hold, it's not the default
+      self.stamps.pop(name, None)
+    setattr(self, name, value)
+    return value
+
+
+class SectionFile(object):
+  """Binary file of named, separately compressed text sections.
+
+  Layout: a header (magic string, format revision and number of sections), a
+  table of contents with name, offset and length of each section, then the
+  sections themselves, each a zlib-compressed UTF-8 string. Any section can be
+  read without reading (or decompressing) any other.
+  """
+  MAGIC = b'FILMATYK'
+  REVISION = 1
+  HEADER = struct.Struct('<8sHH')
+  ENTRY = struct.Struct('<16sQQ')
+
+  def __init__(self, path:str):
+    self.path = path
+    self.table = self.readTable()
+
+  @classmethod
+  def isSectionFile(cls, path:str):
+    """Check whether the file starts with the magic string."""
+    with open(path, 'rb') as sfile:
+      return sfile.read(len(cls.MAGIC)) == cls.MAGIC
+
+  @classmethod
+  def write(cls, path:str, sections:list):
+    """Write a list of (name, string) sections to a new file."""
+    blobs = [(name, zlib.compress(text.encode('utf-8'))) for name, text in sections]
+    offset = cls.HEADER.size + cls.ENTRY.size * len(blobs)
+    with open(path, 'wb') as sfile:
+      sfile.write(cls.HEADER.pack(cls.MAGIC, cls.REVISION, len(blobs)))
+      for name, blob in blobs:
+        sfile.write(cls.ENTRY.pack(name.encode('ascii'), offset, len(blob)))
+        offset += len(blob)
+      for _, blob in blobs:
+        sfile.write(blob)
+
+  def readTable(self):
+    """Read the table of contents: (offset, length) of each section, by name."""
+    with open(self.path, 'rb') as sfile:
+      magic, revision, count = self.HEADER.unpack(sfile.read(self.HEADER.size))
+      if magic != self.MAGIC or revision > self.REVISION:
+        raise ValueError('Not a user data file of a known revision')
+      entries = [self.ENTRY.unpack(sfile.read(self.ENTRY.size)) for _ in range(count)]
+    return {
+      name.rstrip(b'\0').decode('ascii'): (offset, length)
+      for name, offset, length in entries
+    }
+
+  def __contains__(self, name:str):
+    return name in self.table.keys()
+
+  def read(self, name:str):
+    """Read and decompress a single section."""
+    # the file might have been saved again since it was opened
+    self.table = self.readTable()
+    offset, length = self.table[name]
+    with open(self.path, 'rb') as sfile:
+      sfile.seek(offset)
+      blob = sfile.read(length)
+    return zlib.decompress(blob).decode('utf-8')
 
 
 class DataManager(object):
   """Backwards-compatibility preserving interface for user data management.
 
   Loaders should put themselves in the "loaders" list as tuples:
-    (callable, version)
-  so that we can construct an OrderedDict from them at init. The class method
+    (callable, version, binary)
+  so that we can construct OrderedDicts from them at init (one for the loaders
+  of text files and one for binary files). The class method
   registerLoaderSince does it automatically and is designed to be used as a
   decorator around a loader.
   """
   all_loaders = []
+  JOURNAL_MIN = 64 * 2**10 # bytes - a journal smaller than that is never compacted
+  JOURNAL_RATIO = 0.25 # nor one smaller than this fraction of the file
 
   def __init__(self, userDataPath:str, version:str):
     self.path = userDataPath
+    self.journal_path = userDataPath + '.journal'
     self.version = version
-    self.loaders = self.__orderLoaders()
+    self.loaders = self.__orderLoaders(binary=False)
+    self.binary_loaders = self.__orderLoaders(binary=True)
 
-  def __orderLoaders(self):
-    """Create an OrderedDict of loaders, ordered by version strings."""
+  def __orderLoaders(self, binary:bool):
+    """Create an OrderedDict of loaders of a given kind, ordered by version strings."""
     ordered_loaders = OrderedDict()
     # Sort by version
     self.all_loaders.sort(key=lambda x: x[1])
-    for loader, version in self.all_loaders:
-      ordered_loaders[version] = loader
+    for loader, version, is_binary in self.all_loaders:
+      if is_binary == binary:
+        ordered_loaders[version] = loader
     return ordered_loaders
 
   def save(self, userData):
     """Save the user data in the most recent format."""
+    # Collect the data first - it might still be read lazily from the old file
+    sections = [('version', self.version)]
+    sections += [(name, getattr(userData, name)) for name in UserData.FIELDS]
+    sections.append(('stamps', json.dumps(userData.stamps)))
     # Safety feature against failing to write new data and removing the old
     if os.path.exists(self.path):
       os.rename(self.path, self.path + '.bak')
     # Now actually write data to disk
-    with open(self.path, 'w') as user_file:
-      user_file.write('#VERSION\n')
-      user_file.write(self.version + '\n')
-      user_file.write('#USERNAME\n')
-      user_file.write(userData.username + '\n')
-      user_file.write('#OPTIONS\n')
-      user_file.write(userData.options_json + '\n')
-      user_file.write('#SESSION\n')
-      user_file.write(userData.session_pkl + '\n')
-      user_file.write('#MOVIES\n')
-      user_file.write(userData.movies_conf + '\n')
-      user_file.write(userData.movies_data + '\n')
-      user_file.write('#SERIES\n')
-      user_file.write(userData.series_conf + '\n')
-      user_file.write(userData.series_data + '\n')
-      user_file.write('#GAMES\n')
-      user_file.write(userData.games_conf + '\n')
-      user_file.write(userData.games_data + '\n')
+    SectionFile.write(self.path, sections)
     # If there were no errors at point, new data has been successfully written
     if os.path.exists(self.path + '.bak'):
       os.remove(self.path + '.bak')
+    # The file now holds all the changes from the journal. Should anything fail
+    # before the journal is removed, replaying it again will change nothing.
+    if os.path.exists(self.journal_path):
+      os.remove(self.journal_path)
+
+  @staticmethod
+  def makeStamp(text:str):
+    """Compute the stamp of a database, identifying its snapshots."""
+    return zlib.crc32(text.encode('utf-8'))
+
+  def snapshotPath(self, field:str, stamp:int, journaled:int):
+    """Path of a snapshot of a database with a number of journaled changes.
+
+    Every snapshot gets a new name, instead of replacing an older one, which
+    might still be mapped into memory (and as such cannot be replaced on some
+    systems).
+    """
+    return '{}.{}.{:08x}-{}.snap'.format(self.path, field, stamp, journaled)
+
+  def findSnapshot(self, field:str, stamp:int, max_count:int):
+    """Find the most recent snapshot of a database, given the journal length.
+
+    Returns the path of the snapshot including the most of the journaled
+    changes (but not more than there are), and their number - or (None, 0) if
+    there is no snapshot at all.
+    """
+    for journaled in range(max_count, -1, -1):
+      path = self.snapshotPath(field, stamp, journaled)
+      if os.path.exists(path):
+        return path, journaled
+    return None, 0
+
+  def removeSnapshots(self, field:str, keep:str=None):
+    """Remove the snapshots of a database, except for the given one.
+
+    Removing a snapshot still in use can fail on some systems - such are left
+    for some next time.
+    """
+    directory, name = os.path.split(os.path.abspath(self.path))
+    prefix = '{}.{}.'.format(name, field)
+    for filename in os.listdir(directory):
+      path = os.path.join(directory, filename)
+      if not filename.startswith(prefix) or not filename.endswith('.snap'):
+        continue
+      if keep and os.path.abspath(keep) == path:
+        continue
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+
+  def appendChanges(self, fields:dict, changes:dict):
+    """Append changes to the journal, instead of saving everything again.
+
+    Fields maps names of UserData fields to their new values, changes maps the
+    names of the database fields to lists of their changes (see Database's
+    popChanges). Each goes to the journal as a single line of JSON.
+    """
+    lines = [json.dumps({'field': name, 'value': value}) for name, value in fields.items()]
+    for name, field_changes in changes.items():
+      lines.extend(json.dumps({'field': name, 'change': change}) for change in field_changes)
+    if not lines:
+      return
+    with open(self.journal_path, 'a', encoding='utf-8') as journal:
+      journal.write(''.join(line + '\n' for line in lines))
+
+  def needsCompaction(self):
+    """Check whether the journal has grown big enough to be saved as a new file.
+
+    A journal of a file that does not exist is not worth anything, so in that
+    case the file has to be saved too.
+    """
+    if not os.path.exists(self.path):
+      return True
+    if not os.path.exists(self.journal_path):
+      return False
+    limit = max(self.JOURNAL_MIN, self.JOURNAL_RATIO * os.path.getsize(self.path))
+    return os.path.getsize(self.journal_path) > limit
 
   def load(self):
     """Load user data from a file, with backwards-compatibility.
@@ -131,12 +343,19 @@ class DataManager(object):
     if not os.path.exists(self.path):
       return UserData()
     # Read data and attempt to locate the version string
-    user_data = self.readFile()
-    data_version = self.checkVersion(user_data)
+    binary = SectionFile.isSectionFile(self.path)
+    try:
+      user_data = SectionFile(self.path) if binary else self.readFile()
+      data_version = self.checkVersion(
+        [user_data.read('version')] if binary else user_data
+      )
+    except:
+      print("User data reading error.")
+      return UserData()
     if not data_version:
       return UserData()
     # Attempt to match loader to that string
-    loader = self.selectLoader(data_version)
+    loader = self.selectLoader(data_version, binary)
     if not loader:
       return UserData()
     # Attempt to parse the user data using that loader
@@ -149,8 +368,42 @@ class DataManager(object):
     # This flag is used by Main to determine whether the program is being ran
     # for the first time.
     parsed_data.is_empty = False
+    self.replayJournal(parsed_data)
     return parsed_data
 
+  def replayJournal(self, user_data):
+    """Apply the changes from the journal to the loaded user data.
+
+    New values of the fields are set right away, while the changes of databases
+    are only collected (in UserData.changes), for Main to apply when it restores
+    the databases. A line that cannot be read (e.g. cut off by a crash) ends the
+    journal - the file is truncated there, so that no more lines are appended to
+    a broken one.
+    """
+    if not os.path.exists(self.journal_path):
+      return
+    valid_size = 0
+    with open(self.journal_path, 'rb') as journal:
+      for line in journal:
+        try:
+          entry = json.loads(line)
+          name = entry['field']
+          if not line.endswith(b'\n') or name not in UserData.FIELDS:
+            break
+          if 'change' in entry.keys():
+            user_data.changes.setdefault(name, []).append(entry['change'])
+          else:
+            setattr(user_data, name, entry['value'])
+            # the snapshots of the previous value are no good anymore
+            user_data.stamps.pop(name, None)
+        except (ValueError, KeyError, TypeError):
+          break
+        valid_size += len(line)
+    if valid_size < os.path.getsize(self.journal_path):
+      print("User data journal damaged, only partially read.")
+      with open(self.journal_path, 'r+b') as journal:
+        journal.truncate(valid_size)
+
   def readFile(self):
     """Simply read lines from the user data file.
 
@@ -183,26 +436,31 @@ class DataManager(object):
     # If no version string is present
     return None
 
-  def selectLoader(self, data_version):
+  def selectLoader(self, data_version, binary:bool=False):
     """Select the loader that matches the version of the given user data file.
 
-    Iterate over registered loaders for as long as the data version is more
-    recent than the loader. This will stop when a loader version is too new
-    for the data. The previous (matching) loader will be returned.
+    Iterate over registered loaders (of binary or text files) for as long as
+    the data version is more recent than the loader. This will stop when a
+    loader version is too new for the data. The previous (matching) loader will
+    be returned.
     """
+    loaders = self.binary_loaders if binary else self.loaders
     matching_loader = None
-    for loader_version, loader in self.loaders.items():
+    for loader_version, loader in loaders.items():
       if data_version >= loader_version:
         matching_loader = loader
       else:
         break
     return matching_loader
 
-  def registerLoaderSince(version:str):
-    """Add the given loader to the loaders list."""
+  def registerLoaderSince(version:str, binary:bool=False):
+    """Add the given loader to the loaders list.
+
+    Loaders of binary files are given a SectionFile instead of a list of lines.
+    """
     version = Version(version)
     def decorator(loader):
-      DataManager.all_loaders.append((loader, version))
+      DataManager.all_loaders.append((loader, version, binary))
       return loader
     return decorator
 
@@ -238,3 +496,7 @@ class Loaders(object):
       games_conf=user_data[8],
       games_data=user_data[9],
     )
+
+  @DataManager.registerLoaderSince('1.0.0-beta.5', binary=True)
+  def loader100b5(sections):
+    return LazyUserData(sections)
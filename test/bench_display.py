@@ -0,0 +1,65 @@
+"""Benchmark of repeated displays of items by the Presenter.
+
+Displays a synthetic database (see synthetic.py) of a given size, with all of
+the columns visible, in a fake tree (see test_presenter.py), so that only the
+time of retrieving and formatting the values is measured. Items are shuffled
+between the displays, as if the sorting has changed. Reports time of the first
+display (when the formatted values have to be computed) and of the subsequent
+ones (when they come from the cache, and rows that have already been made are
+only reattached to the tree), both for the regular Items and the views
+of a compact Database, and both for a window of rows (as displayUpdate would
+do) and for all of them (as if the user has scrolled to the very end).
+
+Usage:
+  cd test && python bench_display.py [item count] [repeats]
+"""
+
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import containers
+import database
+import synthetic
+from test_presenter import FakeConfig, makePresenter
+
+
+def measure(presenter, repeats:int, full:bool):
+  """Return times (in seconds) of the first and the average of the next displays."""
+  rng = random.Random(0)
+  times = []
+  for _ in range(repeats + 1):
+    rng.shuffle(presenter.items)
+    start = time.perf_counter()
+    presenter.displayUpdate()
+    if full:
+      presenter.materializeRows(len(presenter.items))
+    times.append(time.perf_counter() - start)
+  return times[0], sum(times[1:]) / repeats
+
+
+def main(count:int, repeats:int):
+  print('{} items, {} repeats'.format(count, repeats))
+  records = synthetic.makeRecords(count, 'Movie')
+  regular = [containers.Movie(**record) for record in records]
+  compact = database.Database.restoreFromString(
+    'Movie', json.dumps(records), None, None, compact=True
+  ).getItems()
+  columns = [name for name in containers.Movie.blueprints if name != 'id']
+  for name, items in [('regular', regular), ('compact', compact)]:
+    for full in [False, True]:
+      presenter = makePresenter(list(items))
+      presenter.config = FakeConfig(columns, columns)
+      first, warm = measure(presenter, repeats, full)
+      print('  {} ({}): first {:8.2f} ms, next {:8.2f} ms ({:.1f}x faster)'.format(
+        name, 'all rows' if full else 'window', first * 1000, warm * 1000, first / warm
+      ))
+
+
+if __name__ == "__main__":
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+  main(count, repeats)
@@ -0,0 +1,86 @@
+"""Benchmark of consecutive updates of the rating histogram.
+
+Compares the Histogram (see statview.py), which only moves items of a canvas,
+with drawing a new matplotlib chart every time (as StatView used to do: clear
+the figure, plot the bars, render it and convert it to a PIL image - without
+the final PhotoImage, which needs a display). If there is no display to create
+a tk.Canvas on, the Histogram draws on a FakeCanvas (see test_stats.py), so
+only the Python side of its updates is measured. Matplotlib is only needed for
+the comparison - if it is not installed, that part is skipped.
+
+Usage:
+  cd test && python bench_histogram.py [update count]
+"""
+
+import os
+import random
+import sys
+import time
+import tkinter as tk
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import statview
+from test_stats import FakeCanvas
+
+
+def makeHistograms(count:int):
+  rng = random.Random(0)
+  return [[rng.randint(0, 500) for _ in range(11)] for _ in range(count)]
+
+
+def benchCanvas(histograms:list):
+  try:
+    root = tk.Tk()
+  except tk.TclError:
+    root = None
+    canvas = FakeCanvas()
+  else:
+    canvas = tk.Canvas(root, width=statview.Histogram.WIDTH, height=statview.Histogram.HEIGHT)
+    canvas.pack()
+  histogram = statview.Histogram(canvas)
+  start = time.perf_counter()
+  for values in histograms:
+    histogram.update(values)
+    if root:
+      root.update_idletasks()
+  elapsed = time.perf_counter() - start
+  if root:
+    root.destroy()
+  return elapsed, 'tk.Canvas' if root else 'FakeCanvas'
+
+
+def benchMatplotlib(histograms:list):
+  import matplotlib
+  matplotlib.use('Agg')
+  import matplotlib.pyplot as plt
+  from PIL import Image
+  figure = plt.figure(figsize=(6, 3))
+  start = time.perf_counter()
+  for values in histograms:
+    figure.clf()
+    ax = figure.add_subplot(111)
+    ax.bar(range(11), values, width=0.5, zorder=1.0)
+    ax.grid(True, which='major', axis='y')
+    ax.set_xticks(range(11))
+    ax.set_xticklabels(['brak'] + [str(i) for i in range(1, 11)])
+    figure.canvas.draw()
+    Image.frombuffer('RGBA', figure.canvas.get_width_height(), figure.canvas.buffer_rgba())
+  return time.perf_counter() - start
+
+
+def main(count:int):
+  histograms = makeHistograms(count)
+  print('{} updates'.format(count))
+  elapsed, kind = benchCanvas(histograms)
+  print('  Histogram ({}): {:8.2f} ms ({:.3f} ms/update)'.format(kind, elapsed * 1000, elapsed * 1000 / count))
+  try:
+    elapsed = benchMatplotlib(histograms)
+  except ImportError:
+    print('  matplotlib: not installed')
+  else:
+    print('  matplotlib:           {:8.2f} ms ({:.3f} ms/update)'.format(elapsed * 1000, elapsed * 1000 / count))
+
+
+if __name__ == "__main__":
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+  main(count)
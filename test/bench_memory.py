@@ -0,0 +1,60 @@
+"""Benchmark of memory used by Items in the regular and the compact Database.
+
+Deserializes a synthetic database (see synthetic.py) of a given size into:
+* a list of regular Items, each holding a dict of properties,
+* a compact Database, holding a ColumnStore and views into it,
+and reports memory retained by each of them (as measured by tracemalloc).
+
+Usage:
+  cd test && python bench_memory.py [item count]
+"""
+
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import containers
+import database
+import synthetic
+
+
+def measure(load, string:str):
+  """Return memory (in bytes) retained by the result of load(string)."""
+  gc.collect()
+  tracemalloc.start()
+  result = load(string)
+  gc.collect()
+  retained, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del result
+  return retained
+
+
+def loadItems(string:str, itemtype:str):
+  itemclass = containers.classByString[itemtype]
+  return [itemclass(**record) for record in json.loads(string)]
+
+
+def loadCompact(string:str, itemtype:str):
+  return database.Database.restoreFromString(itemtype, string, None, None, compact=True)
+
+
+def main(count:int):
+  print('{} items'.format(count))
+  for itemtype in ['Movie', 'Game']:
+    string = json.dumps(synthetic.makeRecords(count, itemtype))
+    regular = measure(lambda s: loadItems(s, itemtype), string)
+    compact = measure(lambda s: loadCompact(s, itemtype), string)
+    print('  {}'.format(itemtype))
+    print('    dict per item: {:7.2f} MB ({:5.0f} B/item)'.format(regular / 2**20, regular / count))
+    print('    compact:       {:7.2f} MB ({:5.0f} B/item, {:.1f}x less)'.format(
+      compact / 2**20, compact / count, regular / compact
+    ))
+
+
+if __name__ == "__main__":
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  main(count)
@@ -0,0 +1,66 @@
+"""Benchmark of the parsing backends of FilmwebAPI.
+
+Parses every page cached in test/assets (see test_api.py on how to obtain them)
+with each of the available backends and reports the average time per page.
+Before measuring, it makes sure that all backends produce identical Items.
+
+Usage:
+  cd test && python bench_parsing.py [repetitions]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import filmweb
+
+ASSETS = 'assets'
+TYPES_BY_PREFIX = {'movies': 'Movie', 'series': 'Series', 'games': 'Game'}
+BACKENDS = ['soup', 'lxml']
+
+
+def loadPages():
+  """Read all cached pages, as (item type, raw HTML) tuples."""
+  pages = []
+  for name in sorted(os.listdir(ASSETS)):
+    prefix = name.split('_')[0]
+    if not name.endswith('.html') or prefix not in TYPES_BY_PREFIX:
+      continue
+    with open(os.path.join(ASSETS, name), 'r', encoding='utf-8') as html:
+      pages.append((TYPES_BY_PREFIX[prefix], html.read()))
+  return pages
+
+
+def parseAll(api, pages):
+  return [api.parseRaw(text, itemtype) for itemtype, text in pages]
+
+
+def main(repetitions:int):
+  pages = loadPages()
+  if not pages:
+    print('No cached pages found in "{}" - run the API tests first.'.format(ASSETS))
+    return
+  apis = {backend: filmweb.FilmwebAPI(None, parser=backend) for backend in BACKENDS}
+  # Validate the backends against each other
+  reference = None
+  for backend, api in apis.items():
+    result = [[item.asDict() for item in page] for page in parseAll(api, pages)]
+    if reference is None:
+      reference = result
+    elif result != reference:
+      print('Backend "{}" produced different results!'.format(backend))
+      return
+  # Measure
+  print('{} pages, {} repetitions'.format(len(pages), repetitions))
+  baseline = None
+  for backend, api in apis.items():
+    total = timeit.timeit(lambda: parseAll(api, pages), number=repetitions)
+    per_page = 1000 * total / (repetitions * len(pages))
+    baseline = baseline or per_page
+    print('{:>6}: {:7.2f} ms/page ({:.1f}x)'.format(backend, per_page, baseline / per_page))
+
+
+if __name__ == "__main__":
+  repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+  main(repetitions)
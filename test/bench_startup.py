@@ -0,0 +1,99 @@
+"""Benchmark of restoring Databases from a user data file at startup.
+
+Saves a synthetic database (see synthetic.py) of a given size to a user data
+file, and then times loading it back, in stages: reading the file (with the
+databases' sections, see userdata.py), decoding the JSON and building the
+Database - compact (as the program does) and regular. Decoding and building is
+timed with each installed JSON backend (see fastjson.py), and building regular
+Items also the plain way (calling the constructor on each record), for
+comparison. Finally, restoring the compact Database from a snapshot (see
+snapshot.py) is timed, along with reading the first screen of its rows.
+
+Usage:
+  cd test && python bench_startup.py [item count] [repeats]
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import containers
+import database
+import fastjson
+import snapshot
+import synthetic
+import userdata
+
+VERSION = '1.0.0-beta.5'
+
+
+def best(function, repeats:int):
+  """Return the shortest time of a few calls of a function, and its last result."""
+  times = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    result = function()
+    times.append(time.perf_counter() - start)
+  return min(times), result
+
+
+def makeFile(path:str, count:int):
+  fields = {name: '' for name in userdata.UserData.FIELDS}
+  fields['movies_data'] = json.dumps(synthetic.makeRecords(count, 'Movie'))
+  fields['games_data'] = json.dumps(synthetic.makeRecords(count // 10, 'Game'))
+  userdata.DataManager(path, VERSION).save(userdata.UserData(**fields))
+
+
+def readData(path:str):
+  loaded = userdata.DataManager(path, VERSION).load()
+  return loaded.movies_data
+
+
+def main(count:int, repeats:int):
+  directory = tempfile.mkdtemp()
+  try:
+    path = os.path.join(directory, 'filmatyk.dat')
+    makeFile(path, count)
+    print('{} movies, {:.2f} MB file'.format(count, os.path.getsize(path) / 2**20))
+    elapsed, string = best(lambda: readData(path), repeats)
+    print('  reading the file:        {:8.1f} ms'.format(elapsed * 1000))
+    for backend in fastjson.available():
+      fastjson.use(backend)
+      decoding, records = best(lambda: fastjson.loads(string), repeats)
+      restore = lambda compact: database.Database.restoreFromString('Movie', string, None, None, compact)
+      compact, _ = best(lambda: restore(True), repeats)
+      regular, _ = best(lambda: restore(False), repeats)
+      print('  {}'.format(backend))
+      print('    decoding:              {:8.1f} ms'.format(decoding * 1000))
+      print('    compact Database:      {:8.1f} ms'.format(compact * 1000))
+      print('    regular Database:      {:8.1f} ms'.format(regular * 1000))
+    plain, _ = best(lambda: [containers.Movie(**record) for record in records], repeats)
+    bulk, _ = best(lambda: containers.Movie.fromRecords(records), repeats)
+    print('  Items from decoded records')
+    print('    constructor per item:  {:8.1f} ms'.format(plain * 1000))
+    print('    fromRecords:           {:8.1f} ms'.format(bulk * 1000))
+    snapshot_path = path + '.snap'
+    db = database.Database.restoreFromString('Movie', string, None, None, True)
+    writing, _ = best(lambda: db.storeToSnapshot(snapshot_path), repeats)
+    def restoreSnapshot():
+      restored = database.Database('Movie', None, None, True)
+      restored.loadSnapshot(snapshot_path)
+      return restored
+    loading, restored = best(restoreSnapshot, repeats)
+    screen, _ = best(lambda: [item.asDict() for item in restored.items[:50]], 1)
+    print('  snapshot ({:.2f} MB)'.format(os.path.getsize(snapshot_path) / 2**20))
+    print('    writing:               {:8.1f} ms'.format(writing * 1000))
+    print('    compact Database:      {:8.1f} ms'.format(loading * 1000))
+    print('    first 50 items:        {:8.1f} ms'.format(screen * 1000))
+  finally:
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+  main(count, repeats)
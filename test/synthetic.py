@@ -0,0 +1,110 @@
+"""Generator of synthetic Items, for benchmarks that need lots of data.
+
+Cached assets only hold a few pages of items, which is too little to measure
+anything. Items generated here mimic real ones: all properties are filled, list
+properties draw their values from vocabularies of realistic sizes, and about
+one in ten items has a comment.
+"""
+
+import os
+import random
+import sys
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import containers
+
+# Sizes of vocabularies for the list properties
+VOCABULARIES = {
+  'genres': 30,
+  'countries': 60,
+  'directors': 3000,
+  'cast': 30000,
+  'developers': 800,
+  'publishers': 300,
+  'platforms': 15,
+}
+LIST_LENGTHS = {
+  'genres': (1, 3),
+  'countries': (1, 2),
+  'directors': (1, 2),
+  'cast': (3, 5),
+  'developers': (1, 2),
+  'publishers': (1, 2),
+  'platforms': (1, 4),
+}
+WORDS = [
+  'noc', 'dzień', 'miasto', 'ostatni', 'pierwszy', 'wielki', 'mały', 'czas',
+  'Łódź', 'życie', 'śmierć', 'miłość', 'wojna', 'gwiazda', 'dom', 'król',
+  'zielony', 'czarny', 'biały', 'sekret', 'powrót', 'droga', 'ogień', 'woda',
+]
+
+
+def makeWords(rng:random.Random, count:int):
+  return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def makeRecord(itemtype:str, iid:int, rng:random.Random):
+  """Generate a single record (as produced by Item.asDict)."""
+  itemclass = containers.classByString[itemtype]
+  record = {
+    'id': iid,
+    'title': makeWords(rng, rng.randint(1, 4)).capitalize(),
+    'otitle': makeWords(rng, rng.randint(1, 4)).capitalize(),
+    'year': rng.randint(1920, 2020),
+    'link': '/film/Synthetic-{}'.format(iid),
+    'imglink': 'https://fwcdn.pl/fpo/{:02d}/{:02d}/{}/0000000.6.jpg'.format(iid % 97, iid % 89, iid),
+    'fwRating': round(rng.uniform(3, 9), 1),
+    'plot': makeWords(rng, rng.randint(20, 40)).capitalize() + '.',
+  }
+  if 'duration' in itemclass.blueprints:
+    record['duration'] = rng.randint(60, 200)
+  for prop, size in VOCABULARIES.items():
+    if prop not in itemclass.blueprints:
+      continue
+    low, high = LIST_LENGTHS[prop]
+    record[prop] = [
+      '{} {}'.format(prop, rng.randrange(size))
+      for _ in range(rng.randint(low, high))
+    ]
+  record['userdata'] = {
+    'rating': {
+      'rating': rng.randint(1, 10),
+      'comment': makeWords(rng, 10) if rng.random() < 0.1 else '',
+      'dateOf': {'y': rng.randint(2005, 2020), 'm': rng.randint(1, 12), 'd': rng.randint(1, 28)},
+      'faved': int(rng.random() < 0.05),
+    }
+  }
+  return record
+
+
+def makeRecords(count:int, itemtype:str='Movie', seed:int=0):
+  """Generate a list of records of unique IDs."""
+  rng = random.Random(seed)
+  return [makeRecord(itemtype, 100000 + i, rng) for i in range(count)]
+
+
+def makeRecordsWithGaps(count:int, itemtype:str='Movie', seed:int=0):
+  """Generate records some of which lack the userdata or some properties.
+
+  Every 11th has no rating, every 13th has no year and no genres (an empty
+  list), every 17th has no original title and countries, and a genre that is
+  an empty string - these all have to survive being stored and restored.
+  """
+  records = makeRecords(count, itemtype, seed)
+  for i, record in enumerate(records):
+    if i % 11 == 0:
+      record['userdata'] = {}
+    if i % 13 == 0:
+      record.pop('year')
+      record['genres'] = []
+    if i % 17 == 0:
+      record.pop('otitle', None)
+      record.pop('countries', None)
+      record['genres'] = ['']
+  return records
+
+
+def makeItems(count:int, itemtype:str='Movie', seed:int=0):
+  """Generate a list of Items of unique IDs."""
+  itemclass = containers.classByString[itemtype]
+  return [itemclass(**record) for record in makeRecords(count, itemtype, seed)]
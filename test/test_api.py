@@ -1,6 +1,9 @@
+import contextlib
 import functools
 import getpass
+import io
 import os
+import re
 import sys
 import unittest
 
@@ -227,6 +230,77 @@ class TestAPIParsing(unittest.TestCase):
     items = self.api.parsePage(page, 'Game')
     self.assertGreater(len(items), 0)
 
+  def __test_compiled_body(self, path:str, itemtype:str):
+    """Parse a page with both backends and compare the results."""
+    with open(path, 'r', encoding='utf-8') as html:
+      text = html.read()
+    compiled_api = filmweb.FilmwebAPI(None, parser='lxml')
+    expected = [item.asDict() for item in self.api.parseRaw(text, itemtype)]
+    actual = [item.asDict() for item in compiled_api.parseRaw(text, itemtype)]
+    self.assertGreater(len(actual), 0)
+    self.assertEqual(expected, actual)
+
+  def test_30_compiled_movie_page(self):
+    """Parse a page of movies using the compiled (lxml) parser."""
+    self.__test_compiled_body(self.moviePagePath, 'Movie')
+
+  def test_31_compiled_series_page(self):
+    """Parse a page of series using the compiled (lxml) parser."""
+    self.__test_compiled_body(self.seriesPagePath, 'Series')
+
+  def test_32_compiled_game_page(self):
+    """Parse a page of games using the compiled (lxml) parser."""
+    self.__test_compiled_body(self.gamePagePath, 'Game')
+
+  def __test_diagnostics_body(self, parser:str):
+    """Break the join of a single rating and check if it gets reported."""
+    with open(self.moviePagePath, 'r', encoding='utf-8') as html:
+      text = html.read()
+    api = filmweb.FilmwebAPI(None, parser=parser)
+    # A clean page should produce no diagnostics at all
+    diagnostics = filmweb.PageDiagnostics('Movie', 1)
+    page = api.parseRaw(text, 'Movie', diagnostics)
+    self.assertFalse(diagnostics)
+    # Reassign the first rating to an item that does not exist on the page
+    ratings = self.api.extractRatings(self.api.extractDataSource(self.api.makePage(text)))
+    _, iid = self.api.parseRating(ratings[0])
+    text = re.sub(r'"eId":\s*{}\b'.format(iid), '"eId": 1', text, count=1)
+    diagnostics = filmweb.PageDiagnostics('Movie', 1)
+    broken = api.parseRaw(text, 'Movie', diagnostics)
+    self.assertTrue(diagnostics)
+    self.assertEqual([rid for rid, _ in diagnostics.orphan_ratings], [1])
+    self.assertEqual(diagnostics.unrated_items, [iid])
+    # Everything else should have been joined just as before
+    self.assertEqual(len(broken), len(page))
+    for item, original in zip(broken, page):
+      if item.getRawProperty('id') == iid:
+        self.assertEqual(item.getRawProperty('rating'), '')
+      else:
+        self.assertEqual(item.asDict(), original.asDict())
+    # Reported problems are remembered, but only the most recent ones
+    with contextlib.redirect_stdout(io.StringIO()):
+      for page_number in range(api.max_diagnostics + 10):
+        reported = filmweb.PageDiagnostics('Movie', page_number)
+        reported.unrated_items = [iid]
+        api.reportDiagnostics(reported)
+    self.assertEqual(len(api.diagnostics), api.max_diagnostics)
+    self.assertEqual(api.diagnostics[-1].page, api.max_diagnostics + 9)
+
+  def test_40_join_diagnostics(self):
+    """Report orphan ratings and unrated items (default parser)."""
+    self.__test_diagnostics_body('soup')
+
+  def test_41_join_diagnostics_compiled(self):
+    """Report orphan ratings and unrated items (compiled parser)."""
+    self.__test_diagnostics_body('lxml')
+
+  def test_42_batch_rating_decoding(self):
+    """Decode ratings in a batch, exactly as one by one."""
+    page = self.getPage(self.moviePagePath)
+    ratings = self.api.extractRatings(self.api.extractDataSource(page))
+    expected = [self.api.parseRating(text) for text in ratings]
+    self.assertEqual(self.api.parseRatings(ratings), expected)
+
 
 if __name__ == "__main__":
   try:
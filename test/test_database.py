@@ -1,12 +1,20 @@
+import functools
+import http.server
+import json
 import os
 import sys
+import threading
 from typing import List, Set, Tuple
 import unittest
+from unittest import mock
 
 sys.path.append(os.path.join('..', 'filmatyk'))
+import columnstore
 import containers
 import database
+import fastjson
 import filmweb
+import synthetic
 
 
 class DatabaseDifference():
@@ -80,12 +88,17 @@ class FakeAPI(filmweb.FilmwebAPI):
   """Loads cached data instead of connecting online.
 
   When initializing, will look for HTML files in the given directory and treat
-  them as "pages" to load data from, later when emulating "getItemsPage".
+  them as "pages" to load data from. Their paths are used in place of URLs, so
+  that all the original code of acquiring items from pages can be used, except
+  for actually fetching the raw data ("fetchRaw") - which reads these files.
   """
   def __init__(self, src_path:str='', itemtype:str='Movie'):
     super(FakeAPI, self).__init__(None)
+    # This session is never used to connect, but enforceSession watches it
+    self.session = filmweb.requests_html.HTMLSession()
     self.src_path = src_path
     self.page_paths = self.initPages()
+    self.urlGenerationMethods[itemtype] = self.getPagePath
     self.item_count, self.items_per_page = self.initAnalyze(itemtype)
 
   def initPages(self):
@@ -96,7 +109,7 @@ class FakeAPI(filmweb.FilmwebAPI):
       item.path for item in os.scandir(self.src_path)
       if item.name.endswith('.html') and item.name.startswith('movies_')
     ]
-    return pages
+    return sorted(pages)
 
   def initAnalyze(self, itemtype:str):
     """Checks how many items are in the stored files, and how many per page."""
@@ -111,29 +124,69 @@ class FakeAPI(filmweb.FilmwebAPI):
     # items per page.
     return sum(counts), counts[0]
 
+  def getPagePath(self, page:int=1):
+    """Replaces URL generation, "pages" being the cached files."""
+    return self.page_paths[page - 1]
+
   def checkSession(self):
     """First part of the hack - don't bother with the session at all."""
     return True
 
-  def fetchPage(self, path:str):
+  def fetchRaw(self, path:str):
     """Load HTML from file instead of URL."""
     with open(path, 'r', encoding='utf-8') as html:
-      page = filmweb.BS(html.read(), features='lxml')
-    return page
-
-  def getItemsPage(self, itemtype:str, page:int=1):
-    """Hack to use cached HTMLs instead of online session."""
-    path = self.page_paths[page - 1]
-    #path = os.path.join(self.src_path, 'movies_{}.html'.format(page))
-    page = self.fetchPage(path)
-    items = self.parsePage(page, itemtype)
-    return items
+      return html.read()
 
   def getNumOf(self, itemtype:str):
     """Simply return the values we have computed earlier (initAnalyze)."""
     return self.item_count, self.items_per_page
 
 
+class LocalServer():
+  """Serves files from a given directory over HTTP, on a background thread.
+
+  Used as a local stand-in for Filmweb, so that the actual fetching code of the
+  API can be tested without going online.
+  """
+  class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+      pass
+
+  def __init__(self, directory:str):
+    handler = functools.partial(self.QuietHandler, directory=directory)
+    self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+
+
+class LocalAPI(FakeAPI):
+  """Like FakeAPI, but downloads the cached pages from a LocalServer.
+
+  Pages are fetched using the original FilmwebAPI code (only the URLs differ),
+  with an unauthenticated session.
+  """
+  def __init__(self, src_path:str, server:LocalServer, itemtype:str='Movie'):
+    self.server = server
+    super(LocalAPI, self).__init__(src_path, itemtype)
+
+  def initPages(self):
+    """Turn the paths of the cached files into URLs on the local server."""
+    return [
+      '{}/{}'.format(self.server.url, os.path.basename(path))
+      for path in super(LocalAPI, self).initPages()
+    ]
+
+  def fetchRaw(self, url:str):
+    """Fetch over HTTP as the original does (undoing FakeAPI's override)."""
+    return filmweb.FilmwebAPI.fetchRaw(self, url)
+
+
 class UpdateScenario():
   """Database modification scenario to obtain a simulated previous state.
 
@@ -217,6 +270,8 @@ class TestDatabaseUpdates(unittest.TestCase):
   The update itself is performed via a proxy, which loads data cached from
   earlier tests instead of requiring a live and authenticated session.
   """
+  compact = False
+
   @classmethod
   def setUpClass(self):
     self.api = FakeAPI('assets')
@@ -236,6 +291,7 @@ class TestDatabaseUpdates(unittest.TestCase):
       itemtype=self.orig_db.itemtype,
       api=self.orig_db.api,
       callback=self.orig_db.callback,
+      compact=self.compact,
     )
     # Remove items according to the scenario
     new_db.items = [
@@ -258,9 +314,20 @@ class TestDatabaseUpdates(unittest.TestCase):
     alter_db = self.makeModifiedDatabase(scenario)
     # Make sure the databases are actually different!
     self.assertNotEqual(alter_db, self.orig_db)
+    saved = alter_db.storeToString()
     # Call update and check difference
     alter_db.softUpdate()
     self.assertEqual(alter_db, self.orig_db)
+    # Replaying the changes on the saved state gives the same result
+    changes = alter_db.popChanges()
+    self.assertEqual(alter_db.popChanges(), [])
+    replayed = database.Database.restoreFromString(
+      'Movie', saved, self.api, lambda x: x, compact=self.compact
+    )
+    replayed.applyChanges(changes)
+    self.assertEqual(replayed, self.orig_db)
+    replayed.applyChanges(changes)
+    self.assertEqual(replayed, self.orig_db)
 
   # Addition tests
 
@@ -372,6 +439,305 @@ class TestDatabaseUpdates(unittest.TestCase):
     self.assertEqual(alter_db, self.orig_db)
 
 
+class TestDatabaseIndexes(unittest.TestCase):
+  """Test the ID and property indexes of the Database.
+
+  Every lookup is compared against a plain linear search over the items, both
+  after loading from scratch and after the operations that replace the items.
+  """
+  @classmethod
+  def setUpClass(self):
+    self.api = FakeAPI('assets')
+    self.db = database.Database(itemtype='Movie', api=self.api, callback=lambda x: x)
+    self.db.hardUpdate()
+
+  def assertIndexed(self, db):
+    """Every item can be found by its ID, and unknown IDs are not."""
+    for item in db.items:
+      self.assertIs(db.getItemByID(item.getRawProperty('id')), item)
+    self.assertIsNone(db.getItemByID(-1))
+
+  def test_idIndex(self):
+    """Look up items by ID after an update and after deserialization."""
+    self.assertIndexed(self.db)
+    restored = database.Database.restoreFromString(
+      itemtype='Movie',
+      string=self.db.storeToString(),
+      api=self.api,
+      callback=lambda x: x,
+    )
+    self.assertIndexed(restored)
+
+  def test_directModification(self):
+    """The ID index recovers if the list of items was modified directly."""
+    db = database.Database(itemtype='Movie', api=self.api, callback=lambda x: x)
+    db.setItems(self.db.getItems())
+    db.items.reverse()
+    self.assertIndexed(db)
+    db.items.pop()
+    self.assertIndexed(db)
+    # same length, but a new item at either end
+    for end in [0, -1]:
+      item = containers.Movie(**dict(db.items[end].asDict(), id=-100 - end))
+      db.items[end] = item
+      self.assertIs(db.getItemByID(item.getRawProperty('id')), item)
+
+  def test_updatedIndex(self):
+    """Indexes reflect the state after a soft update."""
+    db = database.Database(itemtype='Movie', api=self.api, callback=lambda x: x)
+    db.setItems(self.db.getItems()[5:])
+    self.assertIsNone(db.getItemByID(self.db.items[0].getRawProperty('id')))
+    self.assertEqual(len(db.getItemsInRange('year')), len(db.items))
+    db.softUpdate()
+    self.assertIndexed(db)
+    self.assertEqual(len(db.getItemsInRange('year')), len(db.items))
+
+  def test_rangeQueries(self):
+    """Range queries on indexed properties match a linear search."""
+    for prop in database.Database.indexed_properties:
+      values = sorted(set(
+        item.getRawProperty(prop) for item in self.db
+        if item.getRawProperty(prop) != ''
+      ))
+      self.assertGreater(len(values), 2)
+      lo, hi = values[1], values[-2]
+      expected = [
+        item for item in self.db
+        if item.getRawProperty(prop) != '' and lo <= item.getRawProperty(prop) <= hi
+      ]
+      actual = self.db.getItemsInRange(prop, lo, hi)
+      self.assertCountEqual(actual, expected)
+      keys = [item.getRawProperty(prop) for item in actual]
+      self.assertEqual(keys, sorted(keys))
+      # Open-ended ranges
+      known = [item for item in self.db if item.getRawProperty(prop) != '']
+      above = [item for item in known if item.getRawProperty(prop) >= lo]
+      below = [item for item in known if item.getRawProperty(prop) <= hi]
+      self.assertCountEqual(self.db.getItemsInRange(prop, lo=lo), above)
+      self.assertCountEqual(self.db.getItemsInRange(prop, hi=hi), below)
+
+
+class TestCompactDatabaseUpdates(TestDatabaseUpdates):
+  """Run all the update tests on a compact Database (see TestCompactDatabase)."""
+  compact = True
+
+
+class TestCompactDatabase(unittest.TestCase):
+  """Test the compact Database, whose Items are views into a ColumnStore.
+
+  Compact Items have to behave exactly like the regular ones, so each test does
+  the same operation on a regular and a compact Database and compares them.
+  """
+  @classmethod
+  def setUpClass(self):
+    self.api = FakeAPI('assets')
+    self.db = database.Database(itemtype='Movie', api=self.api, callback=lambda x: x)
+    self.db.hardUpdate()
+
+  def makeCompact(self):
+    return database.Database.restoreFromString(
+      itemtype='Movie',
+      string=self.db.storeToString(),
+      api=self.api,
+      callback=lambda x: x,
+      compact=True,
+    )
+
+  def assertSameItems(self, compact, regular):
+    self.assertEqual(len(compact.items), len(regular.items))
+    for view, item in zip(compact.items, regular.items):
+      self.assertIsInstance(view, columnstore.ItemView)
+      self.assertEqual(view.asDict(), item.asDict())
+      for prop in item.blueprints:
+        self.assertEqual(view[prop], item[prop])
+        raw = view.getRawProperty(prop)
+        # List properties are held as tuples (see columnstore.ListColumn)
+        raw = list(raw) if isinstance(raw, tuple) else raw
+        self.assertEqual(raw, item.getRawProperty(prop))
+
+  def test_serialization(self):
+    """Compact Database is restored and stored exactly as a regular one."""
+    compact = self.makeCompact()
+    self.assertSameItems(compact, self.db)
+    self.assertEqual(compact.storeToString(), self.db.storeToString())
+
+  def test_update(self):
+    """Load data from scratch into a compact Database."""
+    compact = database.Database(itemtype='Movie', api=self.api, callback=lambda x: x, compact=True)
+    compact.hardUpdate()
+    self.assertSameItems(compact, self.db)
+
+  def test_modification(self):
+    """Modify an Item through its view."""
+    compact = self.makeCompact()
+    view = compact.items[0]
+    rating = {'rating': 3, 'comment': 'meh', 'dateOf': {'y': 2001, 'm': 2, 'd': 3}, 'faved': 0}
+    view.addRating(rating)
+    self.assertEqual(view.getRawProperty('rating'), 3)
+    self.assertEqual(view['dateOf'], '2001-02-03')
+    self.assertEqual(view.asDict()['userdata']['rating'], rating)
+    other = containers.Movie(**self.db.items[1].asDict())
+    view.update(other)
+    self.assertEqual(view.asDict(), other.asDict())
+
+  def test_displayCache(self):
+    """Formatted values are cached, but refreshed when an Item is modified."""
+    compact = self.makeCompact()
+    regular = containers.Movie(**self.db.items[0].asDict())
+    other = containers.Movie(**self.db.items[1].asDict())
+    rating = {'rating': 3, 'comment': 'meh', 'dateOf': {'y': 2001, 'm': 2, 'd': 3}, 'faved': 1}
+    for item in [regular, compact.items[0]]:
+      title = item['title']
+      self.assertIs(item['title'], title)
+      self.assertEqual(item['nonexistent'], '')
+      item.addRating(rating)
+      self.assertEqual(item['rating'], '3 ★★★')
+      self.assertEqual(item['faved'], '♥')
+      item.update(other)
+      for prop in other.blueprints:
+        self.assertEqual(item[prop], other[prop])
+
+  def test_store(self):
+    """The store is built for both kinds of Databases, with shared strings."""
+    for db in [self.db, self.makeCompact()]:
+      store = db.getStore()
+      self.assertEqual(len(store), len(db.items))
+      ids = store.getColumn('id').values.tolist()
+      self.assertEqual(ids, [item.getRawProperty('id') for item in db.items])
+      genres = [genre for row in store.getColumn('genres').values for genre in row]
+      by_value = {}
+      for genre in genres:
+        self.assertIs(by_value.setdefault(genre, genre), genre)
+
+  def test_reindex(self):
+    """Only new and changed rows are written to the store, and the views held remain valid."""
+    compact = self.makeCompact()
+    regular = database.Database.restoreFromString('Movie', self.db.storeToString(), self.api, None)
+    for db in [compact, regular]:
+      held = db.getItems()
+      records = [item.asDict() for item in held]
+      title = held[6]['title']
+      new = containers.Movie(**dict(records[3], id=-1))
+      changed = containers.Movie(**dict(records[5], title='Changed'))
+      held[5].update(changed)
+      items = [new] + held[5:] + held[:2]
+      expected = [new.asDict(), changed.asDict()] + records[6:] + records[:2]
+      with mock.patch.object(columnstore.ColumnStore, 'setRecord', autospec=True, side_effect=columnstore.ColumnStore.setRecord) as setRecord:
+        db.setItems(items, changed=[1])
+      self.assertEqual(setRecord.call_count, 2)
+      store = db.getStore()
+      self.assertEqual([store.getRecord(row) for row in range(len(store))], expected)
+      self.assertEqual([item.asDict() for item in db.items], expected)
+      self.assertIs(db.items[1], held[5])
+      self.assertIs(held[6]['title'], title)
+      # views of the removed items still read their values
+      self.assertEqual([item.asDict() for item in held[2:5]], records[2:5])
+      self.assertIs(db.getItemByID(records[7]['id']), held[7])
+
+
+class TestBulkDecoding(unittest.TestCase):
+  """Test that Items built in bulk are the same as those built one by one.
+
+  Uses synthetic records, some of them lacking properties or the userdata, and
+  some holding keys that are not properties at all (which are to be ignored).
+  """
+  @classmethod
+  def setUpClass(self):
+    self.records = synthetic.makeRecords(200, 'Movie', seed=5)
+    for i, record in enumerate(self.records):
+      if i % 7 == 0:
+        record['userdata'] = {}
+      if i % 11 == 0:
+        record.pop('cast')
+        record['unknown'] = 'ignored'
+    self.string = json.dumps(self.records)
+
+  def tearDown(self):
+    fastjson.use()
+
+  def test_fromRecords(self):
+    """Items constructed from records at once and one by one are the same."""
+    for itemtype in ['Movie', 'Game']:
+      itemclass = containers.classByString[itemtype]
+      bulk = itemclass.fromRecords(self.records)
+      for item, record in zip(bulk, self.records):
+        plain = itemclass(**record)
+        self.assertIsInstance(item, itemclass)
+        self.assertEqual(item.properties, plain.properties)
+        self.assertEqual(item.asDict(), plain.asDict())
+        self.assertNotIn('unknown', item.properties)
+
+  def test_backends(self):
+    """Databases are restored the same with every JSON backend, and stored back the same."""
+    for backend in fastjson.available():
+      fastjson.use(backend)
+      for compact in [False, True]:
+        db = database.Database.restoreFromString('Movie', self.string, None, None, compact)
+        expected = [containers.Movie(**record).asDict() for record in self.records]
+        self.assertEqual([item.asDict() for item in db], expected, backend)
+        self.assertEqual(json.loads(db.storeToString()), expected, backend)
+    self.assertIn('json', fastjson.available())
+    with self.assertRaises(ImportError):
+      fastjson.use('nothing')
+
+
+class TestConcurrentFetching(unittest.TestCase):
+  """Test downloading pages concurrently, from a local HTTP server.
+
+  Results of a concurrent download have to be exactly the same as of a regular,
+  sequential one - in particular, the order of items must be preserved.
+  """
+  @classmethod
+  def setUpClass(self):
+    self.server = LocalServer('assets')
+    self.api = LocalAPI('assets', self.server)
+
+  @classmethod
+  def tearDownClass(self):
+    self.server.close()
+
+  def loadDatabase(self, fetch_workers:int, parse_workers:int=0, callback=lambda x: x):
+    """Create a new Database and fill it using the given number of workers."""
+    self.api.fetch_workers = fetch_workers
+    self.api.parse_workers = parse_workers
+    db = database.Database(itemtype='Movie', api=self.api, callback=callback)
+    db.hardUpdate()
+    return db
+
+  def test_pageOrder(self):
+    """Concurrently loaded items come in the same order as sequential ones."""
+    sequential = self.loadDatabase(fetch_workers=1)
+    concurrent = self.loadDatabase(fetch_workers=4)
+    known_count, _ = self.api.getNumOf('Movie')
+    self.assertEqual(len(concurrent.items), known_count)
+    self.assertEqual(
+      [item.getRawProperty('id') for item in sequential.items],
+      [item.getRawProperty('id') for item in concurrent.items],
+    )
+
+  def test_parserProcesses(self):
+    """Pages parsed in separate processes give the same result."""
+    sequential = self.loadDatabase(fetch_workers=1)
+    self.api.min_parsed_pages = 1
+    pipelined = self.loadDatabase(fetch_workers=4, parse_workers=2)
+    self.assertEqual(
+      [item.asDict() for item in sequential.items],
+      [item.asDict() for item in pipelined.items],
+    )
+
+  def test_progress(self):
+    """Progress is reported once per every page, ending with a full bar."""
+    reports = []
+    callback = lambda value, abort=False: reports.append(value)
+    self.loadDatabase(fetch_workers=4, callback=callback)
+    page_reports = reports[1:-1]
+    self.assertEqual(reports[0], 0)
+    self.assertEqual(reports[-1], -1)
+    self.assertEqual(len(page_reports), len(self.api.page_paths))
+    self.assertEqual(page_reports, sorted(page_reports))
+    self.assertEqual(page_reports[-1], 100)
+
+
 if __name__ == "__main__":
   database.Database.__ne__ = DatabaseDifference.compute
   database.Database.__eq__ = DatabaseDifference.ne_to_eq
@@ -0,0 +1,401 @@
+import datetime
+import os
+import random
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import columnstore
+import containers
+import filters
+import synthetic
+import titleindex
+
+
+def makeFilter(filter_class, **attributes):
+  """Create a Filter without its GUI (which cannot be tested here)."""
+  filter_object = filter_class.__new__(filter_class)
+  for name, value in attributes.items():
+    setattr(filter_object, name, value)
+  return filter_object
+
+
+class FakeFilter(object):
+  """Stands in for a Filter in the FilterMachine, recording its evaluations."""
+  def __init__(self, ID:int, cost:int, predicate):
+    self.ID = ID
+    self.COST = cost
+    self.calls = []
+    self.setPredicate(predicate)
+  def setPredicate(self, predicate):
+    def function(store, rows):
+      self.calls.append(rows.copy())
+      return np.array([predicate(store.view(row)) for row in rows], dtype=bool)
+    self.function = function
+  def setCallback(self, callback):
+    self.callback = callback
+  def getFunction(self):
+    return self.function
+  def getID(self):
+    return self.ID
+  def activate(self, narrowing=False):
+    self.callback(self.ID, self.function, narrowing=narrowing)
+  def reset(self):
+    self.callback(self.ID, self.function, reset=True)
+
+
+class TestFilterFunctions(unittest.TestCase):
+  """Test the callables produced by the filters against per-item predicates.
+
+  Filters evaluate their criteria over whole columns of a ColumnStore. Each test
+  makes sure that the resulting mask is exactly what checking every Item on its
+  own would give. Data comes from the synthetic database (see synthetic.py),
+  with some properties removed from some of the items.
+  """
+  @classmethod
+  def setUpClass(self):
+    records = synthetic.makeRecords(500, 'Movie', seed=1)
+    for i, record in enumerate(records):
+      if i % 17 == 0:
+        record.pop('countries')
+      if i % 23 == 0:
+        record['userdata'] = {}
+    self.store = columnstore.ColumnStore('Movie', records)
+    self.items = [containers.Movie(**record) for record in records]
+    game_records = synthetic.makeRecords(300, 'Game', seed=2)
+    self.game_store = columnstore.ColumnStore('Game', game_records)
+    self.games = [containers.Game(**record) for record in game_records]
+
+  def assertMatches(self, function, store, items, predicate):
+    """Compare the mask over all rows and over a subset with a predicate."""
+    expected = np.array([predicate(item) for item in items], dtype=bool)
+    self.assertTrue(expected.any())
+    self.assertFalse(expected.all())
+    rows = np.arange(len(store))
+    np.testing.assert_array_equal(function(store, rows), expected)
+    rows = rows[::3]
+    np.testing.assert_array_equal(function(store, rows), expected[rows])
+
+  def test_title(self):
+    """Search by a fragment of a title or original title, ignoring case and diacritics."""
+    title_filter = makeFilter(filters.TitleFilter, ID=0, index=titleindex.TitleIndex(),
+      last_search=None, machineCallback=lambda *args, **kwargs: None
+    )
+    title_filter.populateChoices(self.store)
+    fold = titleindex.fold
+    for search in ['łódź', 'LODZ', 'ci', 'ś', 'zyc']:
+      title_filter.setSearch(fold(search))
+      self.assertMatches(title_filter.function, self.store, self.items,
+        lambda item: fold(search) in fold(item.getRawProperty('title'))
+          or fold(search) in fold(item.getRawProperty('otitle'))
+      )
+
+  def test_year(self):
+    """Year range."""
+    function = filters.Filter.makeRangeFunction('year', 1950, 1990)
+    self.assertMatches(function, self.store, self.items,
+      lambda item: 1950 <= item.getRawProperty('year') <= 1990
+    )
+
+  def test_rating(self):
+    """Rating range - unrated items never pass."""
+    function = filters.Filter.makeRangeFunction('rating', 0, 4)
+    self.assertMatches(function, self.store, self.items,
+      lambda item: item.userdata.hasRating() and item.getRawProperty('rating') <= 4
+    )
+
+  def test_date(self):
+    """Date range - items with no date never pass."""
+    dateFrom = datetime.date(2010, 3, 1)
+    dateTo = datetime.date(2015, 6, 30)
+    function = filters.Filter.makeRangeFunction(
+      'dateOf', dateFrom.toordinal(), dateTo.toordinal()
+    )
+    self.assertMatches(function, self.store, self.items,
+      lambda item: item.userdata.hasRating() and dateFrom <= item.getRawProperty('dateOf') <= dateTo
+    )
+
+  def test_genres(self):
+    """All three modes of the genre filter."""
+    # select the genres of some item, so that there is an exact match
+    selected = next(
+      item.getRawProperty('genres') for item in self.items
+      if len(item.getRawProperty('genres')) == 2
+    )
+    genre_filter = makeFilter(filters.GenreFilter, selected=selected)
+    genre_filter.buildIndex(self.store)
+    genres = lambda item: item.getRawProperty('genres')
+    self.assertMatches(genre_filter.makeMaskFunction(genre_filter.filterAtLeast()),
+      self.store, self.items, lambda item: any(g in genres(item) for g in selected)
+    )
+    self.assertMatches(genre_filter.makeMaskFunction(genre_filter.filterAll()),
+      self.store, self.items, lambda item: all(g in genres(item) for g in selected)
+    )
+    self.assertMatches(genre_filter.makeMaskFunction(genre_filter.filterExactly()),
+      self.store, self.items, lambda item: sorted(genres(item)) == sorted(selected)
+    )
+
+  def test_countries(self):
+    """Country filter - items with no countries never pass."""
+    country = self.items[1].getRawProperty('countries')[0]
+    country_filter = makeFilter(filters.CountryFilter, selected=[country])
+    country_filter.buildIndex(self.store)
+    self.assertMatches(country_filter.makeMaskFunction(country_filter.filterBelongs()),
+      self.store, self.items, lambda item: country in (item.getRawProperty('countries') or [])
+    )
+
+  def test_gamemakers(self):
+    """Game maker filter looks into both developers and publishers."""
+    developer = self.games[0].getRawProperty('developers')[0]
+    publisher = self.games[1].getRawProperty('publishers')[0]
+    maker_filter = makeFilter(filters.GamemakerFilter, selected=[developer, publisher])
+    maker_filter.buildIndex(self.game_store)
+    self.assertMatches(maker_filter.makeMaskFunction(maker_filter.filterBelongs()),
+      self.game_store, self.games,
+      lambda item: developer in item.getRawProperty('developers')
+        or publisher in item.getRawProperty('publishers')
+    )
+    values = filters.GamemakerFilter.getValues(self.game_store, [0])[0]
+    self.assertEqual(
+      list(values),
+      self.games[0].getRawProperty('developers') + self.games[0].getRawProperty('publishers')
+    )
+
+
+class TestListboxIndex(unittest.TestCase):
+  """Test the inverted index built by the listbox filters."""
+  def setUp(self):
+    records = synthetic.makeRecords(300, 'Game', seed=5)
+    # make some developer also a publisher of the same game
+    records[0]['publishers'] = records[0]['developers'][:1]
+    records[1].pop('developers')
+    self.store = columnstore.ColumnStore('Game', records)
+    self.views = self.store.views()
+
+  def test_index(self):
+    """Every value lists exactly the rows that contain it, each row once."""
+    maker_filter = makeFilter(filters.GamemakerFilter)
+    maker_filter.buildIndex(self.store)
+    makers = lambda view: set(view.getRawProperty('developers') or ()) \
+      | set(view.getRawProperty('publishers') or ())
+    expected = {}
+    for row, view in enumerate(self.views):
+      for value in makers(view):
+        expected.setdefault(value, []).append(row)
+    self.assertEqual(maker_filter.all_options, sorted(expected.keys()))
+    for value, rows in expected.items():
+      self.assertEqual(list(maker_filter.index[value]), rows)
+    self.assertEqual(len(maker_filter.lengths), len(self.store))
+
+  def test_unknownValue(self):
+    """Values absent from the index match nothing."""
+    genre_filter = makeFilter(filters.GenreFilter, selected=['nonexistent'])
+    genre_filter.buildIndex(self.store)
+    self.assertFalse(genre_filter.filterAtLeast().any())
+    self.assertFalse(genre_filter.filterAll().any())
+    genre_filter.selected = []
+    self.assertEqual(len(genre_filter.filterAtLeast()), len(self.store))
+
+  def test_allWithDuplicates(self):
+    """A value found twice in the same row only counts once."""
+    maker = self.views[0].getRawProperty('developers')[0]
+    maker_filter = makeFilter(filters.GamemakerFilter)
+    maker_filter.buildIndex(self.store)
+    self.assertEqual(list(maker_filter.index[maker]).count(0), 1)
+    self.assertTrue(maker_filter.rowsWithAll([maker])[0])
+
+
+class TestTitleIndex(unittest.TestCase):
+  """Test the trigram index used by the TitleFilter."""
+  def setUp(self):
+    self.records = synthetic.makeRecords(200, 'Movie', seed=6)
+    self.index = titleindex.TitleIndex()
+    self.index.update(columnstore.ColumnStore('Movie', self.records))
+
+  def scan(self, query:str):
+    """Search the records the simple way."""
+    query = titleindex.fold(query)
+    return {
+      record['id'] for record in self.records
+      if query in titleindex.fold(record['title']) or query in titleindex.fold(record['otitle'])
+    }
+
+  def test_fold(self):
+    """Polish diacritics, including ł, are folded into base letters."""
+    self.assertEqual(titleindex.fold('Zażółć gęślą jaźń'), 'zazolc gesla jazn')
+    self.assertEqual(titleindex.fold('ŁÓDŹ'), 'lodz')
+
+  def test_search(self):
+    """Results equal those of a linear scan, for short and long queries."""
+    for query in ['o', 'ży', 'ść', 'zyc', 'miłość', 'LOSC WOJNA', 'n\nd', 'qqq', '']:
+      self.assertEqual(self.index.search(query), self.scan(query), query)
+    self.assertEqual(len(self.index.search('')), len(self.records))
+
+  def test_incremental(self):
+    """Only the items whose titles have changed are reindexed."""
+    self.records[5]['title'] = 'Żółta łódź podwodna'
+    self.records[7]['otitle'] = 'Yellow Submarine'
+    removed = self.records.pop(9)
+    self.records.append(synthetic.makeRecord('Movie', 999999, random.Random(0)))
+    changed = self.index.update(columnstore.ColumnStore('Movie', self.records))
+    self.assertEqual(changed, 4)
+    self.assertEqual(len(self.index), len(self.records))
+    self.assertIn(self.records[5]['id'], self.index.search('zolta lodz'))
+    self.assertIn(self.records[7]['id'], self.index.search('submarine'))
+    self.assertNotIn(removed['id'], self.index.search(titleindex.fold(removed['title'])))
+    for query in ['lodz', 'zolta', 'ow', 'wojna']:
+      self.assertEqual(self.index.search(query), self.scan(query), query)
+    # no change at all
+    self.assertEqual(self.index.update(columnstore.ColumnStore('Movie', self.records)), 0)
+
+
+class TestFilterMachine(unittest.TestCase):
+  """Test combining the filters by the FilterMachine."""
+  def setUp(self):
+    records = synthetic.makeRecords(200, 'Movie', seed=3)
+    self.store = columnstore.ColumnStore('Movie', records)
+    self.machine = filters.FilterMachine(callback=lambda: None)
+    self.cheap = FakeFilter(0, 1, lambda item: item.getRawProperty('year') < 1970)
+    self.expensive = FakeFilter(1, 3, lambda item: item.getRawProperty('rating') > 5)
+    # register the expensive one first, to make sure it's not evaluated first
+    self.machine.registerFilter(self.expensive)
+    self.machine.registerFilter(self.cheap)
+
+  def test_inactive(self):
+    """With no active filters, everything passes and nothing is evaluated."""
+    mask = self.machine.getMask(self.store)
+    self.assertTrue(mask.all())
+    self.assertEqual(len(mask), len(self.store))
+    self.assertEqual(self.cheap.calls + self.expensive.calls, [])
+
+  def test_costs(self):
+    """Filters that only look up a precomputed mask are evaluated before the range ones."""
+    indexed = [filters.TitleFilter, filters.GenreFilter, filters.CountryFilter, filters.PlatformFilter]
+    ranged = [filters.YearFilter, filters.RatingFilter, filters.DateFilter]
+    for cheap in indexed:
+      for expensive in ranged:
+        self.assertLess(cheap.COST, expensive.COST)
+
+  def test_cheapestFirst(self):
+    """Filters are evaluated cheapest-first, each only on the passing rows."""
+    self.cheap.activate()
+    self.expensive.activate()
+    mask = self.machine.getMask(self.store)
+    views = self.store.views()
+    expected = [
+      v.getRawProperty('year') < 1970 and v.getRawProperty('rating') > 5 for v in views
+    ]
+    np.testing.assert_array_equal(mask, expected)
+    self.assertEqual(len(self.cheap.calls[0]), len(self.store))
+    passed = [row for row in range(len(self.store)) if views[row].getRawProperty('year') < 1970]
+    np.testing.assert_array_equal(self.expensive.calls[0], passed)
+
+  def test_shortCircuit(self):
+    """Once no rows are left, remaining filters are not evaluated at all."""
+    nothing = FakeFilter(2, 0, lambda item: False)
+    self.machine.registerFilter(nothing)
+    nothing.activate()
+    self.expensive.activate()
+    mask = self.machine.getMask(self.store)
+    self.assertFalse(mask.any())
+    self.assertEqual(self.expensive.calls, [])
+
+
+  def test_caching(self):
+    """Only the filter that has changed is evaluated again."""
+    self.cheap.activate()
+    self.expensive.activate()
+    first = self.machine.getMask(self.store)
+    self.assertEqual(len(self.cheap.calls), 1)
+    self.assertEqual(len(self.expensive.calls), 1)
+    # Nothing has changed - nothing is evaluated
+    np.testing.assert_array_equal(self.machine.getMask(self.store), first)
+    self.assertEqual(len(self.cheap.calls), 1)
+    self.assertEqual(len(self.expensive.calls), 1)
+    # The expensive one has changed - only it is evaluated
+    self.expensive.setPredicate(lambda item: item.getRawProperty('rating') > 2)
+    self.expensive.activate()
+    mask = self.machine.getMask(self.store)
+    self.assertEqual(len(self.cheap.calls), 1)
+    self.assertEqual(len(self.expensive.calls), 2)
+    expected = [
+      v.getRawProperty('year') < 1970 and v.getRawProperty('rating') > 2
+      for v in self.store.views()
+    ]
+    np.testing.assert_array_equal(mask, expected)
+    # A new store invalidates everything
+    store = columnstore.ColumnStore('Movie', synthetic.makeRecords(50, 'Movie', seed=4))
+    self.assertEqual(len(self.machine.getMask(store)), 50)
+    self.assertEqual(len(self.cheap.calls), 2)
+
+  def test_widening(self):
+    """Rows rejected by a filter are checked again if it has been widened."""
+    self.cheap.activate()
+    self.machine.getMask(self.store)
+    self.cheap.setPredicate(lambda item: item.getRawProperty('year') < 1990)
+    self.cheap.activate()
+    mask = self.machine.getMask(self.store)
+    self.assertEqual(len(self.cheap.calls[-1]), len(self.store))
+    expected = [v.getRawProperty('year') < 1990 for v in self.store.views()]
+    np.testing.assert_array_equal(mask, expected)
+
+  def test_narrowing(self):
+    """A narrowed filter is only evaluated on the rows that passed it before."""
+    self.cheap.activate()
+    self.expensive.activate()
+    self.machine.getMask(self.store)
+    views = self.store.views()
+    passed = [row for row, v in enumerate(views) if v.getRawProperty('year') < 1970]
+    self.cheap.setPredicate(lambda item: item.getRawProperty('year') < 1950)
+    self.cheap.activate(narrowing=True)
+    mask = self.machine.getMask(self.store)
+    np.testing.assert_array_equal(self.cheap.calls[-1], passed)
+    expected = [
+      v.getRawProperty('year') < 1950 and v.getRawProperty('rating') > 5 for v in views
+    ]
+    np.testing.assert_array_equal(mask, expected)
+    # The expensive filter has been evaluated once for each of these rows
+    self.assertEqual(sum(len(rows) for rows in self.expensive.calls), len(passed))
+
+  def test_reset(self):
+    """A reset filter is not evaluated, and forgets its results."""
+    self.cheap.activate()
+    self.machine.getMask(self.store)
+    self.cheap.reset()
+    self.assertTrue(self.machine.getMask(self.store).all())
+    self.cheap.activate(narrowing=True)
+    self.machine.getMask(self.store)
+    self.assertEqual(len(self.cheap.calls[-1]), len(self.store))
+
+
+class TestNarrowing(unittest.TestCase):
+  """Test whether the filters recognize their criteria being narrowed."""
+  def setUp(self):
+    self.notifications = []
+    self.callback = lambda ID, function, narrowing=False, reset=False: \
+      self.notifications.append(narrowing)
+
+  def test_range(self):
+    """Range filters: both limits have to move inwards."""
+    year_filter = makeFilter(filters.YearFilter, ID=0, last_range=None, machineCallback=self.callback)
+    for low, high in [(1950, 1990), (1960, 1990), (1960, 1980), (1955, 1980), (1970, 1970)]:
+      year_filter.setRange('year', low, high)
+    self.assertEqual(self.notifications, [False, True, True, False, True])
+    year_filter._reset()
+    year_filter.setRange('year', 1970, 1970)
+    self.assertEqual(self.notifications[-1], False)
+
+  def test_title(self):
+    """Title filter: new search has to contain the previous one."""
+    title_filter = makeFilter(filters.TitleFilter, ID=0, index=titleindex.TitleIndex(),
+      ids=np.zeros(0, dtype=np.int64), last_search=None, machineCallback=self.callback
+    )
+    for search in ['ó', 'łó', 'łód', 'łódź', 'łó', 'x']:
+      title_filter.setSearch(search)
+    self.assertEqual(self.notifications, [False, True, True, True, False, False])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,234 @@
+import http.server
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import posterman
+
+
+class PosterServer():
+  """Serves fake posters over HTTP, holding every response until opened.
+
+  A poster's content is its own path, padded to a given size, except for paths
+  containing "missing", which are not found. Posters are served as JPEGs,
+  except for those with "png" in the path.
+  """
+  class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+      server = self.server.owner
+      with server.lock:
+        server.requests.append(self.path)
+      server.gate.wait(timeout=5)
+      if 'missing' in self.path:
+        self.send_error(404)
+        return
+      content = self.path.encode('utf-8').ljust(server.size)
+      self.send_response(200)
+      self.send_header('Content-Type', 'image/png' if 'png' in self.path else 'image/jpeg; charset=binary')
+      self.send_header('Content-Length', str(len(content)))
+      self.end_headers()
+      self.wfile.write(content)
+    def log_message(self, *args):
+      pass
+
+  def __init__(self):
+    self.gate = threading.Event()
+    self.lock = threading.Lock()
+    self.requests = []
+    self.size = 1000
+    self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.Handler)
+    self.server.owner = self
+    self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+
+  def waitForRequests(self, count:int):
+    deadline = time.monotonic() + 5
+    while len(self.requests) < count and time.monotonic() < deadline:
+      time.sleep(0.01)
+
+  def makeURL(self, pid, name='1.1.jpg'):
+    return '{}/po/00/00/{}/{}'.format(self.url, pid, name)
+
+  def close(self):
+    self.gate.set()
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+
+
+class TestPosterManager(unittest.TestCase):
+  """Test downloading of the posters in the background."""
+  @classmethod
+  def setUpClass(self):
+    self.server = PosterServer()
+
+  @classmethod
+  def tearDownClass(self):
+    self.server.close()
+
+  def setUp(self):
+    self.server.gate.set()
+    self.server.requests = []
+    self.cache = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.cache)
+    self.manager = self.makeManager()
+    # wait for the blank poster
+    self.assertEqual(self.manager.requestPoster('').result(), self.path(0))
+
+  def makeManager(self, max_size:int=None):
+    class LocalManager(posterman.PosterManager):
+      CACHE_DIR = self.cache
+      NO_POSTER = '{}/blank.jpg'.format(self.server.url)
+    manager = LocalManager(max_size)
+    self.addCleanup(manager.close)
+    return manager
+
+  def path(self, pid:int, ext:str='.jpg'):
+    return os.path.join(self.cache, '{}{}'.format(pid, ext))
+
+  def readPoster(self, path:str):
+    with open(path, 'rb') as poster:
+      return poster.read().decode('utf-8').strip()
+
+  def test_blank(self):
+    """The blank poster is downloaded on start, and not downloaded again."""
+    self.assertEqual(self.readPoster(self.path(0)), '/blank.jpg')
+    self.manager.close()
+    self.manager = self.makeManager()
+    self.assertIn(0, self.manager.cached)
+    self.assertEqual(self.server.requests, ['/blank.jpg'])
+
+  def test_async(self):
+    """Poster is requested without waiting for it, and then cached."""
+    self.server.gate.clear()
+    url = self.server.makeURL(123)
+    self.assertIsNone(self.manager.getCachedPath(url))
+    request = self.manager.requestPoster(url)
+    self.assertFalse(request.done())
+    # asking again while it downloads does not start another download
+    self.assertIs(self.manager.requestPoster(url), request)
+    self.server.gate.set()
+    path = request.result(timeout=5)
+    self.assertEqual(path, self.path(123))
+    self.assertEqual(self.readPoster(path), '/po/00/00/123/1.1.jpg')
+    self.assertEqual(self.manager.getCachedPath(url), path)
+    self.assertTrue(self.manager.requestPoster(url).done())
+    self.assertEqual(self.server.requests.count('/po/00/00/123/1.1.jpg'), 1)
+
+  def test_failure(self):
+    """If a poster cannot be downloaded, the blank one is given instead."""
+    url = self.server.makeURL(404).replace('1.1.jpg', 'missing.jpg')
+    self.assertEqual(self.manager.getPosterByURL(url), self.path(0))
+    self.assertIsNone(self.manager.getCachedPath(url))
+    self.assertFalse(os.path.exists(self.path(404)))
+
+  def test_readonly(self):
+    """If a poster cannot be written to the cache, the blank one is given, and it can be tried again."""
+    url = self.server.makeURL(7)
+    os.chmod(self.cache, 0o555)
+    self.addCleanup(os.chmod, self.cache, 0o755)
+    # permissions do not stop the superuser, so then writing has to fail by hand
+    replace = os.replace
+    if os.access(self.cache, os.W_OK):
+      replace = mock.Mock(side_effect=PermissionError)
+    with mock.patch('posterman.os.replace', replace):
+      self.assertEqual(self.manager.getPosterByURL(url), self.path(0))
+    self.assertEqual(self.manager.pending, {})
+    self.assertIsNone(self.manager.getCachedPath(url))
+    self.assertEqual(sorted(os.listdir(self.cache)), ['0.jpg'])
+    os.chmod(self.cache, 0o755)
+    self.assertEqual(self.manager.getPosterByURL(url), self.path(7))
+
+  def test_prefetch(self):
+    """Prefetched posters that have not started downloading are dropped by the next prefetch."""
+    self.server.gate.clear()
+    workers = self.manager.WORKERS
+    first = [self.server.makeURL(pid) for pid in range(1, 3 * workers + 1)]
+    self.manager.prefetch(first)
+    self.server.waitForRequests(1 + workers)
+    # one of the queued ones is needed right now - it must not be dropped
+    request = self.manager.requestPoster(first[-1])
+    second = [self.server.makeURL(pid) for pid in range(100, 100 + workers)]
+    self.manager.prefetch(first[:2] + second)
+    self.server.gate.set()
+    self.assertEqual(request.result(timeout=5), self.path(3 * workers))
+    for url in second:
+      self.assertEqual(self.manager.getPosterByURL(url), self.path(self.manager.getPosterID(url)))
+    self.manager.close()
+    self.manager.executor.shutdown(wait=True)
+    cached = set(self.manager.cached)
+    self.assertTrue(cached.issuperset(range(100, 100 + workers)))
+    # only the downloads that had started by the time of the second prefetch
+    self.assertEqual(len(cached.intersection(range(1, 3 * workers))), workers)
+    self.assertEqual(len(self.server.requests), 1 + 2 * workers + 1)
+
+  def test_close(self):
+    """Closing drops the downloads that have not started yet."""
+    self.server.gate.clear()
+    workers = self.manager.WORKERS
+    self.manager.prefetch([self.server.makeURL(pid) for pid in range(1, 3 * workers + 1)])
+    self.server.waitForRequests(1 + workers)
+    self.manager.close()
+    self.server.gate.set()
+    self.manager.executor.shutdown(wait=True)
+    self.assertEqual(len(self.server.requests), 1 + workers)
+    self.assertEqual(len(self.manager.cached), 1 + workers)
+
+  def test_types(self):
+    """Posters are named after the type given by the server, or else by the URL."""
+    self.assertEqual(self.manager.getPosterByURL(self.server.makeURL(1, 'png')), self.path(1, '.png'))
+    self.assertEqual(self.manager.getExtension('http://a/b/1.JPEG', None), '.jpg')
+    self.assertEqual(self.manager.getExtension('http://a/b/1.gif', ''), '.gif')
+    self.assertEqual(self.manager.getExtension('http://a/b/1.6', 'text/html'), '.jpg')
+
+  def test_eviction(self):
+    """Least recently used posters are removed once the cache is full, also after a restart."""
+    manager = self.makeManager(max_size=5 * self.server.size)
+    urls = [self.server.makeURL(pid) for pid in range(1, 5)]
+    for url in urls:
+      manager.getPosterByURL(url)
+    # make the first one the most recently used
+    self.assertEqual(manager.getCachedPath(urls[0]), self.path(1))
+    manager.getPosterByURL(self.server.makeURL(5))
+    self.assertEqual(list(manager.cached.keys()), [0, 3, 4, 1, 5])
+    self.assertFalse(os.path.exists(self.path(2)))
+    self.assertEqual(manager.size, 5 * self.server.size)
+    # the order of use is remembered on disk (file times may be too coarse to
+    # tell the order of the uses above, so they are set explicitly)
+    manager.close()
+    for time, pid in enumerate([0, 3, 4, 1, 5]):
+      os.utime(self.path(pid), (time, time))
+    manager = self.makeManager(max_size=3 * self.server.size)
+    self.assertEqual(list(manager.cached.keys()), [0, 1, 5])
+    self.assertIn(0, manager.cached.keys())
+    self.assertEqual(sorted(os.listdir(self.cache)), ['0.jpg', '1.jpg', '5.jpg'])
+
+  def test_concurrent(self):
+    """Many threads requesting the same posters get them downloaded once each."""
+    urls = [self.server.makeURL(pid) for pid in range(1, 21)]
+    manager = self.makeManager(max_size=10 * self.server.size)
+    def request(offset):
+      for i in range(len(urls)):
+        manager.getPosterByURL(urls[(i + offset) % len(urls)])
+    threads = [threading.Thread(target=request, args=(offset,)) for offset in range(0, 20, 4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    # a poster can be downloaded again only after it has been evicted
+    self.assertEqual(len(set(self.server.requests)), 1 + len(urls))
+    self.assertLessEqual(manager.size, 10 * self.server.size)
+    files = [name for name in os.listdir(self.cache)]
+    self.assertEqual(sorted(files), sorted(filename for filename, _ in manager.cached.values()))
+    self.assertEqual(manager.size, sum(size for _, size in manager.cached.values()))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,351 @@
+from collections import OrderedDict
+import json
+import os
+import random
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import columnstore
+import presenter
+import synthetic
+
+
+class FakeTree(object):
+  """Stands in for a ttk.Treeview, counting the calls made to it."""
+  def __init__(self):
+    self.rows = []    # attached rows, in order
+    self.attached = set()
+    self.values = {}  # all rows, including detached ones
+    self.calls = 0
+    self.inserts = 0
+  def get_children(self):
+    self.calls += 1
+    return tuple(self.rows)
+  def insert(self, parent, index, iid, text='', values=[]):
+    self.calls += 1
+    self.inserts += 1
+    if iid in self.values.keys():
+      raise ValueError('Item {} already exists'.format(iid))
+    self.values[iid] = values
+    self.attach(iid, index)
+    return iid
+  def attach(self, iid, index):
+    self.rows.insert(len(self.rows) if index == 'end' else index, iid)
+    self.attached.add(iid)
+  def move(self, iid, parent, index):
+    self.calls += 1
+    # moving an attached row is never needed, and its semantics are tricky
+    if iid in self.attached:
+      raise ValueError('Item {} is attached'.format(iid))
+    self.attach(iid, index)
+  def detach(self, *iids):
+    self.calls += 1
+    self.attached.difference_update(iids)
+    self.rows = [iid for iid in self.rows if iid in self.attached]
+  def delete(self, *iids):
+    self.detach(*iids)
+    for iid in iids:
+      self.values.pop(iid)
+  def displayedIDs(self):
+    return [self.values[iid][0] for iid in self.rows]
+
+
+class FakeHeadings(object):
+  """Stands in for a ttk.Treeview, holding only the column headings."""
+  def __init__(self):
+    self.headings = {}
+  def heading(self, column, option=None, text=None):
+    if option == 'text':
+      return self.headings.setdefault(column, column)
+    self.headings[column] = text
+
+
+class FakeConfig(object):
+  def __init__(self, all_columns:list, columns:list):
+    self.all_columns = all_columns
+    self.columns = columns
+  def getAllColumns(self):
+    return self.all_columns
+  def getColumns(self):
+    return self.columns
+
+
+class FakeWidget(object):
+  """Accepts (and ignores) any calls."""
+  def __getattr__(self, name):
+    return lambda *args, **kwargs: None
+
+
+class FakePosterManager(object):
+  """Remembers the posters it was asked to prefetch."""
+  def __init__(self):
+    self.prefetched = []
+  def prefetch(self, urls:list):
+    self.prefetched = urls
+
+
+class FakeDetailWindow(object):
+  def __init__(self):
+    self.posterManager = FakePosterManager()
+
+
+def makePresenter(items:list):
+  """Create a Presenter without its GUI, holding a given list of items."""
+  p = presenter.Presenter.__new__(presenter.Presenter)
+  p.tree = FakeTree()
+  p.yScroll = FakeWidget()
+  p.stats = FakeWidget()
+  p.detailWindow = FakeDetailWindow()
+  p.config = FakeConfig(['title', 'year', 'genres', 'rating'], ['title', 'rating'])
+  p.items = items
+  p.displayed = 0
+  p.shown = []
+  p.known = set()
+  p.firstVisible = 0
+  return p
+
+
+class TestVirtualDisplay(unittest.TestCase):
+  """Test that only the visible part of the items is inserted into the tree."""
+  def setUp(self):
+    self.items = synthetic.makeItems(1000, 'Movie')
+    self.presenter = makePresenter(self.items)
+    self.window = presenter.Presenter.TREE_HEIGHT + presenter.Presenter.DISPLAY_CHUNK
+
+  def test_window(self):
+    """Display a window of items, in the reverse order, with only the chosen columns."""
+    self.presenter.displayUpdate()
+    tree = self.presenter.tree
+    self.assertEqual(len(tree.rows), self.window)
+    expected = [item['id'] for item in reversed(self.items)][:self.window]
+    self.assertEqual(tree.displayedIDs(), expected)
+    values = tree.values[tree.rows[0]]
+    self.assertEqual(values, [self.items[-1]['id'], self.items[-1]['title'], '', '', self.items[-1]['rating']])
+
+  def test_scrolling(self):
+    """Rows are added when scrolled close to the end, until all items are there."""
+    p = self.presenter
+    p.displayUpdate()
+    # the view is far from the end
+    p._treeScrolled('0.0', '0.2')
+    self.assertEqual(len(p.tree.rows), self.window)
+    # the view is near the end
+    p._treeScrolled('0.7', '0.9')
+    self.assertEqual(len(p.tree.rows), self.window + presenter.Presenter.DISPLAY_CHUNK)
+    while p.displayed < len(self.items):
+      p._treeScrolled('0.9', '1.0')
+    expected = [item['id'] for item in reversed(self.items)]
+    self.assertEqual(p.tree.displayedIDs(), expected)
+    p._treeScrolled('0.9', '1.0')
+    self.assertEqual(len(p.tree.rows), len(self.items))
+
+  def test_prefetch(self):
+    """Posters of the items in view are prefetched, also after scrolling."""
+    p = self.presenter
+    height = presenter.Presenter.TREE_HEIGHT
+    expected = [item.getRawProperty('imglink') for item in reversed(self.items)]
+    p.displayUpdate()
+    self.assertEqual(p.detailWindow.posterManager.prefetched, expected[:height])
+    p._treeScrolled('0.5', '0.7')
+    first = self.window // 2
+    self.assertEqual(p.detailWindow.posterManager.prefetched, expected[first:first + height])
+
+  def test_redisplay(self):
+    """A new display replaces the old one, also when there's less items than the window."""
+    p = self.presenter
+    p.displayUpdate()
+    p.items = self.items[:10]
+    p.displayUpdate()
+    self.assertEqual(p.tree.displayedIDs(), [item['id'] for item in reversed(self.items[:10])])
+    p.items = []
+    p.displayUpdate()
+    self.assertEqual(p.tree.rows, [])
+
+
+class TestDiffDisplay(unittest.TestCase):
+  """Test that the tree is updated with as few calls as possible."""
+  def setUp(self):
+    self.items = synthetic.makeItems(100, 'Movie')
+    self.presenter = makePresenter(list(self.items))
+    self.presenter.displayUpdate()
+
+  def display(self, items:list):
+    """Display a new list of items, returning the number of calls made to the tree."""
+    tree = self.presenter.tree
+    calls = tree.calls
+    self.presenter.items = items
+    self.presenter.displayUpdate()
+    self.assertEqual(tree.displayedIDs(), [item['id'] for item in reversed(items)])
+    self.assertEqual(tree.rows, [item['id'] for item in reversed(items)])
+    return tree.calls - calls
+
+  def test_longestIncreasing(self):
+    """Indices of the longest increasing subsequence."""
+    lis = presenter.Presenter.longestIncreasing
+    self.assertEqual(lis([]), [])
+    self.assertEqual(lis([3, 2, 1]), [2])
+    self.assertEqual(lis([0, 1, 2]), [0, 1, 2])
+    self.assertEqual(lis([5, 0, 6, 1, 2, 7, 3]), [1, 3, 4, 6])
+
+  def test_unchanged(self):
+    """Displaying the same items makes no calls at all."""
+    self.assertEqual(self.display(list(self.items)), 0)
+
+  def test_removal(self):
+    """Removing items detaches them in a single call."""
+    self.assertEqual(self.display(self.items[:40] + self.items[45:]), 1)
+    self.assertEqual(self.display(self.items[10:20]), 1)
+
+  def test_reattach(self):
+    """Items displayed again are reattached, not inserted."""
+    self.display(self.items[:50])
+    inserts = self.presenter.tree.inserts
+    calls = self.display(list(self.items))
+    self.assertEqual(self.presenter.tree.inserts, inserts)
+    self.assertEqual(calls, 50)
+
+  def test_reordering(self):
+    """Moving an item only moves that one, reversing the list moves all but one."""
+    items = list(self.items)
+    items.insert(10, items.pop(70))
+    self.assertEqual(self.display(items), 2)
+    self.assertEqual(self.display(items[::-1]), 1 + len(items) - 1)
+
+  def test_random(self):
+    """Random filtering and sorting always gives the right display."""
+    rng = random.Random(0)
+    for _ in range(20):
+      items = rng.sample(self.items, rng.randint(0, len(self.items)))
+      key = rng.choice(['year', 'rating', 'title'])
+      items.sort(key=lambda item: item.getRawProperty(key))
+      self.display(items)
+
+  def test_clear(self):
+    """Clearing the tree deletes all the rows, detached ones too."""
+    self.display(self.items[:10])
+    self.presenter.clearTree()
+    self.assertEqual(self.presenter.tree.values, {})
+    self.display(self.items[:10])
+
+
+class TestSorting(unittest.TestCase):
+  """Test sorting the rows of a ColumnStore by the SortingMachine."""
+  @classmethod
+  def setUpClass(self):
+    records = synthetic.makeRecords(300, 'Movie', seed=7)
+    for i, record in enumerate(records):
+      if i % 11 == 0:
+        record.pop('year')
+        record.pop('fwRating')
+      if i % 13 == 0:
+        record['userdata'] = {}
+      if i % 5 == 0:
+        # make some ties
+        record['title'] = 'Tytuł'
+    self.store = columnstore.ColumnStore('Movie', records)
+    self.views = self.store.views()
+    self.mask = np.array([i % 3 != 0 for i in range(len(self.store))])
+
+  def makeMachine(self, chain:list, columns=['title', 'year', 'rating', 'dateOf']):
+    machine = presenter.SortingMachine.__new__(presenter.SortingMachine)
+    machine.tree = FakeHeadings()
+    machine.columns = columns
+    machine.chain = []
+    machine.original_headings = {}
+    machine.store = None
+    machine.ranks = {}
+    machine.permutations = {}
+    machine.firstRun('Movie', chain)
+    return machine
+
+  def expected(self, chain:list):
+    """Sort the passing rows by a chain the regular way: one stable sort per column."""
+    rows = list(np.flatnonzero(self.mask))
+    for column, ascending in reversed(chain):
+      def key(row):
+        value = self.store.get(row, column)
+        return (value is not None, value if value is not None else 0)
+      rows.sort(key=key, reverse=ascending)
+    return rows
+
+  def test_columns(self):
+    """Sort by columns of all kinds, with missing values first."""
+    for column in ['year', 'fwRating', 'title', 'genres', 'dateOf', 'rating']:
+      expected = self.expected([(column, False)])
+      machine = self.makeMachine([(column, False)], columns=[column])
+      self.assertEqual(list(machine.sortRows(self.store, self.mask)), expected, column)
+      # the other direction is the same list reversed (ties included)
+      machine.chain[0][1] = True
+      self.assertEqual(list(machine.sortRows(self.store, self.mask)), expected[::-1], column)
+
+  def test_chains(self):
+    """Sort by chains of columns in all combinations of directions."""
+    for directions in [(False, False, False), (True, False, True), (False, True, False), (True, True, True)]:
+      chain = list(zip(['rating', 'dateOf', 'title'], directions))
+      machine = self.makeMachine(chain)
+      result = list(machine.sortRows(self.store, self.mask))
+      if directions[0]:
+        # tied rows are reversed in this case
+        def tie(row):
+          return tuple(self.store.get(row, column) for column, _ in chain)
+        self.assertEqual([tie(row) for row in result], [tie(row) for row in self.expected(chain)])
+      else:
+        self.assertEqual(result, self.expected(chain), directions)
+
+  def test_clicks(self):
+    """Clicks change the chain and the markers on the headings."""
+    machine = self.makeMachine(None)
+    headings = machine.tree.headings
+    self.assertEqual(machine.getSorting(), [['dateOf', False]])
+    self.assertEqual(headings['dateOf'], '▼ dateOf')
+    machine.update('rating', add=True)
+    machine.update('title', add=True)
+    machine.update('title', add=True)
+    self.assertEqual(machine.getSorting(), [['dateOf', False], ['rating', False], ['title', True]])
+    self.assertEqual([headings[c] for c in ['dateOf', 'rating', 'title']], ['▼1 dateOf', '▼2 rating', '▲3 title'])
+    machine.update('dateOf')
+    self.assertEqual(machine.getSorting()[0], ['dateOf', True])
+    machine.update('year')
+    self.assertEqual(machine.getSorting(), [['year', False]])
+    self.assertEqual([headings[c] for c in ['dateOf', 'rating', 'title', 'year']], ['dateOf', 'rating', 'title', '▼ year'])
+
+  def test_cache(self):
+    """Ranks and permutations are computed once per store."""
+    machine = self.makeMachine([('year', False)])
+    permutation = machine.getPermutation(self.store, machine.chain)
+    self.assertIs(machine.getPermutation(self.store, [['year', True]]), permutation)
+    chain = [['year', False], ['rating', True]]
+    permutation = machine.getPermutation(self.store, chain)
+    self.assertIs(machine.getPermutation(self.store, [['year', True], ['rating', False]]), permutation)
+    self.assertIsNot(machine.getPermutation(self.store, [['year', True], ['rating', True]]), permutation)
+    store = columnstore.ColumnStore('Movie', synthetic.makeRecords(10, 'Movie'))
+    self.assertEqual(len(machine.getPermutation(store, chain)), 10)
+
+  def test_unsorted(self):
+    """With no sorting chosen, rows keep their order."""
+    machine = self.makeMachine([('nonexistent', False)])
+    self.assertEqual(list(machine.sortRows(self.store, self.mask)), list(np.flatnonzero(self.mask)))
+
+
+class TestConfigString(unittest.TestCase):
+  """Test the serialization of the Presenter's Config."""
+  def test_formats(self):
+    """Both the current and the old format are read, and missing config means defaults."""
+    columns = OrderedDict(year=None, title=250)
+    sorting = [['rating', False], ['title', True]]
+    string = json.dumps(OrderedDict(columns=columns, sorting=sorting))
+    self.assertEqual(presenter.Config.parseString('Movie', string), (columns, sorting))
+    self.assertEqual(presenter.Config.parseString('Movie', json.dumps(columns)), (columns, None))
+    self.assertEqual(
+      presenter.Config.parseString('Movie', ''),
+      (presenter.DEFAULT_CONFIGS['Movie'], None)
+    )
+    # column order is preserved
+    parsed, _ = presenter.Config.parseString('Movie', string)
+    self.assertEqual(list(parsed.keys()), ['year', 'title'])
+
+if __name__ == "__main__":
+  unittest.main()
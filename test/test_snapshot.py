@@ -0,0 +1,191 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import containers
+import database
+import snapshot
+import synthetic
+import userdata
+from columnstore import ColumnStore
+
+
+class TestSnapshot(unittest.TestCase):
+  """Test writing the ColumnStores to snapshots and reading them back lazily."""
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+    self.path = os.path.join(self.directory, 'movies.snap')
+    self.records = synthetic.makeRecordsWithGaps(500)
+    self.store = ColumnStore('Movie', self.records)
+    snapshot.write(self.path, self.store)
+
+  def load(self, itemtype:str='Movie'):
+    loaded = snapshot.load(self.path, itemtype)
+    # the mapping has to be closed before the file can be removed (on Windows)
+    self.addCleanup(lambda: loaded.columns.clear())
+    return loaded
+
+  def test_roundtrip(self):
+    """Stores of all types are read back the same, also when empty."""
+    loaded = self.load()
+    self.assertEqual(len(loaded), len(self.store))
+    self.assertEqual([loaded.getRecord(row) for row in range(len(loaded))], self.records)
+    for itemtype in ['Series', 'Game']:
+      records = synthetic.makeRecordsWithGaps(50, itemtype)
+      snapshot.write(self.path, ColumnStore(itemtype, records))
+      loaded = self.load(itemtype)
+      self.assertEqual([loaded.getRecord(row) for row in range(len(loaded))], records)
+    snapshot.write(self.path, ColumnStore('Game'))
+    self.assertEqual(len(self.load('Game')), 0)
+
+  def test_lazy(self):
+    """Strings are only decoded when needed, numbers are read straight from the file."""
+    loaded = self.load()
+    self.assertFalse(loaded.getColumn('year').values.flags.owndata)
+    for row in range(10):
+      loaded.getRecord(row)
+    for name in ['title', 'genres', 'plot', 'cast']:
+      self.assertLessEqual(len(loaded.getColumn(name).decoded), 10)
+    # decoding the whole column at once gives the same values
+    column = loaded.getColumn('genres')
+    self.assertEqual(column.values, self.store.getColumn('genres').values)
+    self.assertEqual(column.present().tolist(), self.store.getColumn('genres').present().tolist())
+    self.assertEqual(loaded.getColumn('year').present().tolist(), self.store.getColumn('year').present().tolist())
+
+  def test_lists(self):
+    """Empty lists, lists of an empty string and missing lists remain different."""
+    loaded = self.load()
+    self.assertEqual(list(loaded.get(13, 'genres')), [])
+    self.assertEqual(list(loaded.get(17, 'genres')), [''])
+    store = ColumnStore('Movie', [{'id': 1, 'title': 'no lists at all'}])
+    snapshot.write(self.path, store)
+    loaded = self.load()
+    self.assertEqual(loaded.getRecord(0), store.getRecord(0))
+    # equal strings are shared, like in a ListColumn
+    snapshot.write(self.path, self.store)
+    loaded = self.load()
+    genres = [loaded.get(row, 'genres') for row in range(len(loaded))]
+    shared = {}
+    for values in genres:
+      for value in values:
+        self.assertIs(shared.setdefault(value, value), value)
+
+  def test_copy_on_write(self):
+    """Changing the loaded store does not change the file."""
+    loaded = self.load()
+    loaded.set(0, 'title', 'Changed')
+    loaded.set(1, 'year', 1900)
+    self.assertEqual(loaded.get(0, 'title'), 'Changed')
+    self.assertEqual(loaded.get(1, 'year'), 1900)
+    again = self.load()
+    self.assertEqual(again.getRecord(0), self.records[0])
+    self.assertEqual(again.getRecord(1), self.records[1])
+
+  def test_broken(self):
+    """Files that are not snapshots, or of another type, or truncated, are rejected."""
+    with self.assertRaises(ValueError):
+      snapshot.load(self.path, 'Game')
+    with open(self.path, 'rb') as snapshot_file:
+      data = snapshot_file.read()
+    broken = os.path.join(self.directory, 'broken.snap')
+    for contents in [b'', b'FILMATYK' + data[8:], data[:len(data) // 2]]:
+      with open(broken, 'wb') as snapshot_file:
+        snapshot_file.write(contents)
+      with self.assertRaises(ValueError):
+        snapshot.load(broken, 'Movie')
+
+  def test_blueprints(self):
+    """A column whose kind has changed since the snapshot was made is left empty."""
+    blueprint = containers.classByString['Movie'].blueprints['year']
+    kind = blueprint.kind
+    blueprint.kind = 'str'
+    try:
+      loaded = self.load()
+    finally:
+      blueprint.kind = kind
+    self.assertEqual(loaded.getColumn('year').present().tolist(), [False] * len(loaded))
+    self.assertEqual(loaded.get(0, 'title'), self.records[0]['title'])
+
+  def test_database(self):
+    """A Database restored from a snapshot is the same as one restored from the string."""
+    db = database.Database('Movie', None, None)
+    db.loadRecords(self.records)
+    string = db.storeToString()
+    db.storeToSnapshot(self.path)
+    for compact in [True, False]:
+      restored = database.Database('Movie', None, None, compact)
+      restored.loadSnapshot(self.path)
+      self.assertEqual(restored.storeToString(), string)
+      id = self.records[7]['id']
+      self.assertEqual(restored.getItemByID(id).asDict(), self.records[7])
+      self.addCleanup(lambda: restored.store.columns.clear())
+
+  def test_changes(self):
+    """Replaying changes and moving the items only decodes the strings of the changed ones."""
+    compact = database.Database('Movie', None, None, compact=True)
+    compact.loadSnapshot(self.path)
+    self.addCleanup(lambda: compact.store.columns.clear())
+    regular = database.Database('Movie', None, None)
+    regular.loadRecords(self.records)
+    added = dict(self.records[3], id=-1, plot='Added')
+    changed = dict(self.records[5], plot='Changed')
+    changes = [{'head': [-1, changed['id']], 'records': [added, changed], 'removed': [self.records[0]['id']]}]
+    held = compact.items[10]
+    for db in [compact, regular]:
+      db.applyChanges(changes)
+      db.setItems(db.items[1:] + db.items[:1])
+    column = compact.getStore().getColumn('plot')
+    self.assertIsInstance(column, snapshot.MappedObjectColumn)
+    self.assertLessEqual(len(column.decoded), 2)
+    self.assertEqual(compact.getItemByID(-1).getRawProperty('plot'), 'Added')
+    self.assertIs(compact.getItemByID(self.records[10]['id']), held)
+    self.assertEqual(held.asDict(), self.records[10])
+    self.assertEqual(compact.storeToString(), regular.storeToString())
+
+
+class TestSnapshotFiles(unittest.TestCase):
+  """Test the stamps of the databases and finding their snapshots."""
+  VERSION = '1.0.0-beta.5'
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+    self.manager = userdata.DataManager(os.path.join(self.directory, 'filmatyk.dat'), self.VERSION)
+
+  def test_stamps(self):
+    """Stamps are saved in the file, and dropped when a database is replaced in the journal."""
+    data = userdata.UserData(movies_data=json.dumps(synthetic.makeRecordsWithGaps(10)), games_data='[]')
+    data.stamps = {field: self.manager.makeStamp(getattr(data, field)) for field in data.DATABASES}
+    self.manager.save(data)
+    self.assertEqual(self.manager.load().stamps, data.stamps)
+    self.manager.appendChanges({'games_data': '[]'}, {})
+    loaded = self.manager.load()
+    self.assertNotIn('games_data', loaded.stamps)
+    self.assertEqual(loaded.stamps['movies_data'], data.stamps['movies_data'])
+    # files without the stamps have none
+    userdata.SectionFile.write(self.manager.path, [('version', self.VERSION), ('movies_data', '[]')])
+    os.remove(self.manager.journal_path)
+    self.assertEqual(self.manager.load().stamps, {})
+
+  def test_find(self):
+    """The snapshot including the most of the journaled changes is found, and the rest removed."""
+    stamp = self.manager.makeStamp('[]')
+    for journaled in [0, 2, 5]:
+      snapshot.write(self.manager.snapshotPath('movies_data', stamp, journaled), ColumnStore('Movie'))
+    self.assertEqual(self.manager.findSnapshot('movies_data', stamp, 1)[1], 0)
+    self.assertEqual(self.manager.findSnapshot('movies_data', stamp, 4)[1], 2)
+    self.assertEqual(self.manager.findSnapshot('movies_data', stamp, 10)[1], 5)
+    self.assertEqual(self.manager.findSnapshot('movies_data', stamp + 1, 10), (None, 0))
+    self.assertEqual(self.manager.findSnapshot('games_data', stamp, 10), (None, 0))
+    keep = self.manager.snapshotPath('movies_data', stamp, 5)
+    self.manager.removeSnapshots('movies_data', keep=keep)
+    self.assertEqual(sorted(os.listdir(self.directory)), [os.path.basename(keep)])
+
+
+if __name__ == "__main__":
+  unittest.main()
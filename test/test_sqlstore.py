@@ -0,0 +1,204 @@
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from datetime import date
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import database
+import sqlstore
+import synthetic
+import userdata
+
+
+class TestSQLStore(unittest.TestCase):
+  """Test saving and loading of the records, and the queries, against the plain ones."""
+  def setUp(self):
+    self.store = sqlstore.SQLStore()
+    self.addCleanup(self.store.close)
+    self.records = synthetic.makeRecordsWithGaps(300)
+    self.store.save('Movie', self.records)
+
+  def makeDatabase(self, records:list):
+    db = database.Database('Movie', None, lambda *args, **kwargs: None)
+    db.loadRecords(records)
+    return db
+
+  def test_roundtrip(self):
+    """Records of all types are loaded back the same, and in order."""
+    self.assertEqual(self.store.load('Movie'), self.records)
+    for itemtype in ['Series', 'Game']:
+      records = synthetic.makeRecordsWithGaps(100, itemtype)
+      self.store.save(itemtype, records)
+      self.assertEqual(self.store.load(itemtype), records)
+    # types do not interfere with each other
+    self.assertEqual(self.store.count('Movie'), len(self.records))
+    self.assertEqual(json.loads(self.store.exportString('Movie')), self.records)
+
+  def test_schema(self):
+    """Tables of the list properties and the indexes exist."""
+    self.store.getTable('Game')
+    names = set(name for name, in self.store.connection.execute('SELECT name FROM sqlite_master'))
+    for name in ['movie', 'genres', 'cast', 'movie_cast', 'game_platforms', 'game_publishers']:
+      self.assertIn(name, names)
+    for name in ['movie_year', 'movie_rating', 'movie_dateOf', 'game_dateOf']:
+      self.assertIn(name, names)
+    plan = self.store.connection.execute(
+      'EXPLAIN QUERY PLAN SELECT id FROM movie WHERE year BETWEEN 1990 AND 2000'
+    ).fetchall()
+    self.assertIn('movie_year', str(plan))
+
+  def test_save(self):
+    """Saving again updates, adds and removes items, and reorders them."""
+    added = [dict(record, id=record['id'] + 1000) for record in synthetic.makeRecordsWithGaps(20, seed=1)]
+    records = [dict(record) for record in self.records[50:150] + added + self.records[:50]]
+    for record in records[::7]:
+      record['title'] = 'Changed'
+      record['cast'] = ['somebody new']
+    self.store.save('Movie', records)
+    self.assertEqual(self.store.load('Movie'), records)
+    # values of the removed items are not left behind
+    junction = self.store.connection.execute('SELECT COUNT(*) FROM movie_cast').fetchone()[0]
+    self.assertEqual(junction, sum(len(record['cast']) for record in records))
+
+  def test_transaction(self):
+    """Nothing is saved if any of the records fails."""
+    records = synthetic.makeRecordsWithGaps(10, seed=2) + [dict(self.records[0], year=[1990])]
+    with self.assertRaises(sqlite3.Error):
+      self.store.save('Movie', records)
+    changes = [{'head': [5, 1], 'records': [dict(self.records[5], year={})], 'removed': [2]}]
+    with self.assertRaises(sqlite3.Error):
+      self.store.applyChanges('Movie', changes)
+    self.assertEqual(self.store.load('Movie'), self.records)
+
+  def test_changes(self):
+    """Changes are replayed the same as on a Database."""
+    rng = random.Random(3)
+    new = iter([dict(record, id=record['id'] + 1000) for record in synthetic.makeRecordsWithGaps(50, seed=4)])
+    ids = [record['id'] for record in self.records]
+    changes = []
+    for _ in range(5):
+      head = rng.sample(ids, 10)
+      added = [next(new) for _ in range(rng.randint(0, 5))]
+      changed = [dict(self.records[ids.index(id)], title='Changed') for id in head[:3]]
+      changes.append({
+        'head': [record['id'] for record in added] + head,
+        'records': added + changed,
+        'removed': rng.sample(ids, 3),
+      })
+    db = self.makeDatabase(self.records)
+    db.applyChanges(changes)
+    self.store.applyChanges('Movie', changes)
+    self.assertEqual(self.store.load('Movie'), [item.asDict() for item in db])
+    # replaying is idempotent
+    self.store.applyChanges('Movie', changes)
+    self.assertEqual(self.store.load('Movie'), [item.asDict() for item in db])
+
+  def test_database(self):
+    """Database is saved to the store and restored from it, its changes left in place."""
+    db = self.makeDatabase(self.records[:100])
+    self.store.saveDatabase(db)
+    restored = database.Database('Movie', None, None, compact=True)
+    self.store.restoreDatabase(restored)
+    self.assertEqual(restored.storeToString(), db.storeToString())
+    # only the changes go to the store now
+    changes = [{'head': [self.records[200]['id']], 'records': [self.records[200]], 'removed': []}]
+    db.applyChanges(changes)
+    db.changes = list(changes)
+    self.store.saveDatabase(db, changes)
+    self.assertEqual(self.store.load('Movie'), [item.asDict() for item in db])
+    self.assertEqual(db.popChanges(), changes)
+
+  def test_select(self):
+    """Selected IDs are the same as those of the items filtered in Python, and sorted."""
+    db = self.makeDatabase(self.records)
+    def expected(passes):
+      return [item.getRawProperty('id') for item in db if passes(item.getRawProperty)]
+    def within(prop, low, high):
+      return lambda get: get(prop) != '' and (low is None or get(prop) >= low) and (high is None or get(prop) <= high)
+    cases = [
+      ({'year': (1990, 2000)}, {}, within('year', 1990, 2000)),
+      ({'rating': (None, 4)}, {}, within('rating', None, 4)),
+      ({'dateOf': (date(2010, 1, 1), None)}, {}, within('dateOf', date(2010, 1, 1), None)),
+      ({}, {'genres': ('any', ['genres 1', 'genres 2'])}, lambda get: {'genres 1', 'genres 2'} & set(get('genres'))),
+      ({}, {'genres': ('all', ['genres 1', 'genres 2'])}, lambda get: {'genres 1', 'genres 2'} <= set(get('genres'))),
+      ({}, {'genres': ('exactly', ['genres 3'])}, lambda get: list(get('genres')) == ['genres 3']),
+      (
+        {'year': (1980, None)}, {'countries': ('any', ['countries 5', 'countries 6'])},
+        lambda get: within('year', 1980, None)(get) and {'countries 5', 'countries 6'} & set(get('countries'))
+      ),
+    ]
+    for ranges, values, passes in cases:
+      selected = self.store.select('Movie', ranges, values)
+      self.assertTrue(selected)
+      self.assertEqual(selected, expected(passes), (ranges, values))
+    # missing values are the lowest, and equal items remain in their order
+    for sorting in [[('year', True)], [('rating', False), ('title', True)], [('dateOf', True), ('fwRating', False)]]:
+      selected = self.store.select('Movie', sorting=sorting)
+      self.assertEqual(sorted(selected), sorted(db.index.keys()))
+      def key(id):
+        values = [db.getItemByID(id).getRawProperty(prop) for prop, _ in sorting]
+        return [(value != '', value) for value in values]
+      for first, second in zip(selected, selected[1:]):
+        for (prop, ascending), a, b in zip(sorting, key(first), key(second)):
+          if a != b:
+            self.assertEqual(a < b, ascending, sorting)
+            break
+        else:
+          self.assertLess(db.index[first], db.index[second])
+    with self.assertRaises(KeyError):
+      self.store.select('Movie', ranges={'genres': (1, 2)})
+    with self.assertRaises(ValueError):
+      self.store.select('Movie', values={'genres': ('some', ['genres 1'])})
+
+
+class TestMigration(unittest.TestCase):
+  """Test copying the databases from the user data file to the store, and back."""
+  VERSION = '1.0.0-beta.5'
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+    self.manager = userdata.DataManager(os.path.join(self.directory, 'filmatyk.dat'), self.VERSION)
+
+  def test_migrate(self):
+    """Databases and their journaled changes are migrated, also to a file that survives a restart."""
+    fields = {name: '' for name in userdata.UserData.FIELDS}
+    records = {
+      'Movie': synthetic.makeRecordsWithGaps(200), 'Series': synthetic.makeRecordsWithGaps(50, 'Series'), 'Game': synthetic.makeRecordsWithGaps(30, 'Game'),
+    }
+    for itemtype, field in sqlstore.SQLStore.FIELDS.items():
+      fields[field] = json.dumps(records[itemtype])
+    data = userdata.UserData(**fields)
+    data.stamps = {field: self.manager.makeStamp(getattr(data, field)) for field in data.DATABASES}
+    self.manager.save(data)
+    change = {'head': [records['Movie'][9]['id']], 'records': [], 'removed': [records['Movie'][0]['id']]}
+    self.manager.appendChanges({}, {'movies_data': [change]})
+    loaded = self.manager.load()
+    path = os.path.join(self.directory, 'filmatyk.sqlite')
+    store = sqlstore.SQLStore(path)
+    store.migrate(loaded)
+    store.close()
+    store = sqlstore.SQLStore(path)
+    self.addCleanup(store.close)
+    movies = records['Movie']
+    self.assertEqual(store.load('Movie'), [movies[9]] + movies[1:9] + movies[10:])
+    for itemtype in ['Series', 'Game']:
+      self.assertEqual(store.load(itemtype), records[itemtype])
+      self.assertEqual(json.loads(store.exportString(itemtype)), json.loads(getattr(loaded, sqlstore.SQLStore.FIELDS[itemtype])))
+    # the store knows which version of each database it holds
+    self.assertEqual(store.getState('movies_data'), (data.stamps['movies_data'], 1))
+    self.assertEqual(store.getState('games_data'), (data.stamps['games_data'], 0))
+    store.setState('games_data', None, 2)
+    self.assertEqual(store.getState('games_data'), (None, 2))
+    # databases that cannot be migrated are not stored at all
+    store.migrate(userdata.UserData())
+    self.assertIsNone(store.getState('movies_data'))
+
+
+if __name__ == "__main__":
+  unittest.main()
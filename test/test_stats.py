@@ -0,0 +1,215 @@
+import os
+import statistics
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import columnstore
+import statengine
+import statview
+import synthetic
+
+
+class FakeCanvas(object):
+  """Stands in for a tk.Canvas, remembering its items and counting the calls."""
+  def __init__(self):
+    self.items = {}
+    self.calls = 0
+  def create(self, kind:str, coords:tuple, options:dict):
+    self.calls += 1
+    iid = len(self.items) + 1
+    self.items[iid] = dict(options, kind=kind, coords=list(coords))
+    return iid
+  def create_line(self, *coords, **options):
+    return self.create('line', coords, options)
+  def create_rectangle(self, *coords, **options):
+    return self.create('rectangle', coords, options)
+  def create_text(self, *coords, **options):
+    return self.create('text', coords, options)
+  def coords(self, iid, *coords):
+    self.calls += 1
+    self.items[iid]['coords'] = list(coords)
+  def itemconfigure(self, iid, **options):
+    self.calls += 1
+    self.items[iid].update(options)
+
+
+class TestStatEngine(unittest.TestCase):
+  """Test the statistics computed by the StatEngine against the plain ones."""
+  @classmethod
+  def setUpClass(self):
+    records = synthetic.makeRecords(500, 'Movie', seed=8)
+    for i, record in enumerate(records):
+      if i % 19 == 0:
+        record['userdata'] = {}
+      elif i % 7 == 0:
+        record['userdata']['rating']['rating'] = 0
+    self.store = columnstore.ColumnStore('Movie', records)
+    self.ratings = [self.store.get(row, 'rating') or 0 for row in range(len(self.store))]
+
+  def assertStats(self, mask):
+    stats, changed = statengine.StatEngine().compute(self.store, mask)
+    self.assertTrue(changed)
+    ratings = [rating for rating, passed in zip(self.ratings, mask) if passed]
+    rated = [rating for rating in ratings if rating > 0]
+    self.assertEqual(stats.count, len(ratings))
+    self.assertEqual(list(stats.histogram), [ratings.count(i) for i in range(11)])
+    self.assertAlmostEqual(stats.mean, statistics.mean(rated) if rated else 0.0)
+    self.assertEqual(stats.median, statistics.median(rated) if rated else 0.0)
+
+  def test_stats(self):
+    """Count, histogram, mean and median for various selections."""
+    length = len(self.store)
+    self.assertStats(np.ones(length, dtype=bool))
+    self.assertStats(np.arange(length) % 3 == 0)
+    self.assertStats(np.arange(length) < 2)
+    self.assertStats(np.arange(length) == 1)
+    self.assertStats(np.zeros(length, dtype=bool))
+
+  def test_median(self):
+    """Median of an odd and even number of ratings, from a histogram."""
+    for ratings in [[1], [1, 2], [3, 3, 7], [2, 5, 9, 10], [0, 0, 4, 8]]:
+      stats = statengine.StatEngine.computeStats(np.array(ratings, dtype=np.int8))
+      self.assertEqual(stats.median, statistics.median([r for r in ratings if r > 0]))
+
+  def test_unchanged(self):
+    """The same selection is not computed again."""
+    engine = statengine.StatEngine()
+    mask = np.arange(len(self.store)) % 2 == 0
+    stats, _ = engine.compute(self.store, mask)
+    same, changed = engine.compute(self.store, mask.copy())
+    self.assertFalse(changed)
+    self.assertIs(same, stats)
+    mask[0] = False
+    _, changed = engine.compute(self.store, mask)
+    self.assertTrue(changed)
+    store = columnstore.ColumnStore('Movie', synthetic.makeRecords(len(self.store), 'Movie'))
+    _, changed = engine.compute(store, mask)
+    self.assertTrue(changed)
+
+
+class TestAggregates(unittest.TestCase):
+  """Test the grouped aggregates against the same computed item by item."""
+  @classmethod
+  def setUpClass(self):
+    records = synthetic.makeRecords(400, 'Movie', seed=9)
+    for i, record in enumerate(records):
+      if i % 13 == 0:
+        record['userdata'] = {}
+      if i % 17 == 0:
+        record.pop('countries')
+        record.pop('duration')
+    self.store = columnstore.ColumnStore('Movie', records)
+    self.views = self.store.views()
+
+  def expectedGroups(self, mask, key):
+    """Group the rated items by key(view), which returns a list of groups."""
+    groups = {}
+    for view, passed in zip(self.views, mask):
+      rating = view.getRawProperty('rating')
+      if passed and rating:
+        for group in key(view):
+          groups.setdefault(group, []).append(rating)
+    return {group: (len(ratings), statistics.mean(ratings)) for group, ratings in groups.items()}
+
+  def assertAggregates(self, aggregates, mask):
+    keys = {
+      'years': lambda view: [view.getRawProperty('dateOf').year],
+      'genres': lambda view: view.getRawProperty('genres'),
+      'countries': lambda view: view.getRawProperty('countries') or [],
+      'directors': lambda view: view.getRawProperty('directors'),
+    }
+    for name, key in keys.items():
+      expected = self.expectedGroups(mask, key)
+      groups = aggregates[name].getGroups()
+      self.assertEqual(len(groups), len(expected), name)
+      for label, count, mean in groups:
+        self.assertEqual(count, expected[label][0], name)
+        self.assertAlmostEqual(mean, expected[label][1], msg=name)
+    selected = [view for view, passed in zip(self.views, mask) if passed]
+    durations = [view.getRawProperty('duration') for view in selected]
+    self.assertEqual(aggregates['duration'].getTotal(), (
+      len([d for d in durations if d != '']), float(sum(d for d in durations if d != ''))
+    ))
+    deltas = [
+      view.getRawProperty('rating') - view.getRawProperty('fwRating')
+      for view in selected if view.getRawProperty('rating')
+    ]
+    count, total = aggregates['delta'].getTotal()
+    self.assertEqual(count, len(deltas))
+    self.assertAlmostEqual(total, sum(deltas))
+
+  def test_aggregates(self):
+    """Aggregates of all, some and none of the items."""
+    length = len(self.store)
+    for mask in [np.ones(length, dtype=bool), np.arange(length) % 4 == 1, np.zeros(length, dtype=bool)]:
+      self.assertAggregates(statengine.AggregateEngine().compute(self.store, mask), mask)
+
+  def test_incremental(self):
+    """Aggregates updated with small and large changes of the selection."""
+    engine = statengine.AggregateEngine()
+    rng = np.random.default_rng(0)
+    mask = np.ones(len(self.store), dtype=bool)
+    for flipped in [5, 20, 300, 1, 150, 2]:
+      mask = mask.copy()
+      rows = rng.choice(len(self.store), flipped, replace=False)
+      mask[rows] = ~mask[rows]
+      self.assertAggregates(engine.compute(self.store, mask), mask)
+
+  def test_games(self):
+    """Items with no countries, directors or duration."""
+    store = columnstore.ColumnStore('Game', synthetic.makeRecords(50, 'Game'))
+    aggregates = statengine.AggregateEngine().compute(store, np.ones(50, dtype=bool))
+    self.assertEqual(sorted(aggregates.keys()), ['delta', 'genres', 'years'])
+
+
+class TestHistogram(unittest.TestCase):
+  """Test the geometry of the histogram drawn on a canvas."""
+  def setUp(self):
+    self.canvas = FakeCanvas()
+    self.histogram = statview.Histogram(self.canvas)
+
+  def test_step(self):
+    """Grid steps are round numbers, covering the maximum in a few steps."""
+    for maximum, step in [(0, 1), (3, 1), (7, 2), (10, 2), (11, 5), (24, 5), (26, 10), (480, 100), (1234, 500)]:
+      self.assertEqual(statview.Histogram.makeStep(maximum, 5), step, maximum)
+
+  def test_bars(self):
+    """Bars are proportional to the values, and the highest one fits in the chart."""
+    values = [3, 0, 1, 2, 5, 8, 17, 23, 12, 4, 1]
+    created = len(self.canvas.items)
+    self.histogram.update(values)
+    self.assertEqual(len(self.canvas.items), created)
+    heights = []
+    for (bar, _, _), value in zip(self.histogram.bars, values):
+      x0, y0, x1, y1 = self.canvas.items[bar]['coords']
+      self.assertEqual(y1, self.histogram.y0)
+      heights.append(y1 - y0)
+    self.assertLessEqual(max(heights), self.histogram.height)
+    for height, value in zip(heights, values):
+      self.assertAlmostEqual(height, heights[7] * value / 23)
+
+  def test_grid(self):
+    """Grid lines are labelled with the steps, unneeded ones are hidden."""
+    self.histogram.update([0, 0, 0, 0, 0, 0, 3, 0, 0, 0, 0])
+    labels = [self.canvas.items[label] for _, label in self.histogram.grid]
+    self.assertEqual([l['text'] for l in labels[:4]], ['0', '1', '2', '3'])
+    self.assertEqual([l['state'] for l in labels], ['normal'] * 4 + ['hidden'] * 2)
+    self.histogram.update([0, 0, 0, 0, 0, 0, 48, 0, 0, 0, 0])
+    self.assertEqual([l['text'] for l in labels], ['0', '10', '20', '30', '40', '50'])
+    # the top line is at the top of the chart
+    line = self.canvas.items[self.histogram.grid[-1][0]]
+    self.assertAlmostEqual(line['coords'][1], self.histogram.y0 - self.histogram.height)
+
+  def test_notify(self):
+    """Message is shown until the next update."""
+    self.histogram.notify('nothing here')
+    self.assertEqual(self.canvas.items[self.histogram.message]['text'], 'nothing here')
+    self.histogram.update([1] * 11)
+    self.assertEqual(self.canvas.items[self.histogram.message]['text'], '')
+
+
+if __name__ == "__main__":
+  unittest.main()
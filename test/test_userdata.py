@@ -0,0 +1,197 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join('..', 'filmatyk'))
+import synthetic
+import userdata
+
+
+def makeUserData():
+  """Create a UserData with every field distinct, and databases of some size."""
+  fields = {name: '{} value'.format(name) for name in userdata.UserData.FIELDS}
+  fields['options_json'] = '{"rememberLogin": true}'
+  fields['movies_data'] = json.dumps(synthetic.makeRecords(300, 'Movie'))
+  fields['series_data'] = json.dumps(synthetic.makeRecords(100, 'Series'))
+  fields['games_data'] = json.dumps(synthetic.makeRecords(50, 'Game'))
+  return userdata.UserData(**fields)
+
+
+class TestUserData(unittest.TestCase):
+  """Test saving and loading of the user data, in the current and legacy formats."""
+  VERSION = '1.0.0-beta.5'
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+    self.path = os.path.join(self.directory, 'filmatyk.dat')
+    self.manager = userdata.DataManager(self.path, self.VERSION)
+
+  def assertFields(self, loaded, expected):
+    for name in userdata.UserData.FIELDS:
+      self.assertEqual(getattr(loaded, name), getattr(expected, name), name)
+
+  def writeLines(self, lines:list):
+    with open(self.path, 'w') as user_file:
+      user_file.write('\n'.join(lines) + '\n')
+
+  def test_roundtrip(self):
+    """Saved data is loaded back the same."""
+    saved = makeUserData()
+    self.manager.save(saved)
+    self.assertTrue(userdata.SectionFile.isSectionFile(self.path))
+    # the binary format has a version of its own, newer than any text format
+    self.assertEqual(userdata.SectionFile(self.path).read('version'), self.VERSION)
+    self.assertIsNone(self.manager.selectLoader(userdata.Version('1.0.0-beta.4'), binary=True))
+    loaded = self.manager.load()
+    self.assertFalse(loaded.is_empty)
+    self.assertFields(loaded, saved)
+    # the databases are stored compressed
+    length = sum(len(getattr(saved, name)) for name in userdata.UserData.FIELDS)
+    self.assertLess(os.path.getsize(self.path), length / 2)
+
+  def test_lazy(self):
+    """Sections are only read when accessed, each one on its own."""
+    saved = makeUserData()
+    self.manager.save(saved)
+    loaded = self.manager.load()
+    self.assertIsInstance(loaded, userdata.LazyUserData)
+    self.assertNotIn('games_data', vars(loaded))
+    # damage the games section - the others can still be read
+    offset, length = loaded.sections.table['games_data']
+    with open(self.path, 'r+b') as user_file:
+      user_file.seek(offset)
+      user_file.write(b'\xff' * length)
+    self.assertEqual(loaded.movies_data, saved.movies_data)
+    self.assertIn('movies_data', vars(loaded))
+    # the damaged one is default, as if the whole file could not be read
+    self.assertEqual(loaded.games_data, '')
+    self.assertEqual(loaded.damaged, {'games_data'})
+
+  def test_resave(self):
+    """Sections not read yet can be read after the file has been saved again."""
+    saved = makeUserData()
+    self.manager.save(saved)
+    loaded = self.manager.load()
+    changed = makeUserData()
+    changed.username = 'somebody else, with a longer name'
+    changed.series_data = '[]'
+    self.manager.save(changed)
+    self.assertFalse(os.path.exists(self.path + '.bak'))
+    self.assertEqual(loaded.username, changed.username)
+    self.assertEqual(loaded.series_data, '[]')
+    self.assertEqual(loaded.games_data, saved.games_data)
+
+  def test_missing(self):
+    """Fields that the file has no sections for are default."""
+    userdata.SectionFile.write(self.path, [('version', self.VERSION), ('username', 'user')])
+    loaded = self.manager.load()
+    self.assertEqual(loaded.username, 'user')
+    self.assertEqual(loaded.movies_data, '')
+    self.assertEqual(loaded.options_json, '{}')
+    with self.assertRaises(AttributeError):
+      loaded.something_else
+
+  def test_legacy(self):
+    """Text files of the previous versions are still loaded."""
+    expected = makeUserData()
+    self.writeLines([
+      '#VERSION', '1.0.0-beta.4', '#USERNAME', expected.username,
+      '#OPTIONS', expected.options_json, '#SESSION', expected.session_pkl,
+      '#MOVIES', expected.movies_conf, expected.movies_data,
+      '#SERIES', expected.series_conf, expected.series_data,
+      '#GAMES', expected.games_conf, expected.games_data,
+    ])
+    loaded = self.manager.load()
+    self.assertNotIsInstance(loaded, userdata.LazyUserData)
+    self.assertFalse(loaded.is_empty)
+    self.assertFields(loaded, expected)
+    # the oldest format had no options and session
+    self.writeLines([
+      '#VERSION', '1.0.0-beta.1', '#USERNAME', expected.username,
+      '#MOVIES', expected.movies_conf, expected.movies_data,
+      '#SERIES', expected.series_conf, expected.series_data,
+      '#GAMES', expected.games_conf, expected.games_data,
+    ])
+    loaded = self.manager.load()
+    self.assertEqual(loaded.games_data, expected.games_data)
+    self.assertEqual(loaded.options_json, '{}')
+
+  def test_broken(self):
+    """Files that cannot be read give empty data."""
+    self.assertTrue(self.manager.load().is_empty)
+    with open(self.path, 'wb') as user_file:
+      user_file.write(userdata.SectionFile.MAGIC + b'\x01')
+    self.assertTrue(self.manager.load().is_empty)
+    self.writeLines(['no version here'])
+    self.assertTrue(self.manager.load().is_empty)
+
+
+class TestJournal(unittest.TestCase):
+  """Test appending changes to the journal and replaying them on load."""
+  VERSION = '1.0.0-beta.5'
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+    self.path = os.path.join(self.directory, 'filmatyk.dat')
+    self.manager = userdata.DataManager(self.path, self.VERSION)
+    self.saved = makeUserData()
+    self.manager.save(self.saved)
+    self.change = {'head': [3, 1], 'records': [{'id': 3, 'title': 'New'}], 'removed': [2]}
+
+  def test_replay(self):
+    """Fields are replaced and changes of databases collected, in order."""
+    self.manager.appendChanges({'session_pkl': 'new session'}, {'movies_data': [self.change]})
+    self.manager.appendChanges({'session_pkl': 'newer session', 'games_conf': 'conf'}, {'movies_data': [{}]})
+    loaded = self.manager.load()
+    self.assertEqual(loaded.session_pkl, 'newer session')
+    self.assertEqual(loaded.games_conf, 'conf')
+    self.assertEqual(loaded.movies_conf, self.saved.movies_conf)
+    self.assertEqual(loaded.changes, {'movies_data': [self.change, {}]})
+    # the databases themselves are still read only when needed
+    self.assertNotIn('movies_data', vars(loaded))
+    self.assertEqual(loaded.movies_data, self.saved.movies_data)
+
+  def test_small(self):
+    """A small change costs a small write."""
+    size = os.path.getsize(self.path)
+    self.manager.appendChanges({'movies_conf': '{"columns": {}}'}, {'movies_data': [], 'games_data': []})
+    self.assertLess(os.path.getsize(self.manager.journal_path), 100)
+    self.assertEqual(os.path.getsize(self.path), size)
+    self.manager.appendChanges({}, {'movies_data': []})
+    self.assertLess(os.path.getsize(self.manager.journal_path), 100)
+
+  def test_compaction(self):
+    """Journal is only compacted when it has grown, and saving removes it."""
+    self.assertFalse(self.manager.needsCompaction())
+    self.manager.appendChanges({'session_pkl': 'x'}, {})
+    self.assertFalse(self.manager.needsCompaction())
+    limit = max(self.manager.JOURNAL_MIN, self.manager.JOURNAL_RATIO * os.path.getsize(self.path))
+    self.manager.appendChanges({'session_pkl': 'x' * int(limit)}, {})
+    self.assertTrue(self.manager.needsCompaction())
+    self.manager.save(self.manager.load())
+    self.assertFalse(os.path.exists(self.manager.journal_path))
+    self.assertEqual(self.manager.load().session_pkl, 'x' * int(limit))
+    # without the file, even an empty journal is not enough
+    os.remove(self.path)
+    self.assertTrue(self.manager.needsCompaction())
+
+  def test_damaged(self):
+    """Journal is read up to a damaged line, and then truncated there."""
+    self.manager.appendChanges({'username': 'first'}, {})
+    size = os.path.getsize(self.manager.journal_path)
+    with open(self.manager.journal_path, 'a') as journal:
+      journal.write('{"field": "username", "val')
+    loaded = self.manager.load()
+    self.assertEqual(loaded.username, 'first')
+    self.assertEqual(os.path.getsize(self.manager.journal_path), size)
+    self.manager.appendChanges({'username': 'second'}, {})
+    self.assertEqual(self.manager.load().username, 'second')
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -7,7 +7,8 @@ import importlib
 dependencies = {
   #package name:      import module
   'beautifulsoup4':   'bs4',
-  'matplotlib':       'matplotlib',
+  'lxml':             'lxml',
+  'numpy':            'numpy',
   'pillow':           'PIL',
   'requests':         'requests',
   'requests_html':    'requests_html',